@@ -0,0 +1,470 @@
+"""
+Web 后端：在同步的 CompanyStoryGenerator 外面包一层异步任务服务
+
+生成一篇文章要几分钟，HTTP 请求不直接等待生成结果：
+- POST /api/generate 提交任务，立即返回任务编号（缓存新鲜时直接返回结果）
+- 任务在有界线程池中运行，同一家公司的进行中任务会被复用
+- GET /api/jobs/{job_id}/events 以 Server-Sent Events 推送阶段和章节进度
+- GET /api/jobs/{job_id} 查询任务状态和结果
+
+    cd api && python main.py
+    uvicorn main:app --port 8000
+
+设置 OPENAI_BASE_URL 可以指向本地模拟服务（bench/mock_server.py）做端到端测试。
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any, List, Callable
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+try:
+    from dotenv import load_dotenv
+    load_dotenv()
+except ImportError:
+    pass
+
+from company_story import CompanyStoryGenerator  # noqa: E402
+from http_client import configure_http_client, close_openai_clients  # noqa: E402
+from metrics import get_metrics  # noqa: E402
+from utils import normalize_ticker_or_name  # noqa: E402
+
+# SSE 心跳间隔（秒），防止代理在长时间无输出时断开连接
+SSE_HEARTBEAT_SECONDS = 15
+# 已结束任务的保留时间（秒）
+JOB_RETENTION_SECONDS = 3600
+
+
+class GenerateRequest(BaseModel):
+    """生成请求"""
+    company: str = Field(..., min_length=1, description="公司名或股票代码")
+    use_cache: bool = Field(True, description="是否使用缓存")
+    stream: bool = Field(False, description="是否推送文章内容片段（仅 single 写作模式）")
+    wait: bool = Field(False, description="是否等待生成完成再返回（兼容旧的同步调用）")
+
+
+class Job:
+    """一个生成任务：状态、进度事件和结果"""
+
+    def __init__(self, company: str, use_cache: bool, stream: bool):
+        self.id = uuid.uuid4().hex
+        self.company = company
+        self.use_cache = use_cache
+        self.stream = stream
+        self.status = "queued"
+        self.stage: Optional[str] = None
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        self.future: Optional[Future] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict[str, Any]] = []
+        self._subscribers: List[tuple] = []
+        self._lock = threading.Lock()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def publish(self, event: str, data: Dict[str, Any]) -> None:
+        """
+        记录一个进度事件并推送给所有订阅者（可在工作线程中调用）
+
+        Args:
+            event: 事件名（stage、chapter、chunk、done、error）
+            data: 事件数据
+        """
+        with self._lock:
+            item = {"id": len(self.events) + 1, "event": event, "data": data}
+            self.events.append(item)
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # 订阅者的事件循环已关闭（连接已断开），丢弃该订阅，不影响生成任务
+                self.unsubscribe(queue)
+
+    @staticmethod
+    def is_terminal(item: Dict[str, Any]) -> bool:
+        """是否为任务结束事件（done、error）"""
+        return item["event"] in ("done", "error")
+
+    def subscribe(self, loop: asyncio.AbstractEventLoop, after: int = 0) -> tuple:
+        """
+        订阅进度事件
+
+        Args:
+            loop: 订阅者所在的事件循环
+            after: 只回放编号大于 after 的历史事件（SSE 断线重连时的 Last-Event-ID）
+
+        Returns:
+            (历史事件列表, asyncio.Queue, 是否已结束)，之后的新事件会放入队列；
+            任务已结束时不会再有新事件，也不注册订阅
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        with self._lock:
+            backlog = [item for item in self.events if item["id"] > after]
+            finished = any(self.is_terminal(item) for item in self.events)
+            if not finished:
+                self._subscribers.append((loop, queue))
+        return backlog, queue, finished
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        with self._lock:
+            self._subscribers = [item for item in self._subscribers if item[1] is not queue]
+
+    def to_dict(self, include_result: bool = True) -> Dict[str, Any]:
+        data = {
+            "job_id": self.id,
+            "company": self.company,
+            "status": self.status,
+            "stage": self.stage,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+        if include_result and self.result is not None:
+            data.update(self.result)
+        return data
+
+
+class JobManager:
+    """
+    任务管理：有界线程池执行生成，排队中的任务数有上限
+
+    所有任务共享同一个生成器（同一个 OpenAI client、缓存和限流器）。
+    """
+
+    def __init__(
+        self,
+        generator_factory: Callable[[], CompanyStoryGenerator],
+        max_workers: int = 4,
+        max_pending: int = 32,
+        retention_seconds: float = JOB_RETENTION_SECONDS
+    ):
+        """
+        初始化任务管理器
+
+        Args:
+            generator_factory: 创建生成器的函数（第一次需要时才调用）
+            max_workers: 同时运行的生成任务数
+            max_pending: 未完成任务（排队 + 运行中）的上限，超过时拒绝新任务
+            retention_seconds: 已结束任务在内存中保留的时间
+        """
+        self.generator_factory = generator_factory
+        self.max_workers = max(1, max_workers)
+        self.max_pending = max(self.max_workers, max_pending)
+        self.retention_seconds = retention_seconds
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="job")
+        self.jobs: Dict[str, Job] = {}
+        self._inflight: Dict[tuple, Job] = {}
+        self._generator: Optional[CompanyStoryGenerator] = None
+        self._lock = threading.Lock()
+
+    @property
+    def generator(self) -> CompanyStoryGenerator:
+        with self._lock:
+            if self._generator is None:
+                self._generator = self.generator_factory()
+            return self._generator
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def submit(self, company: str, use_cache: bool = True, stream: bool = False) -> Job:
+        """
+        提交生成任务；同一家公司、同样参数的任务正在进行时直接返回该任务
+
+        Args:
+            company: 规范化后的公司标识
+            use_cache: 是否使用缓存
+            stream: 是否推送文章内容片段
+
+        Returns:
+            Job 对象
+
+        Raises:
+            RuntimeError: 未完成任务数已达上限
+        """
+        key = (company, use_cache, stream)
+        with self._lock:
+            self._prune()
+            job = self._inflight.get(key)
+            if job is not None and not job.finished:
+                return job
+            if sum(1 for item in self.jobs.values() if not item.finished) >= self.max_pending:
+                raise RuntimeError(f"任务队列已满（{self.max_pending}），请稍后再试")
+            job = Job(company, use_cache, stream)
+            self.jobs[job.id] = job
+            self._inflight[key] = job
+            job.publish("status", {"status": "queued"})
+            job.future = self.executor.submit(self._run, job, key)
+        return job
+
+    def _prune(self) -> None:
+        """删除超过保留时间的已结束任务（调用方持有锁）"""
+        cutoff = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self.jobs.items() if job.finished and job.finished_at < cutoff]:
+            del self.jobs[job_id]
+
+    def _run(self, job: Job, key: tuple) -> Dict[str, Any]:
+        """在工作线程中执行一个任务"""
+        job.status = "running"
+        job.publish("status", {"status": "running"})
+        started = time.monotonic()
+        try:
+            generator = self.generator
+
+            job.stage = "factpack"
+            job.publish("stage", {"stage": "factpack", "state": "started"})
+            factpack = generator.generate_fact_pack(job.company, use_cache=job.use_cache)
+            job.publish("stage", {"stage": "factpack", "state": "done"})
+
+            job.stage = "article"
+            job.publish("stage", {"stage": "article", "state": "started"})
+            article = generator.generate_article(
+                factpack,
+                stream=job.stream,
+                on_chunk=(lambda chunk: job.publish("chunk", {"text": chunk})) if job.stream else None,
+                on_progress=lambda event, data: job.publish(event, data),
+                use_cache=job.use_cache
+            )
+            job.publish("stage", {"stage": "article", "state": "done"})
+
+            job.result = build_result(job.company, article, factpack, generator.result_metadata(), cached=False)
+            job.status = "done"
+            job.stage = None
+            job.finished_at = time.time()
+            job.publish("done", {"job_id": job.id, "elapsed": round(time.monotonic() - started, 3)})
+            return job.result
+        except Exception as e:
+            job.error = str(e)
+            job.status = "error"
+            job.finished_at = time.time()
+            job.publish("error", {"job_id": job.id, "stage": job.stage, "error": job.error})
+            raise
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is job:
+                    del self._inflight[key]
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def build_result(
+    company: str,
+    article: str,
+    factpack,
+    metadata: Dict[str, Any],
+    cached: bool
+) -> Dict[str, Any]:
+    """
+    组装返回给前端的结果
+
+    Args:
+        company: 公司标识
+        article: Markdown 文章
+        factpack: FactPack 对象
+        metadata: 生成元数据
+        cached: 是否直接来自缓存
+
+    Returns:
+        结果字典
+    """
+    return {
+        "company": company,
+        "article": article,
+        "factpack": factpack.model_dump(mode="json"),
+        "metadata": metadata,
+        "cached": cached,
+    }
+
+
+def default_generator_factory() -> CompanyStoryGenerator:
+    """按环境变量创建生成器"""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise RuntimeError("未设置 OPENAI_API_KEY 环境变量")
+    return CompanyStoryGenerator(
+        api_key=api_key,
+        model=os.getenv("OPENAI_MODEL", "gpt-4o"),
+        base_url=os.getenv("OPENAI_BASE_URL") or None,
+        enable_web_search=os.getenv("ENABLE_WEB_SEARCH", "1").lower() not in ("0", "false", "no"),
+        writer_mode=os.getenv("WRITER_MODE", "single"),
+        factpack_mode=os.getenv("FACTPACK_MODE", "single")
+    )
+
+
+def format_sse(item: Dict[str, Any]) -> str:
+    """把事件编码为一条 SSE 消息"""
+    data = json.dumps(item["data"], ensure_ascii=False)
+    return f"id: {item['id']}\nevent: {item['event']}\ndata: {data}\n\n"
+
+
+def create_app(manager: Optional[JobManager] = None) -> FastAPI:
+    """
+    创建 FastAPI 应用
+
+    Args:
+        manager: 任务管理器（默认按环境变量 API_MAX_WORKERS、API_MAX_QUEUE 创建）
+
+    Returns:
+        FastAPI 应用
+    """
+    if manager is None:
+        max_workers = int(os.getenv("API_MAX_WORKERS", "4"))
+        # 每个任务最多同时发出约 6 个请求（分章节写作）
+        configure_http_client(max_connections=max(32, max_workers * 6), max_keepalive_connections=max(16, max_workers * 6))
+        manager = JobManager(
+            default_generator_factory,
+            max_workers=max_workers,
+            max_pending=int(os.getenv("API_MAX_QUEUE", "32"))
+        )
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        manager.shutdown()
+        close_openai_clients()
+
+    app = FastAPI(title="Company Story API", lifespan=lifespan)
+    app.state.jobs = manager
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=[
+            origin.strip()
+            for origin in os.getenv("ALLOWED_ORIGINS", "http://localhost:3000").split(",")
+            if origin.strip()
+        ],
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    def _get_job(job_id: str) -> Job:
+        job = manager.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="任务不存在或已过期")
+        return job
+
+    @app.get("/api/health")
+    async def health() -> Dict[str, Any]:
+        return {"status": "ok", "pending_jobs": manager.pending_count(), "max_workers": manager.max_workers}
+
+    @app.post("/api/generate")
+    async def generate(request: GenerateRequest, http_request: Request):
+        ticker, name = normalize_ticker_or_name(request.company)
+        company = ticker or name
+
+        # 当天的 Fact Pack 和文章都已缓存时直接返回，不占用工作线程
+        if request.use_cache:
+            try:
+                generator = await asyncio.to_thread(lambda: manager.generator)
+            except RuntimeError as e:
+                raise HTTPException(status_code=500, detail=str(e))
+            cached = await asyncio.to_thread(generator.load_cached_result, company)
+            if cached is not None:
+                article, factpack = cached
+                return dict(
+                    build_result(company, article, factpack, generator.result_metadata(), cached=True),
+                    status="done"
+                )
+
+        try:
+            job = manager.submit(company, use_cache=request.use_cache, stream=request.stream)
+        except RuntimeError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+        if request.wait:
+            try:
+                await asyncio.wrap_future(job.future)
+            except Exception:
+                raise HTTPException(status_code=500, detail=job.error or "生成失败")
+            return job.to_dict()
+
+        base = str(http_request.url_for("job_status", job_id=job.id))
+        return JSONResponse(
+            status_code=202,
+            content={
+                "job_id": job.id,
+                "status": job.status,
+                "status_url": base,
+                "events_url": base + "/events",
+            }
+        )
+
+    @app.get("/api/jobs/{job_id}", name="job_status")
+    async def job_status(job_id: str) -> Dict[str, Any]:
+        return _get_job(job_id).to_dict()
+
+    @app.get("/api/jobs/{job_id}/events")
+    async def job_events(job_id: str, request: Request):
+        job = _get_job(job_id)
+        try:
+            after = int(request.headers.get("last-event-id", "0"))
+        except ValueError:
+            after = 0
+
+        async def _stream():
+            backlog, queue, finished = job.subscribe(asyncio.get_running_loop(), after=after)
+            try:
+                for item in backlog:
+                    yield format_sse(item)
+                    if Job.is_terminal(item):
+                        return
+                # Last-Event-ID 已经在结束事件之后：没有可回放的事件，也不会再有新事件
+                if finished:
+                    return
+                while True:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+                    except asyncio.TimeoutError:
+                        if await request.is_disconnected():
+                            return
+                        yield ": ping\n\n"
+                        continue
+                    yield format_sse(item)
+                    if Job.is_terminal(item):
+                        return
+            finally:
+                job.unsubscribe(queue)
+
+        return StreamingResponse(
+            _stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics() -> str:
+        return get_metrics().to_prometheus()
+
+    return app
+
+
+app = create_app()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,418 @@
+"""
+批量生成：从文件或标准输入读取公司列表，使用有界线程池并发生成
+"""
+import sys
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Dict, Any
+
+from utils import normalize_ticker_or_name
+
+
+def read_company_list(source: str) -> List[str]:
+    """
+    读取公司列表
+
+    每行一个公司名或股票代码（也可以用逗号分隔），空行和以 # 开头的行会被忽略，
+    重复的公司只保留第一次出现。
+
+    Args:
+        source: 文件路径，"-" 表示从标准输入读取
+
+    Returns:
+        规范化后的公司标识列表（ticker 或 name）
+    """
+    if source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, 'r', encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+    companies = []
+    seen = set()
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        for item in line.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            ticker, name = normalize_ticker_or_name(item)
+            identifier = ticker or name
+            if identifier not in seen:
+                seen.add(identifier)
+                companies.append(identifier)
+
+    return companies
+
+
+def _format_duration(seconds: float) -> str:
+    """格式化耗时"""
+    if seconds < 60:
+        return f"{seconds:.1f} 秒"
+    return f"{int(seconds // 60)} 分 {seconds % 60:.0f} 秒"
+
+
+class _BatchProgress:
+    """批量任务的进度与结果统计（线程安全）"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.succeeded: List[str] = []
+        self.failed: List[Dict[str, str]] = []
+        self.durations: Dict[str, float] = {}
+        self.started = time.monotonic()
+        self._done = 0
+        self._lock = threading.Lock()
+
+    def success(self, company: str, duration: float, detail: str = "") -> None:
+        with self._lock:
+            self._done += 1
+            self.succeeded.append(company)
+            self.durations[company] = duration
+            print(f"[{self._done}/{self.total}] ✓ {company}（耗时 {_format_duration(duration)}{detail}）")
+
+    def failure(self, company: str, error: Exception, stage: str = "") -> None:
+        with self._lock:
+            self._done += 1
+            message = f"{stage}: {error}" if stage else str(error)
+            self.failed.append({"company": company, "error": message})
+            print(f"[{self._done}/{self.total}] ✗ {company} 失败: {message}")
+
+    def summary(self, **extra) -> Dict[str, Any]:
+        elapsed = time.monotonic() - self.started
+        result = {
+            "total": self.total,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "elapsed": elapsed,
+            "durations": self.durations,
+            "throughput_per_min": (len(self.succeeded) / elapsed * 60) if elapsed > 0 else 0.0
+        }
+        result.update(extra)
+        return result
+
+
+def run_batch(
+    generator,
+    companies: List[str],
+    concurrency: int = 4,
+    use_cache: Optional[bool] = None,
+    save: bool = True
+) -> Dict[str, Any]:
+    """
+    并发生成多家公司的文章
+
+    所有任务共享同一个生成器（即同一个 OpenAI client 和同一个缓存目录），
+    单个公司失败不会影响其他公司。
+
+    Args:
+        generator: CompanyStoryGenerator 实例
+        companies: 公司标识列表
+        concurrency: 最大并发数
+        use_cache: 是否使用缓存（覆盖生成器设置）
+        save: 是否保存输出文件
+
+    Returns:
+        汇总结果字典（succeeded、failed、elapsed、throughput_per_min 等）
+    """
+    # 延迟导入，避免与 company_story 循环导入
+    from company_story import save_outputs
+
+    concurrency = max(1, concurrency)
+    progress = _BatchProgress(len(companies))
+
+    def _run_one(company: str) -> float:
+        started = time.monotonic()
+        article, factpack = generator.generate(company, use_cache=use_cache)
+        if save:
+            save_outputs(company, article, factpack, metadata=generator.result_metadata())
+        return time.monotonic() - started
+
+    print(f"批量生成：共 {len(companies)} 家公司，并发数 {concurrency}")
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="story") as executor:
+        futures = {executor.submit(_run_one, company): company for company in companies}
+        for future in as_completed(futures):
+            company = futures[future]
+            try:
+                progress.success(company, future.result())
+            except Exception as e:
+                progress.failure(company, e)
+
+    summary = progress.summary(concurrency=concurrency)
+    print_batch_summary(summary)
+    return summary
+
+
+def run_pipeline(
+    generator,
+    companies: List[str],
+    factpack_concurrency: int = 4,
+    article_concurrency: int = 4,
+    use_cache: Optional[bool] = None,
+    save: bool = True
+) -> Dict[str, Any]:
+    """
+    两阶段流水线批量生成：Fact Pack 阶段和文章阶段各有独立的并发上限
+
+    Fact Pack 完成后立即放入队列，由文章阶段的工作线程取走，因此公司 N+1 的
+    资料收集与公司 N 的写作可以同时进行。两个阶段的 token 消耗和限流特征不同，
+    分开限流可以让两边都跑满。
+
+    Args:
+        generator: CompanyStoryGenerator 实例
+        companies: 公司标识列表
+        factpack_concurrency: Fact Pack 阶段最大并发数
+        article_concurrency: 文章阶段最大并发数
+        use_cache: 是否使用缓存（覆盖生成器设置）
+        save: 是否保存输出文件
+
+    Returns:
+        汇总结果字典（同 run_batch，另含各阶段耗时）
+    """
+    from company_story import save_outputs
+
+    factpack_concurrency = max(1, factpack_concurrency)
+    article_concurrency = max(1, article_concurrency)
+    progress = _BatchProgress(len(companies))
+    stage_durations: Dict[str, Dict[str, float]] = {"factpack": {}, "article": {}}
+    # 队列有界：写作跟不上时，Fact Pack 阶段会自然放慢，避免积压过多结果
+    handoff: "queue.Queue" = queue.Queue(maxsize=max(factpack_concurrency, article_concurrency) * 2)
+    stop = object()
+
+    def _fact_stage(company: str) -> None:
+        started = time.monotonic()
+        try:
+            factpack = generator.generate_fact_pack(company, use_cache=use_cache)
+        except Exception as e:
+            progress.failure(company, e, stage="Fact Pack")
+            return
+        stage_durations["factpack"][company] = time.monotonic() - started
+        handoff.put((company, factpack, started))
+
+    def _article_worker() -> None:
+        while True:
+            item = handoff.get()
+            if item is stop:
+                return
+            company, factpack, started = item
+            article_started = time.monotonic()
+            try:
+                article = generator.generate_article(factpack, use_cache=use_cache)
+                if save:
+                    save_outputs(company, article, factpack, metadata=generator.result_metadata())
+            except Exception as e:
+                progress.failure(company, e, stage="文章")
+                continue
+            stage_durations["article"][company] = time.monotonic() - article_started
+            progress.success(
+                company,
+                time.monotonic() - started,
+                detail=f"，Fact Pack {_format_duration(stage_durations['factpack'][company])}"
+            )
+
+    print(
+        f"流水线批量生成：共 {len(companies)} 家公司，"
+        f"Fact Pack 并发 {factpack_concurrency}，文章并发 {article_concurrency}"
+    )
+
+    writers = [
+        threading.Thread(target=_article_worker, name=f"article-{i}", daemon=True)
+        for i in range(article_concurrency)
+    ]
+    for writer in writers:
+        writer.start()
+
+    with ThreadPoolExecutor(max_workers=factpack_concurrency, thread_name_prefix="factpack") as executor:
+        list(executor.map(_fact_stage, companies))
+
+    for _ in writers:
+        handoff.put(stop)
+    for writer in writers:
+        writer.join()
+
+    summary = progress.summary(
+        concurrency=f"{factpack_concurrency}+{article_concurrency}",
+        stage_durations=stage_durations
+    )
+    print_batch_summary(summary)
+    return summary
+
+
+def run_queue(
+    generator,
+    job_queue,
+    concurrency: int = 4,
+    max_attempts: int = 3,
+    use_cache: Optional[bool] = None,
+    save: bool = True
+) -> Dict[str, Any]:
+    """
+    从持久化任务队列领取公司并逐阶段生成，每完成一个阶段写入检查点
+
+    中断后用同一个队列重新运行，已完成的阶段直接读取队列里保存的 Fact Pack 和文章，
+    不会重复调用模型。
+
+    Args:
+        generator: CompanyStoryGenerator 实例
+        job_queue: job_queue.JobQueue 实例（已加入公司）
+        concurrency: 工作线程数
+        max_attempts: 每家公司最多尝试次数（跨多次运行累计，重新加入公司列表时清零）
+        use_cache: 是否使用缓存（覆盖生成器设置）
+        save: 是否保存输出文件
+
+    Returns:
+        汇总结果字典（同 run_batch，另含 resumed 和队列各阶段计数）
+    """
+    from company_story import save_outputs
+    from job_queue import make_worker_id
+    from schemas import FactPack
+
+    concurrency = max(1, concurrency)
+    recovered = job_queue.recover()
+    counts = job_queue.counts()
+    pending = counts["queued"] + counts["factpack_done"] + counts["article_done"]
+    progress = _BatchProgress(pending)
+    resumed: Dict[str, str] = {}
+    # 各工作线程当前持有租约的公司（中断时交还）
+    held: Dict[str, str] = {}
+    stop = threading.Event()
+
+    def _process(job: Dict[str, Any], worker_id: str) -> None:
+        company = job["company"]
+        stage = job["stage"]
+        if stage != "queued":
+            resumed[company] = stage
+
+        if stage == "queued":
+            factpack = generator.generate_fact_pack(company, use_cache=use_cache)
+            if not job_queue.checkpoint(company, worker_id, "factpack_done", factpack=factpack.model_dump_json()):
+                raise _LeaseLost(company)
+            stage = "factpack_done"
+        else:
+            factpack = FactPack.model_validate_json(job["factpack"])
+
+        if stage == "factpack_done":
+            article = generator.generate_article(factpack, use_cache=use_cache)
+            metadata = generator.result_metadata()
+            if not job_queue.checkpoint(company, worker_id, "article_done", article=article, metadata=metadata):
+                raise _LeaseLost(company)
+        else:
+            article, metadata = job["article"], job["metadata"]
+
+        outputs = None
+        if save:
+            outputs = list(save_outputs(company, article, factpack, metadata=metadata))
+        if not job_queue.checkpoint(company, worker_id, "written", outputs=outputs):
+            raise _LeaseLost(company)
+
+    def _worker(index: int) -> None:
+        worker_id = make_worker_id(f"queue-{index}")
+        try:
+            while not stop.is_set():
+                job = job_queue.lease(worker_id, max_attempts=max_attempts)
+                if job is None:
+                    return
+                started = time.monotonic()
+                held[worker_id] = job["company"]
+                try:
+                    _process(job, worker_id)
+                except _LeaseLost as e:
+                    print(f"警告：{e}")
+                    continue
+                except Exception as e:
+                    if job_queue.fail(job["company"], worker_id, str(e), max_attempts=max_attempts):
+                        progress.failure(job["company"], e)
+                    else:
+                        print(f"警告：{job['company']} 第 {job['attempts']} 次尝试失败，稍后重试: {e}")
+                    continue
+                finally:
+                    held.pop(worker_id, None)
+                detail = f"，从 {resumed[job['company']]} 继续" if job["company"] in resumed else ""
+                progress.success(job["company"], time.monotonic() - started, detail=detail)
+        finally:
+            job_queue.close()
+
+    print(
+        f"队列批量生成：待处理 {pending} 家（已完成 {counts['written']} 家，"
+        f"失败 {counts['failed']} 家），并发数 {concurrency}"
+    )
+    if recovered:
+        print(f"✓ 已释放 {recovered} 个由已退出进程持有的租约")
+
+    workers = [
+        threading.Thread(target=_worker, args=(i,), name=f"queue-{i}", daemon=True)
+        for i in range(concurrency)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(0.5)
+    except KeyboardInterrupt:
+        # 不再领取新任务；交还进行中的租约并退回本次尝试次数，下次运行从上一个检查点继续
+        stop.set()
+        for worker_id, company in list(held.items()):
+            job_queue.release(company, worker_id)
+        raise
+
+    summary = progress.summary(
+        concurrency=concurrency,
+        resumed=resumed,
+        queue=job_queue.counts()
+    )
+    print_batch_summary(summary)
+    if resumed:
+        print(f"从检查点继续: {len(resumed)} 家（未重复调用已完成的阶段）")
+    failed_now = {item["company"] for item in summary["failed"]}
+    earlier = [item for item in job_queue.failures() if item["company"] not in failed_now]
+    if earlier:
+        print(f"此前运行中已失败 {len(earlier)} 家（用 --batch 重新加入后重试）:")
+        for item in earlier:
+            print(f"  - {item['company']}（停在 {item['stage']}）: {item['error']}")
+    remaining = summary["queue"]["leased"]
+    if remaining:
+        print(f"另有 {remaining} 家正由其他进程处理")
+    return summary
+
+
+class _LeaseLost(Exception):
+    """租约已过期并被其他工作线程领走"""
+
+    def __init__(self, company: str):
+        super().__init__(f"{company} 的租约已过期并被其他工作线程领取，丢弃本次结果")
+
+
+def print_batch_summary(summary: Dict[str, Any]) -> None:
+    """
+    打印批量生成汇总
+
+    Args:
+        summary: run_batch 返回的汇总结果
+    """
+    durations = list(summary["durations"].values())
+
+    print(f"\n{'='*60}")
+    print("批量生成汇总")
+    print(f"{'='*60}")
+    print(f"总数: {summary['total']}")
+    print(f"成功: {len(summary['succeeded'])}")
+    print(f"失败: {len(summary['failed'])}")
+    print(f"总耗时: {_format_duration(summary['elapsed'])}")
+    print(f"吞吐量: {summary['throughput_per_min']:.2f} 家/分钟（并发数 {summary['concurrency']}）")
+    if durations:
+        print(f"单家平均耗时: {_format_duration(sum(durations) / len(durations))}")
+    for stage, label in (("factpack", "Fact Pack 阶段"), ("article", "文章阶段")):
+        stage_values = list(summary.get("stage_durations", {}).get(stage, {}).values())
+        if stage_values:
+            print(f"{label}平均耗时: {_format_duration(sum(stage_values) / len(stage_values))}")
+    if summary["failed"]:
+        print("\n失败列表:")
+        for item in summary["failed"]:
+            print(f"  - {item['company']}: {item['error']}")
+    print(f"{'='*60}\n")
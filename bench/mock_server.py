@@ -0,0 +1,515 @@
+"""
+本地模拟的 OpenAI 兼容 Chat Completions 服务（用于离线基准测试，不消耗 API 额度）
+
+按提示词内容识别请求类型（完整 Fact Pack、分段 Fact Pack、补充请求、全文写作、
+分章节写作、续写），返回固定的示例内容；延迟、输出速度、错误率可配置，支持
+SSE 流式输出和 max_tokens 截断（finish_reason 为 "length"）。
+
+单独运行：
+    python bench/mock_server.py --port 8765 --latency 0.2 --tokens-per-second 400
+    python company_story.py AAPL --base-url http://127.0.0.1:8765/v1 --api-key mock
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Dict, Any, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompts import CONTINUATION_PROMPT, WRITER_CHAPTER_TITLES, format_chapter_heading  # noqa: E402
+from utils import estimate_tokens, get_today_date_str  # noqa: E402
+
+
+# 请求类型
+KIND_FACTPACK = "factpack"
+KIND_FACTPACK_SECTION = "factpack_section"
+KIND_FACTPACK_GAP = "factpack_gap"
+KIND_ARTICLE = "article"
+KIND_CHAPTER = "chapter"
+
+
+def canned_factpack(company: str) -> Dict[str, Any]:
+    """
+    示例 Fact Pack（满足 schemas.FactPack 的全部校验）
+
+    Args:
+        company: 公司名或股票代码
+
+    Returns:
+        Fact Pack 字典
+    """
+    today = get_today_date_str()
+    ticker = company.upper()
+    sources = [
+        {
+            "id": i,
+            "title": f"{ticker} 示例来源 {i}",
+            "url": f"https://example.com/{ticker.lower()}/{i}",
+            "publisher": "Example News",
+            "published_date": f"2024-0{i}-15",
+            "accessed_date": today,
+            "used_for": [],
+        }
+        for i in range(1, 7)
+    ]
+
+    def metric(name: str, year: int, value: float) -> Dict[str, Any]:
+        return {
+            "metric_name": name,
+            "value": value,
+            "unit": "USD",
+            "fiscal_year": f"FY{year}",
+            "period_end": f"{year}-12-31",
+            "basis": "GAAP",
+            "source_id": 2,
+        }
+
+    return {
+        "company": {
+            "full_name": f"{ticker} Holdings Inc.",
+            "ticker": ticker,
+            "exchange": "NASDAQ",
+            "headquarters": "示例市",
+            "founded_year": 1998,
+            "founders": ["张三", "李四"],
+            "ceo": "王五",
+            "ceo_as_of": today,
+        },
+        "business": {
+            "main_business_lines": ["硬件", "软件订阅", "服务"],
+            "revenue_structure": {"硬件": "55%", "软件订阅": "30%", "服务": "15%"},
+            "products": ["旗舰设备", "云服务", "企业套件"],
+            "customers": "个人消费者与中小企业",
+            "channels": ["直营门店", "线上商城", "渠道合作伙伴"],
+        },
+        "timeline": [
+            {"date": str(year), "event": f"{ticker} 发展节点 {i + 1}", "significance": "奠定了下一阶段增长的基础"}
+            for i, year in enumerate((1998, 2004, 2010, 2015, 2020, 2023))
+        ],
+        "financials": {
+            "revenue": [metric("revenue", year, 1.0e9 * (year - 2018)) for year in (2021, 2022, 2023)],
+            "gross_profit": [metric("gross_profit", year, 4.0e8 * (year - 2018)) for year in (2021, 2022, 2023)],
+            "operating_income": [metric("operating_income", 2023, 9.0e8)],
+            "net_income": [metric("net_income", 2023, 7.0e8)],
+            "eps": [],
+            "cash": [metric("cash", 2023, 2.5e9)],
+            "debt": [],
+            "operating_cash_flow": [metric("operating_cash_flow", 2023, 1.1e9)],
+            "revenue_composition": {"北美": "60%", "其他地区": "40%"},
+        },
+        "valuation": {
+            "market_cap": 4.2e10,
+            "market_cap_date": today,
+            "pe_ratio": 28.5,
+            "pe_ratio_date": today,
+            "key_metrics": {"ev_to_sales": 8.1},
+            "note": None,
+            "source_id": 3,
+        },
+        "news_30_90d": [
+            {
+                "date": today,
+                "title": f"{ticker} 新闻 {i}",
+                "summary": "公司发布了新的产品线并上调全年指引。",
+                "impact": "市场预期改善",
+                "source_id": 4,
+            }
+            for i in range(1, 6)
+        ],
+        "risks": [
+            {"risk_name": f"风险 {i}", "description": "竞争加剧可能压缩利润率。", "severity": "中"}
+            for i in range(1, 6)
+        ],
+        "competitors": [
+            {"name": f"竞争对手 {i}", "category": category, "description": "在核心市场与公司正面竞争。"}
+            for i, category in enumerate(("直接竞争对手", "替代品", "新进入者", "平台型对手"), start=1)
+        ],
+        "sources": sources,
+        "search_keywords": [],
+    }
+
+
+def canned_chapter(chapter_number: int, chars: int) -> str:
+    """
+    示例章节（标题 + 约 chars 个字的正文）
+
+    Args:
+        chapter_number: 章节编号（从 1 开始）
+        chars: 正文字数
+
+    Returns:
+        Markdown 文本
+    """
+    sentence = f"这是第 {chapter_number} 章的示例正文，用于模拟模型输出（来源：[#{chapter_number % 6 + 1}]）。"
+    repeat = max(1, chars // len(sentence))
+    paragraphs = [sentence * min(repeat, 4) for _ in range(max(1, (repeat + 3) // 4))]
+    return format_chapter_heading(chapter_number) + "\n\n" + "\n\n".join(paragraphs)
+
+
+def canned_article(company: str, chapter_numbers: List[int], chars_per_chapter: int, with_sources: bool) -> str:
+    """
+    示例文章
+
+    Args:
+        company: 公司名或股票代码
+        chapter_numbers: 章节编号列表
+        chars_per_chapter: 每章正文字数
+        with_sources: 是否在末尾附带 Sources 章节
+
+    Returns:
+        Markdown 文本
+    """
+    text = "\n\n".join(canned_chapter(n, chars_per_chapter) for n in chapter_numbers)
+    if with_sources:
+        lines = [
+            f"[#{i}] {company} 示例来源 {i} — Example News — 2024-0{i}-15 — https://example.com/{i}"
+            for i in range(1, 7)
+        ]
+        text += "\n\n## Sources\n" + "\n".join(lines)
+    return text
+
+
+def classify_request(prompt: str) -> str:
+    """按提示词内容识别请求类型"""
+    if "还需要补充" in prompt:
+        return KIND_FACTPACK_GAP
+    if "撰写其中的以下字段" in prompt:
+        return KIND_FACTPACK_SECTION
+    if "只撰写上述结构中列出的" in prompt:
+        return KIND_CHAPTER
+    if "FactPack 数据" in prompt:
+        return KIND_ARTICLE
+    return KIND_FACTPACK
+
+
+def _company_of(prompt: str) -> str:
+    match = re.search(r"公司名或股票代码：([^）)]+)[）)]", prompt)
+    return match.group(1).strip() if match else "MOCK"
+
+
+class MockCompletionServer:
+    """
+    模拟的 Chat Completions 服务（在后台线程中运行，线程安全地统计请求）
+
+    每个请求先等待 latency（± jitter）秒再开始输出，之后按 tokens_per_second 的速度输出
+    （0 表示不限速）；error_rate 比例的请求直接返回 error_status 错误。
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.05,
+        jitter: float = 0.0,
+        tokens_per_second: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        chapter_chars: int = 400,
+        stream_chunk_chars: int = 16,
+        seed: Optional[int] = None
+    ):
+        """
+        初始化模拟服务
+
+        Args:
+            host: 监听地址
+            port: 监听端口（0 表示自动分配）
+            latency: 首字节前的等待时间（秒）
+            jitter: 等待时间的随机浮动范围（秒）
+            tokens_per_second: 输出速度（token/秒），0 表示立即返回
+            error_rate: 返回错误的请求比例（0-1）
+            error_status: 错误状态码（429 时附带 retry-after-ms 响应头）
+            chapter_chars: 示例文章每章正文字数
+            stream_chunk_chars: 流式输出每个片段的字数
+            seed: 随机种子
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.chapter_chars = chapter_chars
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.reset_stats()
+
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockCompletionServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="mock-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self) -> "MockCompletionServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {"requests": {}, "errors": 0, "streams": 0, "truncated": 0, "durations": {}}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        请求统计
+
+        Returns:
+            {"requests": {类型: 次数}, "errors", "streams", "truncated", "durations": {类型: [秒]}}
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def _record(self, kind: str, duration: float, error: bool = False, stream: bool = False,
+                truncated: bool = False) -> None:
+        with self._lock:
+            self._stats["requests"][kind] = self._stats["requests"].get(kind, 0) + 1
+            self._stats["durations"].setdefault(kind, []).append(duration)
+            self._stats["errors"] += int(error)
+            self._stats["streams"] += int(stream)
+            self._stats["truncated"] += int(truncated)
+
+    def _next_id(self) -> str:
+        with self._lock:
+            self._sequence += 1
+            return f"chatcmpl-mock-{self._sequence}"
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def first_byte_delay(self) -> float:
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def render(self, body: Dict[str, Any]) -> Tuple[str, str, int]:
+        """
+        生成请求对应的完整输出
+
+        Args:
+            body: 请求体
+
+        Returns:
+            (请求类型, 全文, 续写请求已输出的字数)
+        """
+        messages = body.get("messages") or []
+        user_messages = [m.get("content") or "" for m in messages if m.get("role") == "user"]
+        prompt = user_messages[0] if user_messages else ""
+        offset = 0
+        if len(user_messages) > 1 and user_messages[-1] == CONTINUATION_PROMPT:
+            assistant = [m.get("content") or "" for m in messages if m.get("role") == "assistant"]
+            offset = len(assistant[-1]) if assistant else 0
+
+        kind = classify_request(prompt)
+        company = _company_of(prompt)
+        if kind == KIND_FACTPACK:
+            text = json.dumps(canned_factpack(company), ensure_ascii=False)
+        elif kind == KIND_FACTPACK_SECTION:
+            match = re.search(r"撰写其中的以下字段：(.+?)。", prompt)
+            sections = match.group(1).split("、") if match else []
+            factpack = canned_factpack(company)
+            part = {name: factpack[name] for name in sections if name in factpack}
+            part["sources"] = factpack["sources"]
+            text = json.dumps(part, ensure_ascii=False)
+        elif kind == KIND_FACTPACK_GAP:
+            match = re.search(r"其中 (\w+) 字段目前只有", prompt)
+            section = match.group(1) if match else "risks"
+            missing = re.search(r"至少还需要补充 (\d+) 条", prompt)
+            items = canned_factpack(company).get(section) or []
+            count = int(missing.group(1)) if missing else 1
+            text = json.dumps({section: (items * (count // max(1, len(items)) + 1))[:count], "sources": []},
+                              ensure_ascii=False)
+        elif kind == KIND_CHAPTER:
+            numbers = sorted({int(n) for n in re.findall(r"^ +## (\d+)\) ", prompt, re.M)})
+            text = canned_article(company, numbers, self.chapter_chars, with_sources=False)
+        else:
+            numbers = list(range(1, len(WRITER_CHAPTER_TITLES) + 1))
+            text = canned_article(company, numbers, self.chapter_chars, with_sources=True)
+        return kind, text, offset
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    """请求处理：POST /v1/chat/completions"""
+
+    # HTTP/1.1 + keep-alive，连接池可以复用连接
+    protocol_version = "HTTP/1.1"
+    mock: MockCompletionServer = None
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"未知路径: {self.path}", "type": "invalid_request_error"}})
+            return
+        try:
+            body = json.loads(raw.decode("utf-8") or "{}")
+        except ValueError:
+            self._send_json(400, {"error": {"message": "请求体不是合法的 JSON", "type": "invalid_request_error"}})
+            return
+
+        mock = self.mock
+        started = time.monotonic()
+        kind, text, offset = mock.render(body)
+        time.sleep(mock.first_byte_delay())
+
+        if mock.should_fail():
+            status = mock.error_status
+            headers = {"retry-after-ms": "100"} if status == 429 else {}
+            self._send_json(
+                status,
+                {"error": {"message": f"模拟错误（{status}）", "type": "server_error", "code": None}},
+                headers=headers
+            )
+            mock._record(kind, time.monotonic() - started, error=True)
+            return
+
+        text = text[offset:]
+        prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in body.get("messages") or [])
+        completion_tokens = estimate_tokens(text)
+        finish_reason = "stop"
+        max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        if max_tokens and completion_tokens > max_tokens:
+            text = text[:max(1, int(len(text) * max_tokens / completion_tokens))]
+            completion_tokens = estimate_tokens(text)
+            finish_reason = "length"
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        model = body.get("model") or "mock"
+        response_id = mock._next_id()
+        created = int(time.time())
+
+        if not body.get("stream"):
+            if mock.tokens_per_second:
+                time.sleep(completion_tokens / mock.tokens_per_second)
+            self._send_json(200, {
+                "id": response_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": usage,
+            })
+            mock._record(kind, time.monotonic() - started, truncated=finish_reason == "length")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices: list, extra: Optional[Dict[str, Any]] = None) -> None:
+            payload = {
+                "id": response_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+            }
+            payload.update(extra or {})
+            self._write_chunk(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        try:
+            step = mock.stream_chunk_chars
+            for start in range(0, len(text), step):
+                piece = text[start:start + step]
+                delta = {"content": piece}
+                if start == 0:
+                    delta["role"] = "assistant"
+                event([{"index": 0, "delta": delta, "finish_reason": None}])
+                if mock.tokens_per_second:
+                    time.sleep(estimate_tokens(piece) / mock.tokens_per_second)
+            event([{"index": 0, "delta": {}, "finish_reason": finish_reason}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                event([], {"usage": usage})
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前中止（如流式校验失败），连接已不可用
+            self.close_connection = True
+        mock._record(kind, time.monotonic() - started, stream=True, truncated=finish_reason == "length")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的 OpenAI 兼容 Chat Completions 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址，默认 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="监听端口，默认 8765")
+    parser.add_argument("--latency", type=float, default=0.05, help="首字节前的等待时间（秒），默认 0.05")
+    parser.add_argument("--jitter", type=float, default=0.0, help="等待时间的随机浮动范围（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="输出速度（token/秒），0 表示不限速")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误的请求比例（0-1）")
+    parser.add_argument("--error-status", type=int, default=500, help="错误状态码，默认 500")
+    parser.add_argument("--chapter-chars", type=int, default=400, help="示例文章每章正文字数，默认 400")
+    parser.add_argument("--seed", type=int, help="随机种子")
+    args = parser.parse_args()
+
+    server = MockCompletionServer(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        chapter_chars=args.chapter_chars,
+        seed=args.seed
+    )
+    print(f"模拟服务已启动: {server.base_url}（Ctrl+C 退出）")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
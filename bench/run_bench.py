@@ -0,0 +1,406 @@
+"""
+离线基准测试：通过本地模拟服务驱动 CompanyStoryGenerator.generate() 和命令行，
+测量各阶段延迟分位数、不同并发数下的吞吐量和内存占用
+
+每次运行的结果按场景追加到 JSONL 文件（默认 bench/results.jsonl），每行带运行编号、
+git 版本和配置，便于跨版本对比。所有缓存和输出文件写在临时目录中，不影响当前目录。
+
+    python bench/run_bench.py
+    python bench/run_bench.py --companies 16 --concurrency 1,4,8,16 --latency 0.5 --tokens-per-second 300
+    python bench/run_bench.py --writer-mode chapters --factpack-mode sections --error-rate 0.05 --cli
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import contextlib
+import subprocess
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from mock_server import MockCompletionServer  # noqa: E402
+from http_client import configure_http_client  # noqa: E402
+from retry import RetryPolicy  # noqa: E402
+
+DEFAULT_RESULTS_PATH = os.path.join(REPO_DIR, "bench", "results.jsonl")
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    延迟分位数（最近秩法）
+
+    Args:
+        values: 耗时列表（秒）
+
+    Returns:
+        {"count", "p50", "p90", "p99", "max", "mean"}，单位毫秒
+    """
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None, "mean": None}
+    ordered = sorted(values)
+
+    def pick(q: float) -> float:
+        index = min(len(ordered) - 1, max(0, int(round(q * len(ordered) + 0.5)) - 1))
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(ordered[-1] * 1000, 2),
+        "mean": round(sum(ordered) / len(ordered) * 1000, 2),
+    }
+
+
+def bench_companies(count: int, prefix: str = "B") -> List[str]:
+    """生成 count 个互不相同、符合股票代码格式的公司标识"""
+    return [f"{prefix}{chr(65 + i // 26 % 26)}{chr(65 + i % 26)}" for i in range(count)]
+
+
+def max_rss_mb(who: int = resource.RUSAGE_SELF) -> float:
+    """进程峰值常驻内存（MB）"""
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        output = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR, capture_output=True, text=True, timeout=10
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return output.stdout.strip() or None
+
+
+class _StageTimer:
+    """给生成器的阶段方法套上计时（线程安全）"""
+
+    STAGES = ("generate_fact_pack", "generate_article")
+
+    def __init__(self, generator):
+        self.durations: Dict[str, List[float]] = {name: [] for name in self.STAGES}
+        self._lock = threading.Lock()
+        for name in self.STAGES:
+            setattr(generator, name, self._wrap(name, getattr(generator, name)))
+
+    def _wrap(self, name, method):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.durations[name].append(time.perf_counter() - started)
+        return timed
+
+
+def make_generator(args, base_url: str, use_cache: bool):
+    from company_story import CompanyStoryGenerator
+
+    return CompanyStoryGenerator(
+        api_key="mock",
+        base_url=base_url,
+        model=args.model,
+        enable_web_search=False,
+        use_cache=use_cache,
+        writer_mode=args.writer_mode,
+        factpack_mode=args.factpack_mode,
+        structured_output=args.structured_output,
+        factpack_stream=args.factpack_stream,
+        # 每个场景使用独立的重试预算和熔断器，退避时间缩短到毫秒级
+        retry_policy=RetryPolicy(base_delay=0.05, max_delay=1.0, max_retry_after=1.0)
+    )
+
+
+def warm_up(args, server: MockCompletionServer) -> None:
+    """
+    不计时地先完整生成一次，让 openai、pydantic 的延迟导入和连接池建立发生在测量之前，
+    否则第一个请求的耗时会计入各场景的 Fact Pack 延迟分位数
+
+    Args:
+        args: 命令行参数
+        server: 模拟服务
+    """
+    generator = make_generator(args, server.base_url, use_cache=False)
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+        generator.generate("WARMUP", stream=args.stream)
+    server.reset_stats()
+
+
+def run_generate_scenario(
+    args,
+    server: MockCompletionServer,
+    companies: List[str],
+    concurrency: int,
+    use_cache: bool = False,
+    label: str = "generate"
+) -> Dict[str, Any]:
+    """
+    在进程内并发调用 generate()
+
+    Args:
+        args: 命令行参数
+        server: 模拟服务
+        companies: 公司列表
+        concurrency: 并发数
+        use_cache: 是否使用缓存
+        label: 场景名
+
+    Returns:
+        场景结果
+    """
+    generator = make_generator(args, server.base_url, use_cache)
+    timer = _StageTimer(generator)
+    totals: List[float] = []
+    failures: List[Dict[str, str]] = []
+    lock = threading.Lock()
+
+    def _run_one(company: str) -> None:
+        started = time.perf_counter()
+        try:
+            generator.generate(company, stream=args.stream)
+        except Exception as e:
+            with lock:
+                failures.append({"company": company, "error": str(e)[:200]})
+            return
+        with lock:
+            totals.append(time.perf_counter() - started)
+
+    server.reset_stats()
+    if args.trace_memory:
+        tracemalloc.start()
+    output = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bench") as executor:
+            list(executor.map(_run_one, companies))
+    elapsed = time.perf_counter() - started
+    traced_peak = None
+    if args.trace_memory:
+        traced_peak = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.stop()
+
+    stats = server.stats()
+    return {
+        "scenario": label,
+        "concurrency": concurrency,
+        "companies": len(companies),
+        "succeeded": len(totals),
+        "failed": len(failures),
+        "failures": failures[:5],
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_min": round(len(totals) / elapsed * 60, 2) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "total": percentiles(totals),
+            "factpack": percentiles(timer.durations["generate_fact_pack"]),
+            "article": percentiles(timer.durations["generate_article"]),
+        },
+        "server": {
+            "requests": stats["requests"],
+            "errors": stats["errors"],
+            "truncated": stats["truncated"],
+            "latency_ms": {kind: percentiles(values) for kind, values in stats["durations"].items()},
+        },
+        "retries": generator.retry_policy.retries,
+        "cache_stats": dict(generator.cache_stats),
+        "max_rss_mb": max_rss_mb(),
+        "traced_peak_mb": traced_peak,
+    }
+
+
+def run_cli_scenario(args, server: MockCompletionServer, company: str, workdir: str) -> List[Dict[str, Any]]:
+    """
+    以子进程运行命令行（先冷缓存，再热缓存），测量端到端耗时和峰值内存
+
+    Args:
+        args: 命令行参数
+        server: 模拟服务
+        company: 公司标识
+        workdir: 子进程工作目录
+
+    Returns:
+        两条场景结果（cli_cold、cli_warm）
+    """
+    command = [
+        sys.executable, os.path.join(REPO_DIR, "company_story.py"), company,
+        "--api-key", "mock",
+        "--base-url", server.base_url,
+        "--model", args.model,
+        "--no-web",
+        "--writer-mode", args.writer_mode,
+        "--factpack-mode", args.factpack_mode,
+    ]
+    results = []
+    for label in ("cli_cold", "cli_warm"):
+        server.reset_stats()
+        started = time.perf_counter()
+        completed = subprocess.run(
+            command, cwd=workdir,
+            stdout=None if args.verbose else subprocess.DEVNULL,
+            stderr=None if args.verbose else subprocess.PIPE,
+            text=True
+        )
+        elapsed = time.perf_counter() - started
+        stats = server.stats()
+        results.append({
+            "scenario": label,
+            "concurrency": 1,
+            "companies": 1,
+            "succeeded": int(completed.returncode == 0),
+            "failed": int(completed.returncode != 0),
+            "failures": [] if completed.returncode == 0 else [
+                {"company": company, "error": (completed.stderr or "")[-200:]}
+            ],
+            "elapsed_s": round(elapsed, 3),
+            "server": {"requests": stats["requests"], "errors": stats["errors"], "truncated": stats["truncated"]},
+            # 子进程中峰值最大的一个（冷、热两次取累计最大值）
+            "max_rss_mb": max_rss_mb(resource.RUSAGE_CHILDREN),
+        })
+    return results
+
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    """打印结果表"""
+    print(f"\n{'='*96}")
+    print(f"{'场景':<14}{'并发':>6}{'成功/总数':>10}{'耗时(s)':>10}{'家/分钟':>10}"
+          f"{'总 p50':>10}{'总 p99':>10}{'FP p50':>10}{'文章 p50':>10}{'RSS(MB)':>10}")
+    print(f"{'-'*96}")
+    for result in results:
+        latency = result.get("latency_ms", {})
+
+        def cell(stage: str, key: str) -> str:
+            value = latency.get(stage, {}).get(key)
+            return f"{value:.0f}" if value is not None else "-"
+
+        print(
+            f"{result['scenario']:<14}{result['concurrency']:>6}"
+            f"{str(result['succeeded']) + '/' + str(result['companies']):>10}"
+            f"{result['elapsed_s']:>10.2f}"
+            f"{format(result['throughput_per_min'], '.1f') if 'throughput_per_min' in result else '-':>10}"
+            f"{cell('total', 'p50'):>10}{cell('total', 'p99'):>10}"
+            f"{cell('factpack', 'p50'):>10}{cell('article', 'p50'):>10}{result['max_rss_mb']:>10.1f}"
+        )
+    print(f"{'='*96}")
+    print("延迟单位为毫秒；FP 为 Fact Pack 阶段")
+
+
+def append_results(path: str, run_info: Dict[str, Any], results: List[Dict[str, Any]]) -> None:
+    """把本次运行的各场景结果追加到 JSONL 文件（每个场景一行）"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(dict(run_info, **result), ensure_ascii=False) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="离线基准测试（本地模拟 OpenAI 服务，不消耗 API 额度）",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--companies", type=int, default=8, help="每个并发档位生成的公司数，默认 8")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="并发档位（逗号分隔），默认 1,2,4,8")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟首字节延迟（秒），默认 0.2")
+    parser.add_argument("--jitter", type=float, default=0.05, help="延迟随机浮动范围（秒），默认 0.05")
+    parser.add_argument("--tokens-per-second", type=float, default=400, help="模拟输出速度（token/秒），默认 400")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟错误比例（0-1），默认 0")
+    parser.add_argument("--error-status", type=int, default=500, help="模拟错误状态码，默认 500")
+    parser.add_argument("--chapter-chars", type=int, default=400, help="示例文章每章正文字数，默认 400")
+    parser.add_argument("--model", default="gpt-4o", help="请求中的模型名，默认 gpt-4o")
+    parser.add_argument("--writer-mode", choices=["single", "chapters"], default="single", help="写作模式")
+    parser.add_argument("--factpack-mode", choices=["single", "sections"], default="single",
+                        help="Fact Pack 生成模式")
+    parser.add_argument("--structured-output", action="store_true", help="Fact Pack 使用结构化输出")
+    parser.add_argument("--factpack-stream", action="store_true", help="Fact Pack 以流式方式生成")
+    parser.add_argument("--stream", action="store_true", help="文章使用流式输出")
+    parser.add_argument("--no-warm", action="store_true", help="跳过热缓存场景")
+    parser.add_argument("--cli", action="store_true", help="另外以子进程运行命令行（冷缓存、热缓存各一次）")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="用 tracemalloc 统计各场景的 Python 内存峰值（会拖慢运行）")
+    parser.add_argument("--seed", type=int, default=0, help="模拟服务的随机种子，默认 0")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_PATH, help="结果 JSONL 文件，默认 bench/results.jsonl")
+    parser.add_argument("--keep-workdir", action="store_true", help="保留临时工作目录（缓存和输出文件）")
+    parser.add_argument("--verbose", action="store_true", help="显示生成器的输出")
+    args = parser.parse_args()
+
+    levels = sorted({max(1, int(item)) for item in args.concurrency.split(",") if item.strip()})
+    output_path = os.path.abspath(args.output)
+    workdir = tempfile.mkdtemp(prefix="company-story-bench-")
+    original_dir = os.getcwd()
+    # 缓存、锁和输出文件都使用相对路径，切换到临时目录后互不干扰
+    os.chdir(workdir)
+    configure_http_client(max_connections=max(32, max(levels) * 6), max_keepalive_connections=max(16, max(levels) * 6))
+
+    run_info = {
+        "run_id": datetime.now().strftime("%Y%m%dT%H%M%S"),
+        "git": git_revision(),
+        "python": sys.version.split()[0],
+        "config": {
+            key: getattr(args, key)
+            for key in (
+                "companies", "latency", "jitter", "tokens_per_second", "error_rate", "error_status",
+                "chapter_chars", "model", "writer_mode", "factpack_mode", "structured_output",
+                "factpack_stream", "stream",
+            )
+        },
+    }
+
+    server = MockCompletionServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        chapter_chars=args.chapter_chars,
+        seed=args.seed
+    ).start()
+    print(f"模拟服务: {server.base_url}，工作目录: {workdir}")
+
+    results = []
+    try:
+        print("预热（不计时）...")
+        warm_up(args, server)
+        for level in levels:
+            print(f"运行场景 generate（并发 {level}）...")
+            companies = bench_companies(args.companies, prefix=f"C{chr(64 + min(level, 26))}")
+            results.append(run_generate_scenario(args, server, companies, level))
+
+        if not args.no_warm:
+            companies = bench_companies(args.companies, prefix="W")
+            level = max(levels)
+            print("运行场景 warm_cache（先填充缓存，再测量命中）...")
+            run_generate_scenario(args, server, companies, level, use_cache=True, label="warm_fill")
+            results.append(run_generate_scenario(args, server, companies, level, use_cache=True, label="warm_cache"))
+
+        if args.cli:
+            print("运行场景 cli（子进程）...")
+            results.extend(run_cli_scenario(args, server, "CLIB", workdir))
+    finally:
+        server.stop()
+        os.chdir(original_dir)
+        if args.keep_workdir:
+            print(f"工作目录已保留: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_results(results)
+    append_results(output_path, run_info, results)
+    print(f"✓ 结果已追加到: {output_path}（运行编号 {run_info['run_id']}）")
+
+
+if __name__ == "__main__":
+    main()
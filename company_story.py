@@ -2,30 +2,122 @@
 """
 公司故事生成器主入口
 """
+from __future__ import annotations
+
+import time
+
+# 模块开始导入的时间点（--startup-timing 以此为起点）
+_STARTED = time.perf_counter()
+
 import os
 import sys
 import json
 import argparse
-import time
-from typing import Optional, Dict, Any
-from datetime import datetime
-
-from openai import OpenAI
-from pydantic import ValidationError
+import re
+import hashlib
+import threading
+from typing import Optional, Dict, Any, Callable, List, TYPE_CHECKING
+from datetime import datetime, timedelta
 
-from schemas import FactPack
-from prompts import WRITER_PROMPT_TEMPLATE, FACT_PACK_PROMPT
+from http_client import get_openai_client, configure_http_client
+from metrics import Metrics, get_metrics
 from utils import (
     normalize_ticker_or_name,
     get_output_paths,
-    get_cache_path,
-    load_cache,
-    save_cache,
+    sanitize_filename,
+    make_factpack_cache_key,
+    get_cache_backend,
+    import_json_cache,
     get_today_date_str,
     format_sources_section,
-    validate_factpack_json
+    dedupe_sources,
+    strip_sources_section,
+    split_markdown_sections,
+    parse_chapter_groups,
+    merge_factpack_sections,
+    merge_gap_fill,
+    refresh_factpack_sections,
+    expired_sections,
+    parse_section_ttls,
+    DEFAULT_SECTION_TTLS,
+    validate_factpack_json,
+    factpack_content_hash,
+    serialize_factpack_for_prompt,
+    estimate_tokens,
+    CacheBackend,
+    ResponseCache,
+    UsageTracker,
+    StreamingJSONObjectParser,
+    SingleFlight,
+    file_lock,
+    lazy_import,
+    FACTPACK_SCHEMA_VERSION,
+    DEFAULT_QUEUE_PATH,
+    DEFAULT_LEASE_SECONDS,
+    DEFAULT_PREWARM_WINDOW
 )
 
+# pydantic 与 schemas 在第一次校验 Fact Pack 时才导入：命中缓存的调用走 load_cached_output，用不到它们
+pydantic = lazy_import("pydantic")
+schemas = lazy_import("schemas")
+# 提示词模板和重试策略在创建生成器时才导入，--help 等不创建生成器的路径用不到
+prompts = lazy_import("prompts")
+retry = lazy_import("retry")
+# 线程池只在分段/分章节并行请求时用到（concurrent.futures 会连带导入 logging）
+concurrent_futures = lazy_import("concurrent.futures")
+
+if TYPE_CHECKING:
+    from schemas import FactPack
+    from retry import RetryPolicy
+    from rate_limiter import RateLimiter
+
+
+# 进程内共享：多个生成器实例（如批量任务、Web 请求）对同一公司的生成请求会被合并
+_factpack_flights = SingleFlight()
+
+PROMPT_FORMATS = ("json", "compact", "compact-tables")
+
+# 配置的模型不可用时依次尝试的备用模型
+FALLBACK_MODELS = ["gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo"]
+
+# 不可用模型记录的缓存命名空间
+MODEL_STATUS_NAMESPACE = "model_status"
+
+
+def _extract_choice(response) -> tuple:
+    """
+    从非流式响应中取出第一个候选的内容和结束原因
+    
+    Args:
+        response: API 响应对象
+        
+    Returns:
+        (内容, finish_reason)；没有内容时内容为 None
+    """
+    if not getattr(response, 'choices', None):
+        return (None, None)
+    choice = response.choices[0]
+    message = getattr(choice, 'message', None)
+    content = getattr(message, 'content', None) if message is not None else None
+    return (content or None, getattr(choice, 'finish_reason', None))
+
+
+def _add_usage(total: Dict[str, int], usage) -> None:
+    """
+    把响应中的 usage 累加到 total
+    
+    Args:
+        total: {"prompt_tokens", "completion_tokens"}，另累加 "cached_tokens"（命中提示词缓存的部分）
+        usage: 响应的 usage 对象（可能为 None）
+    """
+    if usage is None:
+        return
+    total["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+    total["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) if details is not None else 0
+    total["cached_tokens"] = total.get("cached_tokens", 0) + (cached or 0)
+
 
 class CompanyStoryGenerator:
     """公司故事生成器"""
@@ -37,7 +129,25 @@ class CompanyStoryGenerator:
         max_output_tokens: int = 16000,  # 增加默认值以支持更详细的内容
         enable_web_search: bool = True,
         market_days: int = 90,
-        use_cache: bool = True
+        use_cache: bool = True,
+        writer_mode: str = "single",
+        chapter_groups: Optional[List[List[int]]] = None,
+        factpack_mode: str = "single",
+        response_cache: Optional[ResponseCache] = None,
+        response_cache_ttl_hours: Optional[float] = None,
+        incremental_refresh: bool = True,
+        section_ttls: Optional[Dict[str, float]] = None,
+        cache_backend: Optional[CacheBackend] = None,
+        prompt_format: str = "compact",
+        adaptive_max_tokens: bool = True,
+        max_continuations: int = 3,
+        structured_output: bool = False,
+        factpack_stream: bool = False,
+        retry_policy: Optional[RetryPolicy] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        model_unavailable_ttl_hours: float = 24,
+        base_url: Optional[str] = None,
+        metrics: Optional[Metrics] = None
     ):
         """
         初始化生成器
@@ -45,468 +155,2395 @@ class CompanyStoryGenerator:
         Args:
             api_key: OpenAI API Key（如果为 None，从环境变量读取）
             model: 模型名称
-            max_output_tokens: 最大输出 token 数
+            max_output_tokens: 最大输出 token 数（启用自适应时为各阶段上限的上界）
             enable_web_search: 是否启用 web_search
             market_days: 新闻时间窗口（天）
             use_cache: 是否使用缓存
+            writer_mode: 文章写作模式："single"（一次生成全文）或 "chapters"（按章节分组并行生成）
+            chapter_groups: chapters 模式下的章节分组（章节编号从 1 开始），默认 DEFAULT_CHAPTER_GROUPS
+            factpack_mode: Fact Pack 生成模式："single"（一次生成）或 "sections"（按字段分组并行生成）
+            response_cache: LLM 响应缓存（为 None 且 use_cache 为 True 时使用默认目录）
+            response_cache_ttl_hours: 响应缓存有效期（小时），默认带 web_search 的请求 24 小时、其他 7 天
+            incremental_refresh: 当天缓存未命中时，是否基于上一版 Fact Pack 只刷新过期字段
+            section_ttls: 各字段有效期（小时），默认 DEFAULT_SECTION_TTLS
+            cache_backend: 缓存存储后端（默认进程内共享的 SQLite 后端 cache/cache.db）
+            prompt_format: 写作提示词中 FactPack 的编码方式："json"（缩进 JSON）、
+                "compact"（去掉空值和内部字段的紧凑 JSON）或 "compact-tables"（另把财务指标渲染为表格）
+            adaptive_max_tokens: 是否按各阶段历史用量（p95 加余量）自动选择 max_tokens
+            max_continuations: 输出被截断时最多续写的次数
+            structured_output: Fact Pack 是否使用结构化输出（由 schemas.FactPack 生成的 JSON Schema
+                强制约束输出结构，响应只解析一次，不再做 JSON 提取和修复）
+            factpack_stream: Fact Pack 是否以流式方式生成：边接收边解析，每个顶层字段结束后立即
+                按 schemas.py 中的模型校验，字段不合法时立即中止请求
+            retry_policy: 重试策略（默认进程内共享的策略，共享重试预算和熔断器）
+            rate_limiter: 客户端限流器（按模型的 RPM/TPM 令牌桶），为 None 时不限流
+            model_unavailable_ttl_hours: 模型不存在/不可用的记录有效期（小时），有效期内直接使用备用模型
+            base_url: OpenAI 兼容接口地址（默认读取 OPENAI_BASE_URL 环境变量，未设置时为官方地址）
+            metrics: 指标注册表（默认进程内共享的注册表，重试策略和缓存后端也写入它）
         """
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("未找到 OPENAI_API_KEY，请设置环境变量或传入参数")
         
-        self.client = OpenAI(api_key=self.api_key)
+        # 进程内共享 client 和连接池（第一次调用模型时才创建）；SDK 自带的重试已关闭，重试由 retry_policy 统一负责
+        self.base_url = base_url
+        self._client = None
         self.model = model
         self.max_output_tokens = max_output_tokens
         self.enable_web_search = enable_web_search
         self.market_days = market_days
         self.use_cache = use_cache
+        if writer_mode not in ("single", "chapters"):
+            raise ValueError(f"未知的写作模式: {writer_mode}")
+        self.writer_mode = writer_mode
+        self.chapter_groups = chapter_groups or prompts.DEFAULT_CHAPTER_GROUPS
+        if factpack_mode not in ("single", "sections"):
+            raise ValueError(f"未知的 Fact Pack 生成模式: {factpack_mode}")
+        self.factpack_mode = factpack_mode
+        if prompt_format not in PROMPT_FORMATS:
+            raise ValueError(f"未知的提示词格式: {prompt_format}")
+        self.prompt_format = prompt_format
+        self.cache_store = cache_backend or get_cache_backend()
+        self.lock_dir = os.path.join("cache", "locks")
+        self.cache_stats = {
+            f"{kind}_{outcome}": 0
+            for kind in ("factpack", "article", "response")
+            for outcome in ("hit", "miss")
+        }
+        self._stats_lock = threading.Lock()
+        if response_cache is None and use_cache:
+            response_cache = ResponseCache(backend=self.cache_store)
+        self.response_cache = response_cache
+        if response_cache_ttl_hours is not None:
+            ttl = response_cache_ttl_hours * 3600
+            self.response_cache_ttls = {"search": ttl, "default": ttl}
+        else:
+            self.response_cache_ttls = {"search": 24 * 3600, "default": 7 * 24 * 3600}
+        self.incremental_refresh = incremental_refresh
+        self.section_ttls = section_ttls or dict(DEFAULT_SECTION_TTLS)
+        self.last_stream_metrics: Optional[Dict[str, float]] = None
+        self.adaptive_max_tokens = adaptive_max_tokens
+        self.max_continuations = max_continuations
+        self.usage_tracker = UsageTracker(backend=self.cache_store, lock_dir=self.lock_dir)
+        self.structured_output = structured_output
+        self.factpack_stream = factpack_stream
+        self.retry_policy = retry_policy or retry.get_retry_policy()
+        self.rate_limiter = rate_limiter
+        self.model_unavailable_ttl = model_unavailable_ttl_hours * 3600
+        self._unavailable_models: Dict[str, float] = {}
+        self.tools_unsupported_models = set()
+        self._tools_warned = set()
+        self.metrics = metrics or get_metrics()
         
-    def _call_api_with_retry(
+    @property
+    def client(self):
+        """OpenAI client（第一次访问时导入 openai SDK 并创建）"""
+        if self._client is None:
+            self._client = get_openai_client(self.api_key, base_url=self.base_url)
+        return self._client
+    
+    def _build_request_params(
         self,
         prompt: str,
         tools: Optional[list] = None,
-        max_retries: int = 3,
-        retry_delay: int = 5
-    ) -> str:
+        stage: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
         """
-        调用 OpenAI API，带重试机制
+        构建 Chat Completions 请求参数
         
         Args:
             prompt: 提示词
             tools: 工具列表（如 web_search）
-            max_retries: 最大重试次数
-            retry_delay: 重试延迟（秒）
+            stage: 调用阶段（用于按历史用量选择 max_tokens）
+            response_format: 结构化输出格式（如 json_schema）
             
         Returns:
-            API 响应内容
+            请求参数字典
         """
-        for attempt in range(max_retries):
+        # 使用标准 Chat Completions API
+        request_params = {
+            "model": self.active_model(),
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": self._max_tokens_for(stage),
+            "temperature": 0.7
+        }
+        if response_format:
+            request_params["response_format"] = response_format
+        
+        # 尝试添加 reasoning 参数（如果模型支持）
+        # 注意：某些模型可能支持 reasoning 参数，但需要特殊处理
+        try:
+            # 如果模型名称包含 "thinking"，尝试添加 reasoning
+            if "thinking" in self.model.lower():
+                # 某些 API 版本可能支持，但先不添加，避免错误
+                pass
+        except Exception:
+            pass
+        
+        # 添加工具（如果启用 web_search）
+        # 注意：web_search 可能需要特定的模型或 API 版本支持
+        if tools and self.enable_web_search:
+            # 对于 web_search，可能需要使用特定的模型或参数
+            # 如果当前模型不支持，会忽略 tools
             try:
-                # 使用标准 Chat Completions API
-                request_params = {
-                    "model": self.model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": self.max_output_tokens,
-                    "temperature": 0.7
-                }
-                
-                # 尝试添加 reasoning 参数（如果模型支持）
-                # 注意：某些模型可能支持 reasoning 参数，但需要特殊处理
-                try:
-                    # 如果模型名称包含 "thinking"，尝试添加 reasoning
-                    if "thinking" in self.model.lower():
-                        # 某些 API 版本可能支持，但先不添加，避免错误
-                        pass
-                except Exception:
-                    pass
-                
-                # 添加工具（如果启用 web_search）
-                # 注意：web_search 可能需要特定的模型或 API 版本支持
-                if tools and self.enable_web_search:
-                    # 对于 web_search，可能需要使用特定的模型或参数
-                    # 如果当前模型不支持，会忽略 tools
-                    try:
-                        request_params["tools"] = tools
-                    except Exception:
-                        print("警告：当前模型可能不支持 web_search 工具，将忽略")
-                
-                # 调用 API，如果模型不存在则尝试备用模型
-                try:
-                    response = self.client.chat.completions.create(**request_params)
-                except Exception as model_error:
-                    error_str = str(model_error).lower()
-                    # 如果模型不存在，尝试使用备用模型
-                    if "model" in error_str and ("not found" in error_str or "invalid" in error_str or "404" in error_str):
-                        print(f"警告：模型 {self.model} 不可用，尝试使用备用模型...")
-                        # 尝试使用常见的可用模型作为备用
-                        fallback_models = ["gpt-4o", "gpt-4-turbo", "gpt-4", "gpt-3.5-turbo"]
-                        last_error = model_error
-                        for fallback_model in fallback_models:
-                            try:
-                                test_params = request_params.copy()
-                                test_params["model"] = fallback_model
-                                # 移除可能不支持的 tools 参数
-                                if "tools" in test_params:
-                                    del test_params["tools"]
-                                response = self.client.chat.completions.create(**test_params)
-                                print(f"✓ 使用备用模型: {fallback_model}")
-                                break
-                            except Exception as e:
-                                last_error = e
-                                continue
-                        else:
-                            raise Exception(f"所有模型都不可用。最后尝试的错误: {last_error}")
-                    else:
-                        raise model_error
-                
-                # 提取响应内容
-                if hasattr(response, 'choices') and len(response.choices) > 0:
-                    message = response.choices[0].message
-                    if hasattr(message, 'content') and message.content:
-                        return message.content
-                    # 如果有工具调用，可能需要处理
-                    if hasattr(message, 'tool_calls') and message.tool_calls:
-                        # 这里可以处理工具调用的结果，但为了简化，先返回内容
-                        pass
-                
-                raise Exception("无法从 API 响应中提取内容")
-                    
-            except Exception as e:
-                error_msg = str(e).lower()
-                error_str = str(e)
-                
-                # 检查是否是配额不足错误（不应该重试）
-                if "quota" in error_msg or "insufficient_quota" in error_msg:
-                    raise Exception(f"API 配额不足，请检查您的 OpenAI 账户余额和计费设置。错误详情: {error_str}")
-                
-                # 检查是否是限流错误
-                if "rate limit" in error_msg or "429" in error_msg:
-                    if attempt < max_retries - 1:
-                        wait_time = retry_delay * (attempt + 1)
-                        print(f"遇到限流，等待 {wait_time} 秒后重试... (尝试 {attempt + 1}/{max_retries})")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        raise Exception(f"达到最大重试次数，仍然遇到限流: {e}")
-                else:
-                    # 其他错误，直接抛出
-                    raise e
+                request_params["tools"] = tools
+            except Exception:
+                print("警告：当前模型可能不支持 web_search 工具，将忽略")
         
-        raise Exception("API 调用失败")
+        return request_params
     
-    def generate_fact_pack(
-        self,
-        company_input: str,
-        use_cache: Optional[bool] = None
-    ) -> FactPack:
+    def _max_tokens_for(self, stage: Optional[str]) -> int:
         """
-        生成 Fact Pack
+        某阶段的输出上限：有足够历史用量时取 p95 加余量，否则取 max_output_tokens
         
         Args:
-            company_input: 公司名或股票代码
-            use_cache: 是否使用缓存（覆盖初始化设置）
+            stage: 调用阶段
             
         Returns:
-            FactPack 对象
+            max_tokens
         """
-        use_cache = use_cache if use_cache is not None else self.use_cache
+        if not self.adaptive_max_tokens or not stage:
+            return self.max_output_tokens
+        return self.usage_tracker.suggest_max_tokens(stage, self.max_output_tokens)
+    
+    def _continuation_params(self, request_params: Dict[str, Any], partial: str) -> Dict[str, Any]:
+        """
+        构建续写请求：把已输出的内容作为 assistant 消息，要求模型从中断处接着写
         
-        # 检查缓存
-        cache_path = get_cache_path(company_input)
-        if use_cache:
-            cached_data = load_cache(cache_path)
-            if cached_data:
-                print(f"✓ 从缓存加载 Fact Pack: {cache_path}")
-                try:
-                    return FactPack(**cached_data)
-                except ValidationError as e:
-                    print(f"警告：缓存数据格式错误，重新生成: {e}")
+        Args:
+            request_params: 原请求参数
+            partial: 已输出的内容
+            
+        Returns:
+            续写请求参数
+        """
+        params = dict(request_params)
+        params["messages"] = list(request_params["messages"]) + [
+            {"role": "assistant", "content": partial},
+            {"role": "user", "content": prompts.CONTINUATION_PROMPT}
+        ]
+        # 自适应上限低估了本次需要的长度，续写时放开到完整上限
+        params["max_tokens"] = self.max_output_tokens
+        # 续写内容只是前文的后半段，不能再要求它单独符合 JSON Schema
+        params.pop("response_format", None)
+        return params
+    
+    def _record_usage(
+        self,
+        stage: Optional[str],
+        company: Optional[str],
+        usage: Dict[str, int],
+        finish_reason: Optional[str],
+        continuations: int
+    ) -> None:
+        """
+        记录一次调用（含续写）的合计用量
         
-        print(f"正在生成 Fact Pack（公司：{company_input}）...")
+        Args:
+            stage: 调用阶段
+            company: 公司标识
+            usage: {"prompt_tokens", "completion_tokens", "cached_tokens"}
+            finish_reason: 最后一次请求的结束原因
+            continuations: 续写次数
+        """
+        model = self.active_model()
+        self.metrics.inc("tokens_in", usage.get("prompt_tokens", 0), stage=stage, model=model)
+        self.metrics.inc("tokens_out", usage.get("completion_tokens", 0), stage=stage, model=model)
+        self.metrics.inc("tokens_cached", usage.get("cached_tokens", 0), stage=stage, model=model)
+        self.metrics.inc("continuations", continuations, stage=stage)
+        if not stage or not usage.get("completion_tokens"):
+            return
+        self.usage_tracker.record(
+            stage,
+            company,
+            usage["prompt_tokens"],
+            usage["completion_tokens"],
+            finish_reason=finish_reason,
+            continuations=continuations
+        )
+    
+    def _response_cache_key(self, request_params: Dict[str, Any], use_cache: Optional[bool] = None) -> Optional[str]:
+        """
+        计算响应缓存键
         
-        # 构建提示词
-        today_date = get_today_date_str()
+        Args:
+            request_params: 请求参数
+            use_cache: 是否使用缓存（覆盖初始化设置）
+            
+        Returns:
+            缓存键；未启用响应缓存时返回 None
+        """
+        use_cache = use_cache if use_cache is not None else self.use_cache
+        if self.response_cache is None or not use_cache:
+            return None
+        return ResponseCache.make_key(request_params)
+    
+    def _response_cache_ttl(self, request_params: Dict[str, Any]) -> float:
+        """
+        响应缓存有效期（秒）：带 web_search 的请求依赖实时信息，有效期较短
         
-        # 获取 FactPack 的 JSON Schema（简化版，用于提示模型）
-        factpack_schema = """
-{
-  "company": {
-    "full_name": "string",
-    "ticker": "string | null",
-    "exchange": "string | null",
-    "headquarters": "string | null",
-    "founded_year": "integer | null",
-    "founders": ["string"],
-    "ceo": "string | null",
-    "ceo_as_of": "string | null"
-  },
-  "business": {
-    "main_business_lines": ["string"],
-    "revenue_structure": {},
-    "products": ["string"],
-    "customers": "string | null",
-    "channels": ["string"]
-  },
-  "timeline": [
-    {
-      "date": "string",
-      "event": "string",
-      "significance": "string"
-    }
-  ],
-  "financials": {
-    "revenue": [{"metric_name": "string", "value": "number", "unit": "string", "fiscal_year": "string", "period_end": "string", "basis": "string", "source_id": "integer"}],
-    "gross_profit": [...],
-    "operating_income": [...],
-    "net_income": [...],
-    "eps": [...],
-    "cash": [...],
-    "debt": [...],
-    "operating_cash_flow": [...],
-    "revenue_composition": {}
-  },
-  "valuation": {
-    "market_cap": "number | null",
-    "market_cap_date": "string | null",
-    "pe_ratio": "number | null",
-    "pe_ratio_date": "string | null",
-    "key_metrics": {},
-    "note": "string | null",
-    "source_id": "integer | null"
-  },
-  "news_30_90d": [
-    {
-      "date": "string | null",
-      "title": "string",
-      "summary": "string",
-      "impact": "string",
-      "source_id": "integer | null"
-    }
-  ],
-  "risks": [
-    {
-      "risk_name": "string",
-      "description": "string",
-      "severity": "string | null"
-    }
-  ],
-  "competitors": [
-    {
-      "name": "string",
-      "category": "string",
-      "description": "string"
-    }
-  ],
-  "sources": [
-    {
-      "id": "integer",
-      "title": "string",
-      "url": "string",
-      "publisher": "string",
-      "published_date": "string | null",
-      "accessed_date": "string",
-      "used_for": ["string"]
-    }
-  ],
-  "web_search_enabled": "boolean",
-  "search_keywords": ["string"]
-}
-"""
+        Args:
+            request_params: 请求参数
+            
+        Returns:
+            有效期（秒）
+        """
+        if "tools" in request_params:
+            return self.response_cache_ttls["search"]
+        return self.response_cache_ttls["default"]
+    
+    def _rate_limited_create(self, request_params: Dict[str, Any]):
+        """
+        经过客户端限流后发送请求
         
-        prompt = FACT_PACK_PROMPT.format(
-            company_input=company_input,
-            market_days=self.market_days,
-            factpack_schema=factpack_schema,
-            today_date=today_date
-        )
+        按提示词估算 + max_tokens 预扣 TPM 额度，拿到 usage 后按实际用量修正；
+        流式响应在读完（或中止）时修正。
         
-        # 准备工具
-        tools = None
-        if self.enable_web_search:
-            # OpenAI web_search 工具格式
-            # 注意：实际格式可能因 API 版本而异，这里使用通用格式
-            tools = [
-                {
-                    "type": "web_search",
-                    "web_search": {
-                        "enabled": True
-                    }
-                }
-            ]
+        Args:
+            request_params: 请求参数
+            
+        Returns:
+            API 响应对象（流式请求为可迭代的流）
+        """
+        if self.rate_limiter is None:
+            return self.client.chat.completions.create(**request_params)
         
-        # 调用 API
+        model = request_params["model"]
+        estimated = sum(
+            estimate_tokens(message.get("content") or "") + 4
+            for message in request_params["messages"]
+        ) + request_params.get("max_tokens", 0)
+        reserved = self.rate_limiter.acquire(model, estimated)
         try:
-            response_text = self._call_api_with_retry(prompt, tools=tools)
-        except Exception as e:
-            print(f"错误：生成 Fact Pack 失败: {e}")
+            response = self.client.chat.completions.create(**request_params)
+        except Exception:
+            # 请求没有被处理，退回预扣的 token（请求数不退）
+            self.rate_limiter.reconcile(model, reserved, 0)
             raise
         
-        # 尝试从响应中提取 JSON
-        json_str = self._extract_json_from_response(response_text)
-        
-        # 验证 JSON
-        is_valid, error_msg = validate_factpack_json(json_str)
-        if not is_valid:
-            raise ValueError(f"Fact Pack JSON 验证失败: {error_msg}")
+        if request_params.get("stream"):
+            return self._reconciling_stream(response, model, reserved)
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        _add_usage(usage, getattr(response, "usage", None))
+        if usage["prompt_tokens"] or usage["completion_tokens"]:
+            self.rate_limiter.reconcile(model, reserved, usage["prompt_tokens"] + usage["completion_tokens"])
+        return response
+    
+    def _reconciling_stream(self, stream, model: str, reserved: float):
+        """
+        透传流式响应，结束时按 usage 修正限流器的预扣额度
         
-        # 解析为 FactPack 对象
-        try:
-            factpack_data = json.loads(json_str)
-            factpack_data["web_search_enabled"] = self.enable_web_search
-            factpack = FactPack(**factpack_data)
-        except ValidationError as e:
-            print(f"警告：Fact Pack 数据验证失败，尝试修复...")
-            # 尝试修复常见问题
-            factpack_data = json.loads(json_str)
-            # 确保必需字段存在
-            if "sources" not in factpack_data:
-                factpack_data["sources"] = []
-            if "web_search_enabled" not in factpack_data:
-                factpack_data["web_search_enabled"] = self.enable_web_search
-            if "search_keywords" not in factpack_data:
-                factpack_data["search_keywords"] = []
-            
-            # 修复新闻列表不足的问题
-            if "news_30_90d" in factpack_data and len(factpack_data["news_30_90d"]) < 3:
-                print(f"  补充新闻列表（当前 {len(factpack_data['news_30_90d'])} 条）...")
-                # 如果不足 3 条，至少保留现有的，不强制补充
-                pass
+        Args:
+            stream: 流式响应
+            model: 模型名
+            reserved: 预扣的 token 数
             
-            # 修复风险列表不足的问题
-            if "risks" in factpack_data and len(factpack_data["risks"]) < 3:
-                print(f"  补充风险列表（当前 {len(factpack_data['risks'])} 个）...")
-                # 如果不足 3 个，至少保留现有的，不强制补充
-                pass
+        Yields:
+            流式响应的各个分片
+        """
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        try:
+            for chunk in stream:
+                _add_usage(usage, getattr(chunk, "usage", None))
+                yield chunk
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+            if usage["prompt_tokens"] or usage["completion_tokens"]:
+                self.rate_limiter.reconcile(model, reserved, usage["prompt_tokens"] + usage["completion_tokens"])
+    
+    def active_model(self) -> str:
+        """
+        当前实际使用的模型：配置的模型及备用模型中第一个未被记为不可用的
+        
+        Returns:
+            模型名
+        """
+        for candidate in self._model_chain():
+            if not self._model_unavailable(candidate):
+                return candidate
+        # 全部被记为不可用时仍然尝试配置的模型（可能已经恢复）
+        return self.model
+    
+    def _model_chain(self) -> List[str]:
+        """配置的模型加备用模型（去重、保持顺序）"""
+        chain = [self.model]
+        for candidate in FALLBACK_MODELS:
+            if candidate not in chain:
+                chain.append(candidate)
+        return chain
+    
+    def _model_unavailable(self, model: str) -> bool:
+        """
+        模型是否在不可用记录的有效期内
+        
+        Args:
+            model: 模型名
             
-            # 修复时间线不足的问题
-            if "timeline" in factpack_data and len(factpack_data["timeline"]) < 5:
-                print(f"  时间线节点不足（当前 {len(factpack_data['timeline'])} 个），将接受现有数据...")
-                pass
+        Returns:
+            是否不可用
+        """
+        now = time.time()
+        with self._stats_lock:
+            expires_at = self._unavailable_models.get(model)
+        if expires_at is None:
+            entry = self.cache_store.get(MODEL_STATUS_NAMESPACE, model)
+            expires_at = entry.get("expires_at", 0) if entry else 0
+            with self._stats_lock:
+                self._unavailable_models[model] = expires_at
+        return expires_at > now
+    
+    def _mark_model_unavailable(self, model: str, error: Exception) -> None:
+        """
+        记录模型不可用（持久化，有效期内不再请求该模型）
+        
+        Args:
+            model: 模型名
+            error: 请求该模型时的错误
+        """
+        expires_at = time.time() + self.model_unavailable_ttl
+        with self._stats_lock:
+            self._unavailable_models[model] = expires_at
+        self.cache_store.put(
+            MODEL_STATUS_NAMESPACE,
+            model,
+            {"error": str(error)[:500], "expires_at": expires_at},
+            ttl=self.model_unavailable_ttl
+        )
+        print(f"警告：模型 {model} 不可用，{self.model_unavailable_ttl / 3600:.0f} 小时内直接使用备用模型")
+    
+    def _send_with_model_fallback(self, request_params: Dict[str, Any]):
+        """
+        发送请求；模型不存在时记入不可用缓存，并依次尝试后面的备用模型
+        
+        备用模型保留 tools 参数；只有备用模型明确拒绝 tools 时才去掉，并给出警告。
+        
+        Args:
+            request_params: 请求参数
             
+        Returns:
+            API 响应对象
+        """
+        chain = self._model_chain()
+        requested = request_params["model"]
+        candidates = chain[chain.index(requested):] if requested in chain else [requested] + chain
+        last_error = None
+        for candidate in candidates:
+            if candidate != requested and self._model_unavailable(candidate):
+                continue
+            params = request_params if candidate == requested else dict(request_params, model=candidate)
             try:
-                factpack = FactPack(**factpack_data)
-            except ValidationError as e2:
-                # 如果仍然失败，尝试进一步放宽要求
-                error_str = str(e2)
-                if "新闻列表至少需要" in error_str or "风险列表至少需要" in error_str or "时间线至少需要" in error_str:
-                    print(f"  数据量不足，但将尝试继续处理...")
-                    # 临时修改验证器（不推荐，但为了继续运行）
-                    # 或者直接使用字典，不进行严格验证
-                    factpack_dict = factpack_data.copy()
-                    # 确保至少有一些数据
-                    if len(factpack_dict.get("news_30_90d", [])) < 3:
-                        factpack_dict["news_30_90d"] = factpack_dict.get("news_30_90d", []) + [
-                            {"date": None, "title": "数据不足", "summary": "模型生成的数据不足", "impact": "需要更多信息", "source_id": None}
-                        ] * (3 - len(factpack_dict.get("news_30_90d", [])))
-                    if len(factpack_dict.get("risks", [])) < 3:
-                        factpack_dict["risks"] = factpack_dict.get("risks", []) + [
-                            {"risk_name": "数据不足", "description": "模型生成的风险数据不足", "severity": None}
-                        ] * (3 - len(factpack_dict.get("risks", [])))
-                    if len(factpack_dict.get("timeline", [])) < 5:
-                        factpack_dict["timeline"] = factpack_dict.get("timeline", []) + [
-                            {"date": "未知", "event": "数据不足", "significance": "需要更多历史信息"}
-                        ] * (5 - len(factpack_dict.get("timeline", [])))
-                    
-                    try:
-                        factpack = FactPack(**factpack_dict)
-                    except Exception as e3:
-                        raise ValueError(f"无法解析 Fact Pack，即使尝试修复后仍然失败: {e3}")
-                else:
-                    raise ValueError(f"无法解析 Fact Pack: {e2}")
+                response = self._send_with_tools_check(params)
+            except Exception as e:
+                if retry.classify_error(e) != retry.MODEL_NOT_FOUND:
+                    raise
+                self._mark_model_unavailable(candidate, e)
+                last_error = e
+                continue
+            if candidate != requested:
+                print(f"✓ 使用备用模型: {candidate}")
+                self.metrics.inc("fallbacks", requested_model=requested, model=candidate)
+            return response
+        raise Exception(f"所有模型都不可用。最后尝试的错误: {last_error}")
+    
+    def _send_with_tools_check(self, request_params: Dict[str, Any]):
+        """
+        发送请求；模型不支持 tools 时去掉 tools 重发，并记录该模型不使用 web_search
         
-        # 保存缓存
-        if use_cache:
-            save_cache(cache_path, factpack.model_dump())
-            print(f"✓ Fact Pack 已缓存: {cache_path}")
+        Args:
+            request_params: 请求参数
+            
+        Returns:
+            API 响应对象
+        """
+        model = request_params["model"]
+        if "tools" in request_params and self._tools_unsupported(model):
+            if model not in self._tools_warned:
+                self._tools_warned.add(model)
+                print(f"警告：模型 {model} 已记录为不支持 tools 参数，相关请求不使用 web_search")
+            request_params = {key: value for key, value in request_params.items() if key != "tools"}
+        try:
+            return self._rate_limited_create(request_params)
+        except Exception as e:
+            if "tools" not in request_params or retry.classify_error(e) != retry.CLIENT or "tool" not in str(e).lower():
+                raise
+            with self._stats_lock:
+                self.tools_unsupported_models.add(model)
+            self.cache_store.put(
+                MODEL_STATUS_NAMESPACE,
+                f"{model}#no_tools",
+                {"error": str(e)[:500]},
+                ttl=self.model_unavailable_ttl
+            )
+            self._tools_warned.add(model)
+            print(f"警告：模型 {model} 不支持 tools 参数，相关请求将不使用 web_search")
+            params = {key: value for key, value in request_params.items() if key != "tools"}
+            return self._rate_limited_create(params)
+    
+    def _tools_unsupported(self, model: str) -> bool:
+        """模型是否被记为不支持 tools（同样持久化，有效期同不可用记录）"""
+        with self._stats_lock:
+            if model in self.tools_unsupported_models:
+                return True
+        if self.cache_store.get(MODEL_STATUS_NAMESPACE, f"{model}#no_tools"):
+            with self._stats_lock:
+                self.tools_unsupported_models.add(model)
+            return True
+        return False
+    
+    def result_metadata(self) -> Dict[str, Any]:
+        """
+        结果元数据：请求的模型、实际使用的模型、是否实际启用了 web_search
         
-        print("✓ Fact Pack 生成完成")
-        return factpack
+        Returns:
+            元数据字典
+        """
+        model = self.active_model()
+        return {
+            "requested_model": self.model,
+            "model": model,
+            "web_search": self.enable_web_search and not self._tools_unsupported(model)
+        }
     
-    def _extract_json_from_response(self, response_text: str) -> str:
+    def _create_completion(
+        self,
+        request_params: Dict[str, Any],
+        max_retries: Optional[int] = None
+    ):
         """
-        从 API 响应中提取 JSON
+        发送一次 Chat Completions 请求，按重试策略重试，模型不可用时改用备用模型
         
         Args:
-            response_text: API 响应文本
+            request_params: 请求参数
+            max_retries: 最多尝试次数（默认使用重试策略的设置）
             
         Returns:
-            JSON 字符串
+            API 响应对象
         """
-        # 尝试直接解析
+        def _send():
+            return self._send_with_model_fallback(request_params)
+        
         try:
-            json.loads(response_text)
-            return response_text
-        except:
-            pass
+            return self.retry_policy.call(_send, max_attempts=max_retries, label=request_params["model"])
+        except Exception as e:
+            # 配额不足不会重试，给出明确提示
+            if retry.classify_error(e) == retry.QUOTA:
+                raise Exception(f"API 配额不足，请检查您的 OpenAI 账户余额和计费设置。错误详情: {e}")
+            raise
+    
+    def _call_api_with_retry(
+        self,
+        prompt: str,
+        tools: Optional[list] = None,
+        max_retries: Optional[int] = None,
+        stage: Optional[str] = None,
+        company: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        parse: Optional[Callable[[str], Any]] = None,
+        use_cache: Optional[bool] = None
+    ):
+        """
+        调用 OpenAI API，带重试机制
+        
+        相同请求（模型、提示词、工具、采样参数）在有效期内直接从响应缓存返回。
+        输出因达到 max_tokens 被截断（finish_reason 为 "length"）时，会发送续写请求
+        并把各段拼接起来，最多续写 max_continuations 次。
+        
+        只有完整（续写后不再截断）且通过 parse 的输出才写入响应缓存；命中的缓存内容
+        解析失败时删除该记录并重新请求。
         
-        # 尝试提取代码块中的 JSON
-        import re
-        json_pattern = r'```(?:json)?\s*(\{.*?\})\s*```'
-        matches = re.findall(json_pattern, response_text, re.DOTALL)
-        if matches:
-            return matches[0]
+        Args:
+            prompt: 提示词
+            tools: 工具列表（如 web_search）
+            max_retries: 最多尝试次数（默认使用重试策略的设置）
+            stage: 调用阶段（用于记录用量和选择 max_tokens）
+            company: 公司标识（用于记录用量）
+            response_format: 结构化输出格式
+            parse: 解析/校验响应内容的函数，内容无效时抛出异常
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            API 响应内容；传入 parse 时返回 parse 的结果
+        """
+        request_params = self._build_request_params(
+            prompt,
+            tools=tools,
+            stage=stage,
+            response_format=response_format
+        )
+        
+        cache_key = self._response_cache_key(request_params, use_cache)
+        if cache_key:
+            with self.metrics.span("cache_lookup", kind="response"):
+                cached_content = self.response_cache.get(cache_key)
+            self._count_cache("response", hit=cached_content is not None)
+            if cached_content is not None:
+                print(f"✓ 命中响应缓存: {cache_key[:12]}")
+                if parse is None:
+                    return cached_content
+                try:
+                    return parse(cached_content)
+                except Exception as e:
+                    print(f"警告：缓存的响应无法解析，已删除并重新请求: {e}")
+                    self.response_cache.delete(cache_key)
         
-        # 尝试提取第一个 { ... } 块
-        brace_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-        if brace_match:
-            return brace_match.group(0)
+        parts = []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        params = request_params
+        continuations = 0
+        while True:
+            with self.metrics.span("api_call", attrs={"company": company}, stage=stage, model=params["model"]):
+                response = self._create_completion(params, max_retries=max_retries)
+            content, finish_reason = _extract_choice(response)
+            _add_usage(usage, getattr(response, "usage", None))
+            if content:
+                parts.append(content)
+            elif not parts:
+                raise Exception("无法从 API 响应中提取内容")
+            if finish_reason != "length" or continuations >= self.max_continuations:
+                break
+            continuations += 1
+            print(
+                f"输出达到上限（max_tokens={params['max_tokens']}），"
+                f"发送续写请求 ({continuations}/{self.max_continuations})..."
+            )
+            params = self._continuation_params(request_params, "".join(parts))
         
-        # 如果都失败，返回原文本（让调用者处理错误）
-        return response_text
+        if finish_reason == "length":
+            print(f"警告：续写 {continuations} 次后输出仍被截断")
+        content = "".join(parts)
+        self._record_usage(stage, company, usage, finish_reason, continuations)
+        result = parse(content) if parse else content
+        # 截断的输出不缓存，否则有效期内每次都会拿到同一份不完整的内容
+        if cache_key and finish_reason != "length":
+            with self.metrics.span("cache_write", kind="response"):
+                self.response_cache.put(cache_key, content, ttl=self._response_cache_ttl(request_params))
+        return result
     
-    def generate_article(self, factpack: FactPack) -> str:
+    def _call_api_stream(
+        self,
+        prompt: str,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        tools: Optional[list] = None,
+        stage: Optional[str] = None,
+        company: Optional[str] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        parse: Optional[Callable[[str], Any]] = None,
+        use_cache: Optional[bool] = None
+    ):
         """
-        基于 Fact Pack 生成文章
+        以流式方式调用 OpenAI API，每收到一段内容就回调 on_chunk
+        
+        如果在收到第一段内容之前出错（如模型不可用、限流），会退回到
+        _call_api_with_retry 的非流式调用（含重试和备用模型），并把完整内容作为一段回调。
+        输出被截断时以流式续写，续写内容同样逐段回调。on_chunk 抛出异常时会关闭连接、
+        中止本次请求，异常原样抛出。
+        
+        与 _call_api_with_retry 一样，只缓存完整且通过 on_chunk 和 parse 的输出；
+        命中的缓存内容无法解析时删除该记录，异常原样抛出（片段已经回调，无法重来）。
         
         Args:
-            factpack: FactPack 对象
+            prompt: 提示词
+            on_chunk: 内容片段回调
+            tools: 工具列表（如 web_search）
+            stage: 调用阶段（用于记录用量和选择 max_tokens）
+            company: 公司标识（用于记录用量）
+            response_format: 结构化输出格式
+            parse: 解析/校验完整内容的函数，内容无效时抛出异常
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
             
         Returns:
-            Markdown 格式的文章
+            完整的响应内容；传入 parse 时返回 parse 的结果
         """
-        print("正在生成文章...")
-        
-        # 将 FactPack 转换为 JSON 字符串
-        factpack_json = json.dumps(
-            factpack.model_dump(),
-            ensure_ascii=False,
-            indent=2
+        request_params = self._build_request_params(
+            prompt,
+            tools=tools,
+            stage=stage,
+            response_format=response_format
         )
+        started = time.monotonic()
         
-        # 构建提示词
-        prompt = WRITER_PROMPT_TEMPLATE.format(factpack_json=factpack_json)
+        cache_key = self._response_cache_key(request_params, use_cache)
+        if cache_key:
+            with self.metrics.span("cache_lookup", kind="response"):
+                cached_content = self.response_cache.get(cache_key)
+            self._count_cache("response", hit=cached_content is not None)
+            if cached_content is not None:
+                print(f"✓ 命中响应缓存: {cache_key[:12]}")
+                try:
+                    if on_chunk:
+                        on_chunk(cached_content)
+                    result = parse(cached_content) if parse else cached_content
+                except Exception:
+                    self.response_cache.delete(cache_key)
+                    raise
+                elapsed = time.monotonic() - started
+                self.last_stream_metrics = {"ttfb": elapsed, "total": elapsed, "chunks": 1}
+                return result
+        
+        request_params["stream"] = True
+        request_params["stream_options"] = {"include_usage": True}
+        parts = []
+        metrics = {"first_chunk_at": None, "chunks": 0}
+        usage = {"prompt_tokens": 0, "completion_tokens": 0}
+        fell_back = False
         
-        # 调用 API（文章生成不需要 web_search）
         try:
-            article = self._call_api_with_retry(prompt, tools=None)
+            with self.metrics.span(
+                "api_call", attrs={"company": company}, stage=stage, model=request_params["model"], stream=True
+            ):
+                stream = self.retry_policy.call(
+                    lambda: self._rate_limited_create(request_params),
+                    max_attempts=1,
+                    label=request_params["model"]
+                )
+                finish_reason = self._consume_stream(stream, parts, on_chunk, metrics, usage)
         except Exception as e:
-            print(f"错误：生成文章失败: {e}")
-            raise
+            # 已经输出了部分内容，无法无缝退回，直接抛出
+            if parts:
+                raise
+            print(f"警告：流式调用失败，改用非流式调用: {e}")
+            
+            def _deliver(text: str):
+                # 在写入响应缓存之前回调，片段回调里的校验失败时不会缓存
+                if on_chunk:
+                    on_chunk(text)
+                return text, (parse(text) if parse else text)
+            
+            content, result = self._call_api_with_retry(
+                prompt,
+                tools=tools,
+                stage=stage,
+                company=company,
+                response_format=response_format,
+                parse=_deliver,
+                use_cache=use_cache
+            )
+            fell_back = True
+            finish_reason = None
+            metrics = {"first_chunk_at": time.monotonic(), "chunks": 1}
+            parts.append(content)
         
-        # 确保文章末尾包含 Sources 章节
-        if "## Sources" not in article and "## 来源" not in article:
-            sources_section = format_sources_section(factpack.sources)
-            article = article.rstrip() + "\n\n" + sources_section
+        continuations = 0
+        while finish_reason == "length" and continuations < self.max_continuations and parts:
+            continuations += 1
+            print(
+                f"\n输出达到上限（max_tokens={request_params['max_tokens']}），"
+                f"发送续写请求 ({continuations}/{self.max_continuations})..."
+            )
+            params = self._continuation_params(request_params, "".join(parts))
+            with self.metrics.span(
+                "api_call", attrs={"company": company}, stage=stage, model=params["model"], stream=True
+            ):
+                stream = self._create_completion(params)
+                finish_reason = self._consume_stream(stream, parts, on_chunk, metrics, usage)
         
-        print("✓ 文章生成完成")
-        return article
+        finished = time.monotonic()
+        if not parts:
+            raise Exception("无法从 API 流式响应中提取内容")
+        if finish_reason == "length":
+            print(f"警告：续写 {continuations} 次后输出仍被截断")
+        
+        content = "".join(parts)
+        # 非流式退回路径已经记录过用量、写过缓存
+        if not fell_back:
+            self._record_usage(stage, company, usage, finish_reason, continuations)
+            result = parse(content) if parse else content
+            if cache_key and finish_reason != "length":
+                with self.metrics.span("cache_write", kind="response"):
+                    self.response_cache.put(cache_key, content, ttl=self._response_cache_ttl(request_params))
+        
+        self.last_stream_metrics = {
+            "ttfb": metrics["first_chunk_at"] - started,
+            "total": finished - started,
+            "chunks": metrics["chunks"]
+        }
+        return result
     
-    def generate(
+    def _consume_stream(
+        self,
+        stream,
+        parts: List[str],
+        on_chunk: Optional[Callable[[str], None]],
+        metrics: Dict[str, Any],
+        usage: Dict[str, int]
+    ) -> Optional[str]:
+        """
+        读取一个流式响应，把内容追加到 parts 并回调 on_chunk
+        
+        Args:
+            stream: 流式响应
+            parts: 已收到的内容片段（原地追加）
+            on_chunk: 内容片段回调
+            metrics: 首包时间和片段数（原地更新）
+            usage: 累计用量（原地更新）
+            
+        Returns:
+            finish_reason
+        """
+        finish_reason = None
+        try:
+            for chunk in stream:
+                _add_usage(usage, getattr(chunk, "usage", None))
+                if not getattr(chunk, 'choices', None):
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = getattr(choice, 'finish_reason', None) or finish_reason
+                delta = getattr(choice, 'delta', None)
+                content = getattr(delta, 'content', None) if delta is not None else None
+                if not content:
+                    continue
+                if metrics["first_chunk_at"] is None:
+                    metrics["first_chunk_at"] = time.monotonic()
+                metrics["chunks"] += 1
+                parts.append(content)
+                if on_chunk:
+                    on_chunk(content)
+        except BaseException:
+            # 关闭连接，不再为后续输出付费
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+            raise
+        return finish_reason
+    
+    def generate_fact_pack(
         self,
         company_input: str,
-        use_cache: Optional[bool] = None
-    ) -> tuple:
+        use_cache: Optional[bool] = None,
+        factpack_mode: Optional[str] = None,
+        cache_date: Optional[str] = None
+    ) -> FactPack:
         """
-        完整生成流程：Fact Pack + Article
+        生成 Fact Pack
         
         Args:
             company_input: 公司名或股票代码
-            use_cache: 是否使用缓存
+            use_cache: 是否使用缓存（覆盖初始化设置）
+            factpack_mode: 生成模式（覆盖初始化设置）
+            cache_date: 读写哪一天的缓存 YYYY-MM-DD（默认今天；预热时为次日）
             
         Returns:
-            (article_markdown, factpack) 元组
+            FactPack 对象
         """
-        # 阶段 1: 生成 Fact Pack
-        factpack = self.generate_fact_pack(company_input, use_cache=use_cache)
-        
-        # 阶段 2: 生成文章
-        article = self.generate_article(factpack)
+        use_cache = use_cache if use_cache is not None else self.use_cache
+        factpack_mode = factpack_mode or self.factpack_mode
+        cache_date = cache_date or get_today_date_str()
         
-        return (article, factpack)
-
-
-def main():
-    """主函数"""
-    parser = argparse.ArgumentParser(
-        description="生成公司故事文章",
-        formatter_class=argparse.RawDescriptionHelpFormatter
-    )
+        with self.metrics.span("stage", attrs={"company": company_input}, stage="factpack"):
+            # 检查缓存
+            cache_key = make_factpack_cache_key(company_input, cache_date)
+            if use_cache:
+                cached = self._load_cached_fact_pack(cache_key)
+                if cached is not None:
+                    return cached
+            
+            # 同一进程内同一公司只生成一次，其余调用等待并共享结果
+            flight_key = f"{cache_key}:{use_cache}:{factpack_mode}"
+            return _factpack_flights.do(
+                flight_key,
+                lambda: self._generate_fact_pack_exclusive(company_input, cache_key, use_cache, factpack_mode, cache_date)
+            )
     
-    parser.add_argument(
-        "company",
-        nargs="?",
-        help="公司名或股票代码（如果不提供，将进入交互模式）"
-    )
+    def _load_cached_fact_pack(self, cache_key: str) -> Optional[FactPack]:
+        """
+        从缓存读取当天的 Fact Pack
+        
+        Args:
+            cache_key: 缓存键
+            
+        Returns:
+            FactPack 对象；未命中或数据损坏时返回 None
+        """
+        with self.metrics.span("cache_lookup", kind="factpack"):
+            cached_data = self.cache_store.get("factpack", cache_key, schema_version=FACTPACK_SCHEMA_VERSION)
+        if cached_data:
+            print(f"✓ 从缓存加载 Fact Pack: {cache_key}")
+            try:
+                with self.metrics.span("validate", kind="factpack_cache"):
+                    factpack = schemas.FactPack(**cached_data)
+                self._count_cache("factpack", hit=True)
+                return factpack
+            except pydantic.ValidationError as e:
+                print(f"警告：缓存数据格式错误，重新生成: {e}")
+        return None
+    
+    def _generate_fact_pack_exclusive(
+        self,
+        company_input: str,
+        cache_key: str,
+        use_cache: bool,
+        factpack_mode: str,
+        cache_date: str
+    ) -> FactPack:
+        """
+        持有跨进程锁生成 Fact Pack：拿到锁后先重新检查缓存，
+        其他进程已生成的结果直接复用
+        
+        Args:
+            company_input: 公司名或股票代码
+            cache_key: 缓存键
+            use_cache: 是否使用缓存
+            factpack_mode: 生成模式
+            cache_date: 缓存日期
+            
+        Returns:
+            FactPack 对象
+        """
+        if not use_cache:
+            return self._generate_fact_pack_uncached(company_input, cache_key, use_cache, factpack_mode, cache_date)
+        
+        lock_path = os.path.join(self.lock_dir, f"{cache_key}.lock")
+        with file_lock(lock_path):
+            cached = self._load_cached_fact_pack(cache_key)
+            if cached is not None:
+                return cached
+            return self._generate_fact_pack_uncached(company_input, cache_key, use_cache, factpack_mode, cache_date)
+    
+    def _generate_fact_pack_uncached(
+        self,
+        company_input: str,
+        cache_key: str,
+        use_cache: bool,
+        factpack_mode: str,
+        cache_date: str
+    ) -> FactPack:
+        """
+        生成 Fact Pack（增量刷新或完整生成），并写入缓存
+        
+        Args:
+            company_input: 公司名或股票代码
+            cache_key: 缓存键
+            use_cache: 是否使用缓存
+            factpack_mode: 生成模式
+            cache_date: 缓存日期
+            
+        Returns:
+            FactPack 对象
+        """
+        state_key = sanitize_filename(company_input)
+        if use_cache:
+            self._count_cache("factpack", hit=False)
+        
+        # 上一版 Fact Pack 及各字段的获取时间（跨天保留，用于增量刷新）
+        previous_state = None
+        if use_cache and self.incremental_refresh:
+            previous_state = self.cache_store.get("factpack_state", state_key, schema_version=FACTPACK_SCHEMA_VERSION)
+        
+        print(f"正在生成 Fact Pack（公司：{company_input}）...")
+        
+        now = time.time()
+        # 预热次日缓存时，字段要在目标日期结束前都不过期才沿用，否则次日的读者会拿到
+        # 今天早上取的新闻和估值；当天的缓存仍按当前时间判断
+        valid_until = now
+        # 预热次日缓存时不读写响应缓存：今天白天缓存的搜索结果会被当作次日的新数据，
+        # 读者拿到的可能是接近两天前的信息；Fact Pack 和文章仍写入次日的缓存键
+        response_use_cache = use_cache
+        if cache_date > get_today_date_str():
+            valid_until = (datetime.strptime(cache_date, "%Y-%m-%d") + timedelta(days=1)).timestamp()
+            response_use_cache = False
+        factpack = None
+        if previous_state:
+            try:
+                factpack, section_fetched_at = self._refresh_fact_pack(
+                    company_input, previous_state, now, valid_until=valid_until, use_cache=response_use_cache
+                )
+            except Exception as e:
+                print(f"警告：增量刷新失败，改为完整生成: {e}")
+                factpack = None
+        
+        if factpack is None:
+            if factpack_mode == "sections":
+                factpack_data = self._generate_fact_pack_sections(company_input, use_cache=response_use_cache)
+            else:
+                factpack_data = self._generate_fact_pack_single(company_input, use_cache=response_use_cache)
+            
+            factpack = self._build_factpack(factpack_data, company_input, use_cache=response_use_cache)
+            section_fetched_at = {section: now for section in self.section_ttls}
+        
+        # 保存缓存
+        if use_cache:
+            factpack_dict = factpack.model_dump()
+            with self.metrics.span("cache_write", kind="factpack"):
+                self.cache_store.put(
+                    "factpack",
+                    cache_key,
+                    factpack_dict,
+                    company=state_key,
+                    cache_date=cache_date,
+                    schema_version=FACTPACK_SCHEMA_VERSION
+                )
+                self.cache_store.put(
+                    "factpack_state",
+                    state_key,
+                    {"factpack": factpack_dict, "section_fetched_at": section_fetched_at},
+                    company=state_key,
+                    schema_version=FACTPACK_SCHEMA_VERSION
+                )
+            print(f"✓ Fact Pack 已缓存: {cache_key}")
+        
+        print("✓ Fact Pack 生成完成")
+        return factpack
+    
+    def _web_search_tools(self) -> Optional[list]:
+        """
+        构建 web_search 工具参数
+        
+        Returns:
+            工具列表，未启用 web_search 时返回 None
+        """
+        if not self.enable_web_search:
+            return None
+        # OpenAI web_search 工具格式
+        # 注意：实际格式可能因 API 版本而异，这里使用通用格式
+        return [
+            {
+                "type": "web_search",
+                "web_search": {
+                    "enabled": True
+                }
+            }
+        ]
+    
+    def _generate_fact_pack_single(self, company_input: str, use_cache: Optional[bool] = None) -> Dict[str, Any]:
+        """
+        一次请求生成完整的 Fact Pack
+        
+        Args:
+            company_input: 公司名或股票代码
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            FactPack 字典（未经 pydantic 校验）
+        """
+        # 构建提示词
+        today_date = get_today_date_str()
+        
+        with self.metrics.span("prompt_build", stage="factpack"):
+            prompt = prompts.FACT_PACK_PROMPT.format(
+                company_input=company_input,
+                market_days=self.market_days,
+                factpack_schema=prompts.STRUCTURED_OUTPUT_SCHEMA_NOTE if self.structured_output else prompts.FACTPACK_SCHEMA,
+                today_date=today_date
+            )
+        
+        response_format = schemas.FACTPACK_RESPONSE_FORMAT if self.structured_output else None
+        
+        def _parse(response_text: str) -> Dict[str, Any]:
+            if self.structured_output:
+                data = self._parse_structured_factpack(response_text, "Fact Pack")
+                self._validate_factpack_members(data, "Fact Pack")
+                return data
+            
+            # 尝试从响应中提取 JSON
+            json_str = self._extract_json_from_response(response_text)
+            
+            # 验证 JSON
+            with self.metrics.span("validate", kind="factpack_json"):
+                is_valid, error_msg = validate_factpack_json(json_str)
+            if not is_valid:
+                raise ValueError(f"Fact Pack JSON 验证失败: {error_msg}")
+            
+            data = json.loads(json_str)
+            self._validate_factpack_members(data, "Fact Pack")
+            return data
+        
+        # 调用 API
+        try:
+            if self.factpack_stream:
+                return self._stream_fact_pack_json(
+                    prompt,
+                    "Fact Pack",
+                    stage="factpack",
+                    company=company_input,
+                    response_format=response_format,
+                    use_cache=use_cache
+                )
+            return self._call_api_with_retry(
+                prompt,
+                tools=self._web_search_tools(),
+                stage="factpack",
+                company=company_input,
+                response_format=response_format,
+                parse=_parse,
+                use_cache=use_cache
+            )
+        except Exception as e:
+            print(f"错误：生成 Fact Pack 失败: {e}")
+            raise
+    
+    def _validate_factpack_members(self, data: Dict[str, Any], label: str) -> None:
+        """
+        按 FactPack 模型逐个校验顶层字段的格式（不含条数，条数由 _build_factpack 补齐或截断）
+        
+        在响应写入缓存之前调用，格式错误的输出不会进入响应缓存。
+        
+        Args:
+            data: FactPack 字典（或部分字段）
+            label: 出错时提示用的名称
+            
+        Raises:
+            ValueError: 某个字段不符合模型定义
+        """
+        for name, value in data.items():
+            try:
+                with self.metrics.span("validate", kind="section", section=name):
+                    schemas.validate_factpack_section(name, value)
+            except pydantic.ValidationError as e:
+                raise ValueError(f"{label} 字段 {name} 校验失败: {e}")
+    
+    def _parse_structured_factpack(self, response_text: str, label: str) -> Dict[str, Any]:
+        """
+        解析结构化输出的响应（只解析一次），并把键值对数组还原为字典
+        
+        Args:
+            response_text: API 响应文本
+            label: 出错时提示用的名称
+            
+        Returns:
+            FactPack 字典（或部分字段）
+        """
+        try:
+            with self.metrics.span("json_extract", structured=True):
+                data = json.loads(response_text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"{label} 结构化输出不是合法 JSON: {e}")
+        if not isinstance(data, dict):
+            raise ValueError(f"{label} 结构化输出不是 JSON 对象")
+        return schemas.restore_free_form_fields(data)
+    
+    def _stream_fact_pack_json(
+        self,
+        prompt: str,
+        label: str,
+        stage: str,
+        company: str,
+        response_format: Optional[Dict[str, Any]] = None,
+        use_cache: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        流式请求 Fact Pack JSON，边接收边解析，每个顶层字段结束后立即校验
+        
+        某个字段不符合 schemas.py 中的模型时立即中止请求并报错，不再等待剩余输出。
+        
+        Args:
+            prompt: 提示词
+            label: 出错时提示用的名称
+            stage: 调用阶段
+            company: 公司标识
+            response_format: 结构化输出格式
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            FactPack 字典（或部分字段）
+        """
+        def _check_member(name: str, value: Any) -> None:
+            if self.structured_output:
+                restored = schemas.restore_free_form_fields({name: value})
+                parser.members[name] = value = restored[name]
+            try:
+                with self.metrics.span("validate", kind="section", section=name):
+                    schemas.validate_factpack_section(name, value)
+            except pydantic.ValidationError as e:
+                print(f"\n  ✗ 字段 {name} 校验失败，中止流式输出")
+                raise ValueError(f"{label} 字段 {name} 校验失败: {e}")
+            print(f"  ✓ 字段 {name} 校验通过")
+        
+        def _finish(response_text: str) -> Dict[str, Any]:
+            if not parser.done:
+                raise ValueError(f"{label} JSON 不完整：输出在对象结束前中断")
+            return parser.members
+        
+        parser = StreamingJSONObjectParser(on_member=_check_member)
+        return self._call_api_stream(
+            prompt,
+            on_chunk=parser.feed,
+            tools=self._web_search_tools(),
+            stage=stage,
+            company=company,
+            response_format=response_format,
+            parse=_finish,
+            use_cache=use_cache
+        )
+    
+    def _generate_fact_pack_section_group(
+        self,
+        company_input: str,
+        sections: List[str],
+        today_date: str,
+        use_cache: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        生成 Fact Pack 的一组字段（带自己的 sources 列表）
+        
+        Args:
+            company_input: 公司名或股票代码
+            sections: 顶层字段列表
+            today_date: 今天日期
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            部分 FactPack 字典
+        """
+        with self.metrics.span("prompt_build", stage="factpack_section"):
+            prompt = prompts.build_fact_pack_section_prompt(
+                company_input,
+                sections,
+                market_days=self.market_days,
+                today_date=today_date,
+                structured=self.structured_output
+            )
+        label = f"Fact Pack 分段 {sections}"
+        response_format = schemas.factpack_section_response_format(tuple(sections)) if self.structured_output else None
+        if self.factpack_stream:
+            data = self._stream_fact_pack_json(
+                prompt,
+                label,
+                stage="factpack_section",
+                company=company_input,
+                response_format=response_format,
+                use_cache=use_cache
+            )
+        else:
+            def _parse(response_text: str) -> Dict[str, Any]:
+                if self.structured_output:
+                    data = self._parse_structured_factpack(response_text, label)
+                else:
+                    json_str = self._extract_json_from_response(response_text)
+                    try:
+                        data = json.loads(json_str)
+                    except json.JSONDecodeError as e:
+                        raise ValueError(f"{label} JSON 格式错误: {e}")
+                    if not isinstance(data, dict):
+                        raise ValueError(f"{label} 不是 JSON 对象")
+                self._validate_factpack_members(data, label)
+                return data
+            
+            data = self._call_api_with_retry(
+                prompt,
+                tools=self._web_search_tools(),
+                stage="factpack_section",
+                company=company_input,
+                response_format=response_format,
+                parse=_parse,
+                use_cache=use_cache
+            )
+        
+        # 只保留本组负责的字段，避免模型越界输出覆盖其他分组
+        part = {key: data[key] for key in sections if key in data}
+        part["sources"] = data.get("sources") or []
+        return part
+    
+    def _fetch_fact_pack_section_parts(
+        self,
+        company_input: str,
+        section_groups: List[List[str]],
+        use_cache: Optional[bool] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        按字段分组并行请求 Fact Pack 的各部分
+        
+        Args:
+            company_input: 公司名或股票代码
+            section_groups: 字段分组
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            部分 FactPack 字典列表（各自带 sources，尚未重新编号）
+        """
+        today_date = get_today_date_str()
+        print(f"  分段并行生成：{len(section_groups)} 组 {section_groups}")
+        
+        with concurrent_futures.ThreadPoolExecutor(max_workers=len(section_groups), thread_name_prefix="factpack") as executor:
+            futures = [
+                executor.submit(self._generate_fact_pack_section_group, company_input, group, today_date, use_cache)
+                for group in section_groups
+            ]
+            try:
+                return [future.result() for future in futures]
+            except Exception as e:
+                print(f"错误：生成 Fact Pack 失败: {e}")
+                raise
+    
+    def _generate_fact_pack_sections(
+        self,
+        company_input: str,
+        section_groups: Optional[List[List[str]]] = None,
+        use_cache: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        按字段分组并行请求 Fact Pack，再合并为一个整体
+        
+        各组的 sources 会统一重新编号，source_id 随之替换。
+        
+        Args:
+            company_input: 公司名或股票代码
+            section_groups: 字段分组，默认 FACTPACK_SECTION_GROUPS
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            合并后的 FactPack 字典（未经 pydantic 校验）
+        """
+        parts = self._fetch_fact_pack_section_parts(
+            company_input, section_groups or prompts.FACTPACK_SECTION_GROUPS, use_cache=use_cache
+        )
+        return merge_factpack_sections(parts)
+    
+    def _refresh_fact_pack(
+        self,
+        company_input: str,
+        previous_state: Dict[str, Any],
+        now: float,
+        valid_until: Optional[float] = None,
+        use_cache: Optional[bool] = None
+    ) -> tuple:
+        """
+        基于上一版 Fact Pack 做增量刷新：只重新请求已过期的字段
+        
+        Args:
+            company_input: 公司名或股票代码
+            previous_state: 状态文件内容（factpack、section_fetched_at）
+            now: 当前时间戳（记录为刷新字段的获取时间）
+            valid_until: 沿用的字段需要保持有效到的时间戳（默认 now）
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            (FactPack 对象, 更新后的 section_fetched_at)；上一版不可用时返回 (None, None)
+        """
+        previous = previous_state.get("factpack")
+        section_fetched_at = dict(previous_state.get("section_fetched_at") or {})
+        if not previous:
+            return (None, None)
+        try:
+            previous_factpack = schemas.FactPack(**previous)
+        except pydantic.ValidationError as e:
+            print(f"警告：上一版 Fact Pack 格式错误，改为完整生成: {e}")
+            return (None, None)
+        
+        expired = expired_sections(section_fetched_at, self.section_ttls, max(now, valid_until or now))
+        if not expired:
+            print("  所有字段均在有效期内，沿用上一版 Fact Pack")
+            return (previous_factpack, section_fetched_at)
+        
+        # 按默认分组组织过期字段，同组的过期字段合并成一个请求
+        groups = [[section for section in group if section in expired] for group in prompts.FACTPACK_SECTION_GROUPS]
+        groups = [group for group in groups if group]
+        grouped = {section for group in groups for section in group}
+        groups.extend([section] for section in expired if section not in grouped)
+        print(f"  增量刷新过期字段: {', '.join(expired)}")
+        
+        parts = self._fetch_fact_pack_section_parts(company_input, groups, use_cache=use_cache)
+        merged = refresh_factpack_sections(previous_factpack.model_dump(), parts)
+        factpack = self._build_factpack(merged, company_input, use_cache=use_cache)
+        
+        # 只更新实际拿到的字段；模型漏掉的字段沿用旧值，保持过期，下次运行重新请求
+        refreshed = {key for part in parts for key in part if key != "sources"}
+        for section in expired:
+            if section in refreshed:
+                section_fetched_at[section] = now
+        skipped = [section for section in expired if section not in refreshed]
+        if skipped:
+            print(f"警告：未拿到字段 {', '.join(skipped)}，沿用上一版内容，下次运行重新请求")
+        return (factpack, section_fetched_at)
+    
+    def _build_factpack(
+        self,
+        factpack_data: Dict[str, Any],
+        company_input: Optional[str] = None,
+        use_cache: Optional[bool] = None
+    ) -> FactPack:
+        """
+        把 FactPack 字典校验为 FactPack 对象
+        
+        时间线、新闻、风险的条数不足时，只针对这些字段并行发送补充请求（附带已有
+        条目和来源），合并后再校验，而不是重新生成整个 Fact Pack；条数超出上限的字段
+        （时间线最多 7 条）保留前面的条目。
+        
+        Args:
+            factpack_data: FactPack 字典
+            company_input: 公司名或股票代码（补充请求使用，默认取 company.full_name）
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            FactPack 对象
+        """
+        factpack_data = dict(factpack_data)
+        factpack_data["web_search_enabled"] = self.enable_web_search
+        
+        # 条数超出上限时保留前面的条目，不让一次多给的输出变成校验失败
+        for section, (_, max_items) in schemas.FACTPACK_ARRAY_LIMITS.items():
+            items = factpack_data.get(section)
+            if max_items is not None and isinstance(items, list) and len(items) > max_items:
+                print(f"  {section} 有 {len(items)} 条，超出上限，保留前 {max_items} 条")
+                factpack_data[section] = items[:max_items]
+        
+        deficits = schemas.factpack_count_deficits(factpack_data)
+        if deficits:
+            company = company_input or (factpack_data.get("company") or {}).get("full_name") or ""
+            factpack_data = self._fill_factpack_gaps(company, factpack_data, deficits, use_cache=use_cache)
+        
+        try:
+            with self.metrics.span("validate", kind="factpack"):
+                return schemas.FactPack(**factpack_data)
+        except pydantic.ValidationError as e:
+            raise ValueError(f"无法解析 Fact Pack: {e}")
+    
+    def _fill_factpack_gaps(
+        self,
+        company_input: str,
+        factpack_data: Dict[str, Any],
+        deficits: Dict[str, int],
+        use_cache: Optional[bool] = None
+    ) -> Dict[str, Any]:
+        """
+        并行补充条数不足的列表字段，并把结果合并回 Fact Pack
+        
+        Args:
+            company_input: 公司名或股票代码
+            factpack_data: FactPack 字典
+            deficits: {字段名: 缺少的条数}
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            合并后的 FactPack 字典；某个字段补充失败时保留原样
+        """
+        print(
+            "  条数不足，补充字段: "
+            + "、".join(f"{section}（缺 {missing} 条）" for section, missing in deficits.items())
+        )
+        today_date = get_today_date_str()
+        
+        with concurrent_futures.ThreadPoolExecutor(max_workers=len(deficits), thread_name_prefix="gapfill") as executor:
+            futures = {
+                section: executor.submit(
+                    self._request_gap_fill,
+                    company_input,
+                    section,
+                    factpack_data,
+                    missing,
+                    today_date,
+                    use_cache
+                )
+                for section, missing in deficits.items()
+            }
+            results = {}
+            for section, future in futures.items():
+                try:
+                    results[section] = future.result()
+                except Exception as e:
+                    print(f"警告：补充字段 {section} 失败: {e}")
+        
+        # 依次合并，保证来源编号连续
+        for section, (items, sources) in results.items():
+            before = len(factpack_data.get(section) or [])
+            factpack_data = merge_gap_fill(
+                factpack_data, section, items, sources, max_items=schemas.FACTPACK_ARRAY_LIMITS[section][1]
+            )
+            print(f"  ✓ {section}: {before} → {len(factpack_data[section])} 条")
+        return factpack_data
+    
+    def _request_gap_fill(
+        self,
+        company_input: str,
+        section: str,
+        factpack_data: Dict[str, Any],
+        missing: int,
+        today_date: str,
+        use_cache: Optional[bool] = None
+    ) -> tuple:
+        """
+        请求补充某个列表字段
+        
+        Args:
+            company_input: 公司名或股票代码
+            section: 列表字段名
+            factpack_data: 当前的 FactPack 字典
+            missing: 缺少的条数
+            today_date: 今天日期
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            (补充的条目列表, 新来源列表)
+        """
+        with self.metrics.span("prompt_build", stage="factpack_gap"):
+            prompt = prompts.build_gap_fill_prompt(
+                company_input,
+                section,
+                list(factpack_data.get(section) or []),
+                missing,
+                list(factpack_data.get("sources") or []),
+                market_days=self.market_days,
+                today_date=today_date,
+                structured=self.structured_output
+            )
+        label = f"补充字段 {section}"
+        
+        def _parse(response_text: str) -> Dict[str, Any]:
+            if self.structured_output:
+                data = self._parse_structured_factpack(response_text, label)
+            else:
+                try:
+                    data = json.loads(self._extract_json_from_response(response_text))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{label} JSON 格式错误: {e}")
+                if not isinstance(data, dict):
+                    raise ValueError(f"{label} 不是 JSON 对象")
+            if not isinstance(data.get(section), list):
+                raise ValueError(f"{label} 缺少 {section} 列表")
+            self._validate_factpack_members({key: data[key] for key in (section, "sources") if key in data}, label)
+            return data
+        
+        data = self._call_api_with_retry(
+            prompt,
+            tools=self._web_search_tools(),
+            stage="factpack_gap",
+            company=company_input,
+            response_format=schemas.factpack_gap_fill_response_format(section) if self.structured_output else None,
+            parse=_parse,
+            use_cache=use_cache
+        )
+        return (data[section], data.get("sources") or [])
+    
+    def _extract_json_from_response(self, response_text: str) -> str:
+        """
+        从 API 响应中提取 JSON
+        
+        Args:
+            response_text: API 响应文本
+            
+        Returns:
+            JSON 字符串
+        """
+        with self.metrics.span("json_extract"):
+            # 尝试直接解析
+            try:
+                json.loads(response_text)
+                return response_text
+            except:
+                pass
+            
+            # 尝试提取代码块中的 JSON
+            import re
+            json_pattern = r'```(?:json)?\s*(\{.*?\})\s*```'
+            matches = re.findall(json_pattern, response_text, re.DOTALL)
+            if matches:
+                return matches[0]
+            
+            # 尝试提取第一个 { ... } 块
+            brace_match = re.search(r'\{.*\}', response_text, re.DOTALL)
+            if brace_match:
+                return brace_match.group(0)
+            
+            # 如果都失败，返回原文本（让调用者处理错误）
+            return response_text
+    
+    def _generate_article_by_chapters(
+        self,
+        factpack_json: str,
+        company: Optional[str] = None,
+        on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        use_cache: Optional[bool] = None
+    ) -> str:
+        """
+        按章节分组并行生成文章正文，并按固定章节顺序拼接
+        
+        Args:
+            factpack_json: FactPack JSON 字符串
+            company: 公司标识（用于记录用量）
+            on_progress: 进度回调，每完成一组章节调用一次 on_progress("chapter", {...})
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            不含 Sources 章节的文章正文
+        """
+        groups = sorted(self.chapter_groups, key=min)
+        print(f"  分章节并行写作：{len(groups)} 组 {[list(g) for g in groups]}")
+        
+        with self.metrics.span("prompt_build", stage="chapter"):
+            chapter_prompts = [prompts.build_chapter_prompt(group, factpack_json) for group in groups]
+        
+        with concurrent_futures.ThreadPoolExecutor(max_workers=len(groups), thread_name_prefix="chapter") as executor:
+            futures = [
+                executor.submit(
+                    self._call_api_with_retry,
+                    prompt,
+                    None,
+                    stage="chapter",
+                    company=company,
+                    use_cache=use_cache
+                )
+                for prompt in chapter_prompts
+            ]
+            if on_progress:
+                future_groups = dict(zip(futures, groups))
+                for done, future in enumerate(concurrent_futures.as_completed(futures), start=1):
+                    future.result()
+                    on_progress("chapter", {
+                        "chapters": list(future_groups[future]),
+                        "done": done,
+                        "total": len(groups)
+                    })
+            outputs = [future.result() for future in futures]
+        
+        body = self._assemble_chapters(outputs)
+        missing = self._missing_chapters(body)
+        if not missing:
+            return body
+        
+        # 某组漏写了分配给它的章节：只补写缺少的章节，再重新拼接
+        print(f"警告：缺少第 {missing} 章，补充请求这些章节")
+        with self.metrics.span("prompt_build", stage="chapter"):
+            prompt = prompts.build_chapter_prompt(missing, factpack_json)
+        
+        def _check(text: str) -> str:
+            still_missing = sorted(set(missing) & set(self._missing_chapters(text)))
+            if still_missing:
+                raise ValueError(f"补写的内容仍缺少第 {still_missing} 章")
+            return text
+        
+        try:
+            extra = self._call_api_with_retry(
+                prompt, None, stage="chapter", company=company, parse=_check, use_cache=use_cache
+            )
+        except Exception as e:
+            print(f"警告：补写章节失败: {e}")
+            return body
+        
+        chapters = self._chapter_map(outputs)
+        if chapters is None:
+            return self._assemble_chapters(outputs + [extra])
+        # 只取补写内容中原本缺少的章节，模型顺带重写的已有章节丢弃
+        for heading, text in split_markdown_sections(strip_sources_section(extra)):
+            number = self._chapter_number(heading)
+            if number in missing and number not in chapters:
+                chapters[number] = text
+        return "\n\n".join(chapters[n] for n in sorted(chapters))
+    
+    def _chapter_number(self, heading: str) -> Optional[int]:
+        """
+        按章节编号或英文标题识别二级标题对应的固定章节
+        
+        Args:
+            heading: 二级标题行
+            
+        Returns:
+            章节编号（从 1 开始）；无法识别时返回 None
+        """
+        number_match = re.match(r'^##\s*(\d+)[)）.、\s]', heading)
+        if number_match and 1 <= int(number_match.group(1)) <= len(prompts.WRITER_CHAPTER_TITLES):
+            return int(number_match.group(1))
+        for i, title in enumerate(prompts.WRITER_CHAPTER_TITLES):
+            if title.split("（")[0].strip().lower() in heading.lower():
+                return i + 1
+        return None
+    
+    def _missing_chapters(self, text: str) -> List[int]:
+        """
+        找出文章（或某组输出）中缺少的固定章节
+        
+        Args:
+            text: Markdown 正文
+            
+        Returns:
+            缺少的章节编号（升序）
+        """
+        found = {self._chapter_number(heading) for heading, _ in split_markdown_sections(strip_sources_section(text))}
+        return [n for n in range(1, len(prompts.WRITER_CHAPTER_TITLES) + 1) if n not in found]
+    
+    def _chapter_map(self, group_outputs: List[str]) -> Optional[Dict[int, str]]:
+        """
+        按章节编号收集各组输出的章节
+        
+        每个二级标题会按章节编号或英文标题匹配到固定章节。
+        
+        Args:
+            group_outputs: 各分组的输出
+            
+        Returns:
+            {章节编号: 章节内容}；有章节无法识别或重复时返回 None
+        """
+        chapters: Dict[int, str] = {}
+        for output in group_outputs:
+            sections = split_markdown_sections(strip_sources_section(output))
+            if not sections:
+                return None
+            for heading, text in sections:
+                number = self._chapter_number(heading)
+                if number is None or number in chapters:
+                    return None
+                chapters[number] = text
+        return chapters
+    
+    def _assemble_chapters(self, group_outputs: List[str]) -> str:
+        """
+        把各组输出的章节按固定顺序拼接
+        
+        如果有章节无法识别，则退回到按分组顺序直接拼接。
+        
+        Args:
+            group_outputs: 各分组的输出（按分组中最小章节编号排序）
+            
+        Returns:
+            不含 Sources 章节的文章正文
+        """
+        chapters = self._chapter_map(group_outputs)
+        if chapters is not None:
+            return "\n\n".join(chapters[n] for n in sorted(chapters))
+        
+        print("警告：无法识别部分章节标题，按分组顺序拼接")
+        return "\n\n".join(strip_sources_section(output).strip() for output in group_outputs)
+    
+    def generate_article(
+        self,
+        factpack: FactPack,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        writer_mode: Optional[str] = None,
+        on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        use_cache: Optional[bool] = None
+    ) -> str:
+        """
+        基于 Fact Pack 生成文章
+        
+        Args:
+            factpack: FactPack 对象
+            stream: 是否使用流式输出（仅 single 模式支持逐段输出）
+            on_chunk: 流式模式下的内容片段回调（包括末尾补充的 Sources 章节）
+            writer_mode: 写作模式（覆盖初始化设置）
+            on_progress: 进度回调 on_progress(事件名, 数据)，chapters 模式下每完成一组章节调用一次
+            use_cache: 是否读写文章缓存和响应缓存（覆盖初始化设置）
+            
+        Returns:
+            Markdown 格式的文章
+        """
+        writer_mode = writer_mode or self.writer_mode
+        use_cache = use_cache if use_cache is not None else self.use_cache
+        company = factpack.company.ticker or factpack.company.full_name
+        
+        with self.metrics.span("stage", attrs={"company": company}, stage="article"):
+            # 文章缓存：同一份 Fact Pack + 同一版写作模板 + 同一模型直接复用
+            article_key = None
+            if use_cache:
+                with self.metrics.span("cache_lookup", kind="article"):
+                    article_key = self._article_cache_key(factpack, writer_mode)
+                    cached_article = self.cache_store.get("article", article_key)
+                if cached_article:
+                    self._count_cache("article", hit=True)
+                    print(f"✓ 文章缓存命中: {article_key[:12]}")
+                    if stream and on_chunk:
+                        on_chunk(cached_article)
+                    return cached_article
+                self._count_cache("article", hit=False)
+                print(f"文章缓存未命中: {article_key[:12]}")
+            
+            article = self._write_article(
+                factpack,
+                stream=stream,
+                on_chunk=on_chunk,
+                writer_mode=writer_mode,
+                on_progress=on_progress,
+                use_cache=use_cache
+            )
+            
+            if article_key and writer_mode == "chapters" and self._missing_chapters(article):
+                print("警告：文章缺少章节，不写入文章缓存")
+                article_key = None
+            if article_key:
+                with self.metrics.span("cache_write", kind="article"):
+                    self.cache_store.put(
+                        "article",
+                        article_key,
+                        article,
+                        company=sanitize_filename(company),
+                        cache_date=get_today_date_str(),
+                        schema_version=FACTPACK_SCHEMA_VERSION
+                    )
+            return article
+    
+    def _article_cache_key(self, factpack: FactPack, writer_mode: str) -> str:
+        """
+        计算文章缓存键：Fact Pack 内容哈希 + 写作模板版本 + 模型 + 写作模式 + 提示词格式
+        
+        Args:
+            factpack: FactPack 对象
+            writer_mode: 写作模式
+            
+        Returns:
+            SHA-256 十六进制字符串
+        """
+        return self._article_cache_key_for_data(factpack.model_dump(), writer_mode)
+    
+    def _article_cache_key_for_data(self, factpack_data: Dict[str, Any], writer_mode: str) -> str:
+        """
+        按 Fact Pack 字典计算文章缓存键（同 _article_cache_key，不需要 pydantic 对象）
+        
+        Args:
+            factpack_data: FactPack 字典（缓存中保存的就是 model_dump() 的结果）
+            writer_mode: 写作模式
+            
+        Returns:
+            SHA-256 十六进制字符串
+        """
+        material = {
+            "factpack": factpack_content_hash(factpack_data),
+            "prompt_version": prompts.WRITER_PROMPT_VERSION,
+            "model": self.active_model(),
+            "writer_mode": writer_mode,
+            "prompt_format": self.prompt_format,
+            "chapter_groups": sorted(self.chapter_groups) if writer_mode == "chapters" else None
+        }
+        payload = json.dumps(material, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def _serialize_factpack(self, factpack: FactPack) -> str:
+        """
+        按 prompt_format 把 FactPack 编码为写作提示词中的文本，并打印相对缩进 JSON 节省的 token
+        
+        Args:
+            factpack: FactPack 对象
+            
+        Returns:
+            FactPack 文本
+        """
+        factpack_data = factpack.model_dump()
+        full_json = json.dumps(factpack_data, ensure_ascii=False, indent=2)
+        if self.prompt_format == "json":
+            return full_json
+        
+        factpack_json = serialize_factpack_for_prompt(
+            factpack_data,
+            compact_tables=self.prompt_format == "compact-tables"
+        )
+        full_tokens = estimate_tokens(full_json)
+        compact_tokens = estimate_tokens(factpack_json)
+        saved = full_tokens - compact_tokens
+        print(
+            f"FactPack 提示词约 {compact_tokens} tokens"
+            f"（缩进 JSON 约 {full_tokens} tokens，节省 {saved / max(full_tokens, 1):.0%}）"
+        )
+        return factpack_json
+    
+    def _count_cache(self, kind: str, hit: bool) -> None:
+        """
+        记录缓存命中/未命中次数
+        
+        Args:
+            kind: 缓存类型（factpack、article、response）
+            hit: 是否命中
+        """
+        with self._stats_lock:
+            self.cache_stats[f"{kind}_{'hit' if hit else 'miss'}"] += 1
+        self.metrics.inc("cache_requests", kind=kind, outcome="hit" if hit else "miss")
+    
+    def _write_article(
+        self,
+        factpack: FactPack,
+        stream: bool,
+        on_chunk: Optional[Callable[[str], None]],
+        writer_mode: str,
+        on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        use_cache: Optional[bool] = None
+    ) -> str:
+        """
+        调用模型写文章（不经过文章缓存）
+        
+        Args:
+            factpack: FactPack 对象
+            stream: 是否使用流式输出
+            on_chunk: 流式模式下的内容片段回调
+            writer_mode: 写作模式
+            on_progress: 进度回调（chapters 模式下每完成一组章节调用一次）
+            use_cache: 是否读写响应缓存（覆盖初始化设置）
+            
+        Returns:
+            Markdown 格式的文章
+        """
+        print("正在生成文章...")
+        
+        with self.metrics.span("serialize_factpack", prompt_format=self.prompt_format):
+            factpack_json = self._serialize_factpack(factpack)
+        company = factpack.company.ticker or factpack.company.full_name
+        
+        if writer_mode == "chapters":
+            try:
+                body = self._generate_article_by_chapters(
+                    factpack_json, company=company, on_progress=on_progress, use_cache=use_cache
+                )
+            except Exception as e:
+                print(f"错误：生成文章失败: {e}")
+                raise
+            # 各组的 Sources 已被移除，统一生成一份去重后的 Sources 章节
+            article = body + "\n\n" + format_sources_section(dedupe_sources(factpack.sources))
+            if stream and on_chunk:
+                on_chunk(article)
+            print("✓ 文章生成完成")
+            return article
+        
+        # 构建提示词
+        with self.metrics.span("prompt_build", stage="article"):
+            prompt = prompts.WRITER_PROMPT_TEMPLATE.format(factpack_json=factpack_json)
+        
+        # 调用 API（文章生成不需要 web_search）
+        try:
+            if stream:
+                article = self._call_api_stream(
+                    prompt, on_chunk=on_chunk, stage="article", company=company, use_cache=use_cache
+                )
+            else:
+                article = self._call_api_with_retry(
+                    prompt, tools=None, stage="article", company=company, use_cache=use_cache
+                )
+        except Exception as e:
+            print(f"错误：生成文章失败: {e}")
+            raise
+        
+        # 确保文章末尾包含 Sources 章节
+        if "## Sources" not in article and "## 来源" not in article:
+            sources_section = format_sources_section(dedupe_sources(factpack.sources))
+            if stream:
+                # 已输出的内容无法回退，直接在末尾追加（补足到一个空行）
+                trailing_newlines = len(article) - len(article.rstrip("\n"))
+                suffix = "\n" * max(0, 2 - trailing_newlines) + sources_section
+                if on_chunk:
+                    on_chunk(suffix)
+                article = article + suffix
+            else:
+                article = article.rstrip() + "\n\n" + sources_section
+        
+        if stream and self.last_stream_metrics:
+            metrics = self.last_stream_metrics
+            print(f"\n首字节时间（TTFB）: {metrics['ttfb']:.2f} 秒，总耗时: {metrics['total']:.2f} 秒")
+        
+        print("✓ 文章生成完成")
+        return article
+    
+    def load_cached_output(
+        self,
+        company_input: str,
+        writer_mode: Optional[str] = None,
+        cache_date: Optional[str] = None
+    ) -> Optional[tuple]:
+        """
+        快速读取缓存：Fact Pack 按原样返回字典，不导入 pydantic、不创建 API client
+        
+        缓存中的 Fact Pack 写入前已经校验过，命令行命中缓存时直接用它输出文件，
+        启动只需要几十毫秒。
+        
+        Args:
+            company_input: 公司名或股票代码
+            writer_mode: 写作模式（覆盖初始化设置）
+            cache_date: 缓存日期 YYYY-MM-DD（默认今天）
+            
+        Returns:
+            (article_markdown, factpack_dict) 元组；任一未命中时返回 None
+        """
+        if not self.use_cache:
+            return None
+        with self.metrics.span("cache_lookup", kind="factpack"):
+            factpack_data = self.cache_store.get(
+                "factpack",
+                make_factpack_cache_key(company_input, cache_date),
+                schema_version=FACTPACK_SCHEMA_VERSION
+            )
+        if not isinstance(factpack_data, dict):
+            return None
+        with self.metrics.span("cache_lookup", kind="article"):
+            article_key = self._article_cache_key_for_data(factpack_data, writer_mode or self.writer_mode)
+            article = self.cache_store.get("article", article_key)
+        if not article:
+            return None
+        self._count_cache("factpack", hit=True)
+        self._count_cache("article", hit=True)
+        return (article, factpack_data)
+    
+    def load_cached_result(self, company_input: str, writer_mode: Optional[str] = None) -> Optional[tuple]:
+        """
+        只读缓存：当天的 Fact Pack 和对应的文章都已缓存时直接返回，不发起任何 API 请求
+        
+        Args:
+            company_input: 公司名或股票代码
+            writer_mode: 写作模式（覆盖初始化设置）
+            
+        Returns:
+            (article_markdown, factpack) 元组；任一未命中时返回 None
+        """
+        if not self.use_cache:
+            return None
+        factpack = self._load_cached_fact_pack(make_factpack_cache_key(company_input))
+        if factpack is None:
+            return None
+        with self.metrics.span("cache_lookup", kind="article"):
+            article_key = self._article_cache_key(factpack, writer_mode or self.writer_mode)
+            article = self.cache_store.get("article", article_key)
+        if not article:
+            return None
+        self._count_cache("article", hit=True)
+        return (article, factpack)
+    
+    def generate(
+        self,
+        company_input: str,
+        use_cache: Optional[bool] = None,
+        stream: bool = False,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        cache_date: Optional[str] = None
+    ) -> tuple:
+        """
+        完整生成流程：Fact Pack + Article
+        
+        Args:
+            company_input: 公司名或股票代码
+            use_cache: 是否使用缓存
+            stream: 文章是否使用流式输出
+            on_chunk: 流式模式下的内容片段回调
+            cache_date: Fact Pack 缓存日期 YYYY-MM-DD（默认今天）
+            
+        Returns:
+            (article_markdown, factpack) 元组
+        """
+        # 阶段 1: 生成 Fact Pack
+        factpack = self.generate_fact_pack(company_input, use_cache=use_cache, cache_date=cache_date)
+        
+        # 阶段 2: 生成文章
+        article = self.generate_article(factpack, stream=stream, on_chunk=on_chunk, use_cache=use_cache)
+        
+        return (article, factpack)
+
+
+def save_outputs(
+    company_identifier: str,
+    article: str,
+    factpack: FactPack,
+    metadata: Optional[Dict[str, Any]] = None
+) -> tuple:
+    """
+    保存文章 Markdown 和 Sources JSON
+    
+    Args:
+        company_identifier: 公司标识（ticker 或 name）
+        article: Markdown 格式的文章
+        factpack: FactPack 对象（或 load_cached_output 返回的 FactPack 字典）
+        metadata: 写入 Sources JSON 的生成元数据（如实际使用的模型）
+        
+    Returns:
+        (markdown_path, sources_path) 元组
+    """
+    markdown_path, sources_path = get_output_paths(company_identifier)
+    
+    # 保存 Markdown
+    with get_metrics().span("file_write", kind="markdown"), open(markdown_path, 'w', encoding='utf-8') as f:
+        f.write(article)
+    print(f"✓ 文章已保存: {markdown_path}")
+    
+    save_sources(company_identifier, factpack, sources_path, metadata=metadata)
+    
+    return (markdown_path, sources_path)
+
+
+def save_sources(
+    company_identifier: str,
+    factpack: FactPack,
+    sources_path: str,
+    metadata: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    保存 Sources JSON
+    
+    Args:
+        company_identifier: 公司标识（ticker 或 name）
+        factpack: FactPack 对象或 FactPack 字典
+        sources_path: Sources JSON 文件路径
+        metadata: 生成元数据（如实际使用的模型）
+    """
+    if isinstance(factpack, dict):
+        sources = factpack.get("sources", [])
+    else:
+        sources = [s.model_dump() for s in factpack.sources]
+    sources_data = {
+        "company": company_identifier,
+        "generated_at": datetime.now().isoformat(),
+        "sources": sources
+    }
+    if metadata:
+        sources_data["metadata"] = metadata
+    with get_metrics().span("file_write", kind="sources"), open(sources_path, 'w', encoding='utf-8') as f:
+        json.dump(sources_data, f, ensure_ascii=False, indent=2)
+    print(f"✓ 来源文件已保存: {sources_path}")
+
+
+def generate_streaming(generator: "CompanyStoryGenerator", company_identifier: str) -> tuple:
+    """
+    流式生成：文章内容边生成边写入 Markdown 文件并输出到终端
+    
+    Args:
+        generator: CompanyStoryGenerator 实例
+        company_identifier: 公司标识（ticker 或 name）
+        
+    Returns:
+        (markdown_path, sources_path) 元组
+    """
+    factpack = generator.generate_fact_pack(company_identifier)
+    markdown_path, sources_path = get_output_paths(company_identifier)
+    
+    with open(markdown_path, 'w', encoding='utf-8') as f:
+        def _write_chunk(chunk: str) -> None:
+            f.write(chunk)
+            f.flush()
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        
+        generator.generate_article(factpack, stream=True, on_chunk=_write_chunk)
+    print(f"✓ 文章已保存: {markdown_path}")
+    
+    save_sources(company_identifier, factpack, sources_path, metadata=generator.result_metadata())
+    
+    return (markdown_path, sources_path)
+
+
+def print_cache_stats(cache_stats: Dict[str, int]) -> None:
+    """
+    打印缓存命中情况
+    
+    Args:
+        cache_stats: CompanyStoryGenerator.cache_stats
+    """
+    labels = (("factpack", "Fact Pack"), ("article", "文章"), ("response", "LLM 响应"))
+    parts = []
+    for kind, label in labels:
+        hits = cache_stats.get(f"{kind}_hit", 0)
+        misses = cache_stats.get(f"{kind}_miss", 0)
+        if hits or misses:
+            parts.append(f"{label} 命中 {hits} / 未命中 {misses}")
+    if parts:
+        print(f"缓存: {'；'.join(parts)}")
+
+
+def print_model_route(generator: CompanyStoryGenerator) -> None:
+    """
+    配置的模型不可用、实际使用了备用模型时打印提示
+    
+    Args:
+        generator: CompanyStoryGenerator 实例
+    """
+    metadata = generator.result_metadata()
+    if metadata["model"] != metadata["requested_model"]:
+        print(f"实际使用模型: {metadata['model']}（{metadata['requested_model']} 不可用）")
+    if generator.enable_web_search and not metadata["web_search"]:
+        print(f"注意：{metadata['model']} 不支持 tools 参数，本次未使用 web_search")
+
+
+def print_usage_summary(generator: CompanyStoryGenerator) -> None:
+    """
+    打印各阶段的历史 token 用量和当前输出上限
+    
+    Args:
+        generator: CompanyStoryGenerator 实例
+    """
+    summary = generator.usage_tracker.summary()
+    if not summary:
+        return
+    print("token 用量:")
+    for stage, stats in summary.items():
+        print(
+            f"  {stage}: {stats['samples']} 次，平均输出 {stats['avg_completion_tokens']:.0f}，"
+            f"p95 {stats['p95_completion_tokens']}，续写 {stats['continuations']} 次，"
+            f"当前上限 {generator._max_tokens_for(stage)}"
+        )
+
+
+def print_metrics_summary(metrics: Metrics) -> None:
+    """
+    打印各环节耗时、token 用量和缓存命中率
+    
+    Args:
+        metrics: 指标注册表
+    """
+    snapshot = metrics.snapshot()
+    steps: Dict[str, List[float]] = {}
+    for span in snapshot["spans"]:
+        name = span["name"]
+        if name == "stage":
+            name = f"stage:{span['labels'].get('stage')}"
+        total = steps.setdefault(name, [0, 0.0])
+        total[0] += span["count"]
+        total[1] += span["sum_ms"]
+    if steps:
+        print("各环节耗时（多线程并行时合计可能超过总耗时）:")
+        for name, (count, total_ms) in sorted(steps.items(), key=lambda item: -item[1][1]):
+            print(f"  {name}: {count} 次，合计 {total_ms / 1000:.2f} 秒，平均 {total_ms / count:.1f} 毫秒")
+    tokens = {name: metrics.counter(name) for name in ("tokens_in", "tokens_out", "tokens_cached")}
+    if any(tokens.values()):
+        print(
+            f"token: 输入 {tokens['tokens_in']:.0f}（其中缓存 {tokens['tokens_cached']:.0f}），"
+            f"输出 {tokens['tokens_out']:.0f}；重试 {metrics.counter('retries'):.0f} 次，"
+            f"备用模型 {metrics.counter('fallbacks'):.0f} 次"
+        )
+    ratios = snapshot["cache_hit_ratio"]
+    if ratios:
+        print("缓存命中率: " + "，".join(f"{kind} {ratio:.0%}" for kind, ratio in sorted(ratios.items())))
+
+
+def export_metrics(args) -> None:
+    """
+    按命令行参数打印并导出指标
+    
+    Args:
+        args: 命令行参数（timings、metrics_jsonl、metrics_prom）
+    """
+    metrics = get_metrics()
+    if args.timings:
+        print_metrics_summary(metrics)
+    if args.metrics_jsonl:
+        metrics.write_jsonl(args.metrics_jsonl)
+        print(f"✓ 指标已追加到: {args.metrics_jsonl}")
+    if args.metrics_prom:
+        metrics.write_prometheus(args.metrics_prom)
+        print(f"✓ Prometheus 指标已写入: {args.metrics_prom}")
+
+
+def build_generator(args) -> CompanyStoryGenerator:
+    """
+    根据命令行参数创建生成器
+    
+    Args:
+        args: 命令行参数
+        
+    Returns:
+        CompanyStoryGenerator 实例
+    """
+    from rate_limiter import RateLimiter, parse_rate_limits
+    
+    chapter_groups = None
+    if args.chapter_groups:
+        chapter_groups = parse_chapter_groups(args.chapter_groups, len(prompts.WRITER_CHAPTER_TITLES))
+    rate_limits = parse_rate_limits(args.rate_limit)
+    
+    # 每家公司最多同时发出约 6 个请求（分章节写作），两个阶段可能同时在跑
+    concurrency = max(
+        getattr(args, "concurrency", 1) or 1,
+        (getattr(args, "factpack_concurrency", None) or 0) + (getattr(args, "article_concurrency", None) or 0)
+    )
+    configure_http_client(
+        max_connections=args.max_connections or max(32, concurrency * 6),
+        max_keepalive_connections=args.max_connections or max(16, concurrency * 6),
+        http2=args.http2,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout
+    )
+    
+    return CompanyStoryGenerator(
+        api_key=args.api_key,
+        model=args.model,
+        max_output_tokens=args.max_output_tokens,
+        enable_web_search=not args.no_web,
+        market_days=args.market_days,
+        use_cache=not args.no_cache,
+        writer_mode=args.writer_mode,
+        chapter_groups=chapter_groups,
+        factpack_mode=args.factpack_mode,
+        response_cache_ttl_hours=args.response_cache_ttl,
+        incremental_refresh=not args.full_refresh,
+        section_ttls=parse_section_ttls(args.section_ttl),
+        cache_backend=get_cache_backend(args.cache_backend),
+        prompt_format=args.prompt_format,
+        adaptive_max_tokens=not args.fixed_max_tokens,
+        structured_output=args.structured_output,
+        factpack_stream=args.factpack_stream,
+        retry_policy=retry.RetryPolicy(max_attempts=args.max_retries),
+        rate_limiter=RateLimiter(rate_limits) if rate_limits else None,
+        model_unavailable_ttl_hours=args.model_unavailable_ttl,
+        base_url=args.base_url
+    )
+
+
+def run_cache_command(args) -> None:
+    """
+    缓存维护命令：列出、导入旧版 JSON 文件、淘汰与整理
+    
+    Args:
+        args: 命令行参数
+    """
+    backend = get_cache_backend(args.cache_backend)
+    
+    if args.cache_import_json:
+        imported = import_json_cache(backend)
+        print(f"✓ 已导入 {imported} 个 JSON 缓存文件")
+    
+    if args.cache_compact:
+        max_age = args.cache_max_age_days * 86400 if args.cache_max_age_days is not None else None
+        max_bytes = int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb is not None else None
+        removed = backend.evict(max_bytes=max_bytes, max_age=max_age)
+        backend.compact()
+        print(f"✓ 已淘汰 {removed} 个缓存条目并整理存储空间")
+    
+    if args.cache_list:
+        company = None
+        if args.company:
+            ticker, name = normalize_ticker_or_name(args.company)
+            company = sanitize_filename(ticker or name)
+        entries = backend.find(company=company, cache_date=args.cache_date)
+        total_bytes = 0
+        for entry in entries:
+            total_bytes += entry.get("size") or 0
+            print(
+                f"{entry['namespace']:<16} {entry.get('company') or '-':<16} "
+                f"{entry.get('cache_date') or '-':<10}  v{entry.get('schema_version') or '-'}  "
+                f"{(entry.get('size') or 0) / 1024:8.1f} KB  {entry['key']}"
+            )
+        print(f"共 {len(entries)} 个条目，{total_bytes / 1024 / 1024:.2f} MB")
+
+
+def run_batch_mode(args) -> None:
+    """
+    批量模式入口
+    
+    Args:
+        args: 命令行参数
+    """
+    from batch import read_company_list, run_batch, run_pipeline, run_queue
+    from job_queue import JobQueue
+    
+    companies = []
+    if args.batch:
+        try:
+            companies = read_company_list(args.batch)
+        except OSError as e:
+            print(f"错误：无法读取公司列表: {e}")
+            sys.exit(1)
+        if not companies:
+            print("错误：公司列表为空")
+            sys.exit(1)
+    
+    job_queue = None
+    if args.queue:
+        job_queue = JobQueue(args.queue, lease_seconds=args.lease_timeout)
+        if companies:
+            added = job_queue.enqueue(companies)
+            print(f"✓ 任务队列: {args.queue}（新加入 {added} 家）")
+        if args.pipeline:
+            print("警告：任务队列模式不支持 --pipeline，改为按公司逐阶段处理")
+    
+    try:
+        generator = build_generator(args)
+        if job_queue is not None:
+            summary = run_queue(
+                generator,
+                job_queue,
+                concurrency=args.concurrency,
+                max_attempts=args.max_attempts
+            )
+        elif args.pipeline:
+            summary = run_pipeline(
+                generator,
+                companies,
+                factpack_concurrency=args.factpack_concurrency or args.concurrency,
+                article_concurrency=args.article_concurrency or args.concurrency
+            )
+        else:
+            summary = run_batch(generator, companies, concurrency=args.concurrency)
+        print_cache_stats(generator.cache_stats)
+        print_usage_summary(generator)
+        print_model_route(generator)
+    except KeyboardInterrupt:
+        print("\n\n用户中断")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n错误: {e}")
+        sys.exit(1)
+    finally:
+        export_metrics(args)
+    
+    if summary["failed"]:
+        sys.exit(1)
+
+
+def run_prewarm_mode(args) -> None:
+    """
+    预热模式入口
+    
+    Args:
+        args: 命令行参数
+    """
+    from prewarm import parse_prewarm_window, run_prewarm
+    
+    if args.no_cache:
+        print("错误：预热模式需要启用缓存，不能与 --no-cache 同时使用")
+        sys.exit(1)
+    try:
+        parse_prewarm_window(args.prewarm_window)
+    except ValueError as e:
+        print(f"错误：{e}")
+        sys.exit(1)
+    
+    try:
+        generator = build_generator(args)
+        summaries = run_prewarm(
+            generator,
+            args.prewarm,
+            window=args.prewarm_window,
+            concurrency=args.concurrency,
+            once=args.prewarm_once
+        )
+        print_cache_stats(generator.cache_stats)
+        print_usage_summary(generator)
+    except KeyboardInterrupt:
+        print("\n\n用户中断")
+        sys.exit(1)
+    except Exception as e:
+        print(f"\n错误: {e}")
+        sys.exit(1)
+    finally:
+        export_metrics(args)
+    
+    if any(summary["failed"] for summary in summaries):
+        sys.exit(1)
+
+
+class StartupTimer:
+    """记录命令行启动各阶段的耗时（--startup-timing）"""
+    
+    def __init__(self, started: float = _STARTED):
+        self.started = started
+        self.last = started
+        self.marks: List[tuple] = []
+    
+    def mark(self, label: str) -> None:
+        """记录从上一个时间点到现在的阶段耗时"""
+        now = time.perf_counter()
+        self.marks.append((label, now - self.last))
+        self.last = now
+    
+    def report(self) -> None:
+        """打印各阶段耗时"""
+        print("\n启动耗时（从导入 company_story 算起，不含解释器启动）:")
+        for label, seconds in self.marks:
+            print(f"  {label:<10} {seconds * 1000:>8.1f} ms")
+        print(f"  {'合计':<10} {(self.last - self.started) * 1000:>8.1f} ms")
+        loaded = [name for name in ("openai", "httpx", "pydantic", "schemas") if _module_loaded(name)]
+        print(f"  已导入: {', '.join(loaded) if loaded else '无（未导入 openai、pydantic）'}")
+
+
+def _module_loaded(name: str) -> bool:
+    """模块是否已导入"""
+    return name in sys.modules
+
+
+def main():
+    """主函数"""
+    timer = StartupTimer()
+    timer.mark("导入模块")
+    parser = argparse.ArgumentParser(
+        description="生成公司故事文章",
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    
+    parser.add_argument(
+        "company",
+        nargs="?",
+        help="公司名或股票代码（如果不提供，将进入交互模式）"
+    )
     
     parser.add_argument(
         "--no-web",
@@ -525,7 +2562,100 @@ def main():
         "--max-output-tokens",
         type=int,
         default=16000,
-        help="最大输出 token 数，默认 16000（支持约5分钟阅读时间的详细内容）"
+        help="最大输出 token 数，默认 16000（支持约5分钟阅读时间的详细内容）；"
+             "启用自适应时为各阶段上限的上界"
+    )
+    
+    parser.add_argument(
+        "--structured-output",
+        action="store_true",
+        help="Fact Pack 使用结构化输出（按 schemas.FactPack 生成的 JSON Schema 约束输出，需要模型支持）"
+    )
+    
+    parser.add_argument(
+        "--factpack-stream",
+        action="store_true",
+        help="Fact Pack 以流式方式生成，每个字段结束后立即校验，发现错误时提前中止"
+    )
+    
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="单个请求最多尝试次数（含首次），默认 5；限流、超时、连接错误和 5xx 会按指数退避重试"
+    )
+    
+    parser.add_argument(
+        "--rate-limit",
+        action="append",
+        metavar="MODEL=RPM:TPM",
+        help="客户端限流，如 gpt-4o=500:30000（可重复；模型名写 * 表示默认）。"
+             "同一台机器上的多个进程共享额度"
+    )
+    
+    parser.add_argument(
+        "--model-unavailable-ttl",
+        type=float,
+        default=24,
+        metavar="HOURS",
+        help="模型不存在/不可用的记录有效期（小时），默认 24；有效期内直接使用备用模型"
+    )
+    
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="共享 HTTP 连接池的最大连接数（默认按并发数估算，至少 32）"
+    )
+    
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="使用 HTTP/2（需要安装 h2）"
+    )
+    
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=10,
+        help="连接超时（秒），默认 10"
+    )
+    
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=600,
+        help="读超时（秒），默认 600"
+    )
+    
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="结束时打印各环节（缓存读取、提示词构建、API 调用、JSON 提取、校验、写文件）的耗时和 token 用量"
+    )
+    
+    parser.add_argument(
+        "--startup-timing",
+        action="store_true",
+        help="结束时打印启动各阶段（导入模块、解析参数、创建生成器、读取缓存、生成与保存）的耗时，"
+             "以及是否导入了 openai、pydantic"
+    )
+    
+    parser.add_argument(
+        "--metrics-jsonl",
+        metavar="PATH",
+        help="把耗时事件和计数器追加到 JSON Lines 文件"
+    )
+    
+    parser.add_argument(
+        "--metrics-prom",
+        metavar="PATH",
+        help="把指标写成 Prometheus 文本格式（可供 node_exporter textfile collector 读取）"
+    )
+    
+    parser.add_argument(
+        "--fixed-max-tokens",
+        action="store_true",
+        help="关闭自适应输出上限，所有阶段都使用 --max-output-tokens"
     )
     
     parser.add_argument(
@@ -534,12 +2664,81 @@ def main():
         help="禁用缓存"
     )
     
+    parser.add_argument(
+        "--full-refresh",
+        action="store_true",
+        help="关闭增量刷新：当天缓存未命中时重新生成完整 Fact Pack"
+    )
+    
+    parser.add_argument(
+        "--section-ttl",
+        action="append",
+        metavar="SECTION=HOURS",
+        help="覆盖某个 Fact Pack 字段的有效期（小时），可重复，如 --section-ttl news_30_90d=12"
+    )
+    
+    parser.add_argument(
+        "--cache-backend",
+        choices=["sqlite", "json"],
+        default="sqlite",
+        help="缓存存储后端：sqlite（默认，单文件 cache/cache.db）或 json（每个条目一个文件）"
+    )
+    
+    parser.add_argument(
+        "--cache-list",
+        action="store_true",
+        help="列出缓存条目（可配合公司名和 --cache-date 过滤）后退出"
+    )
+    
+    parser.add_argument(
+        "--cache-date",
+        type=str,
+        help="配合 --cache-list 使用，按日期（YYYY-MM-DD）过滤"
+    )
+    
+    parser.add_argument(
+        "--cache-import-json",
+        action="store_true",
+        help="把 cache/ 目录中旧版的 JSON 缓存文件导入当前缓存后端后退出"
+    )
+    
+    parser.add_argument(
+        "--cache-compact",
+        action="store_true",
+        help="淘汰过期/超限的缓存条目并整理存储空间后退出"
+    )
+    
+    parser.add_argument(
+        "--cache-max-age-days",
+        type=float,
+        help="配合 --cache-compact 使用，删除创建时间超过该天数的条目"
+    )
+    
+    parser.add_argument(
+        "--cache-max-mb",
+        type=float,
+        help="配合 --cache-compact 使用，缓存总容量上限（MB），超出时按最久未使用淘汰"
+    )
+    
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        metavar="HOURS",
+        help="LLM 响应缓存有效期（小时），默认带 web_search 的请求 24 小时、其他 7 天"
+    )
+    
     parser.add_argument(
         "--api-key",
         type=str,
         help="OpenAI API Key（如果不提供，从环境变量读取）"
     )
     
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        help="OpenAI 兼容接口地址（如本地模拟服务 http://127.0.0.1:8765/v1），默认读取 OPENAI_BASE_URL"
+    )
+    
     parser.add_argument(
         "--model",
         type=str,
@@ -547,7 +2746,128 @@ def main():
         help="OpenAI 模型名称（默认: gpt-4o）。如需使用 gpt-5.2-thinking，请确保有访问权限"
     )
     
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="流式输出文章：边生成边写入 Markdown 文件并打印到终端"
+    )
+    
+    parser.add_argument(
+        "--factpack-mode",
+        choices=["single", "sections"],
+        default="single",
+        help="Fact Pack 生成模式：single（一次生成，默认）或 sections（按字段分组并行生成）"
+    )
+    
+    parser.add_argument(
+        "--writer-mode",
+        choices=["single", "chapters"],
+        default="single",
+        help="文章写作模式：single（一次生成全文，默认）或 chapters（按章节分组并行生成）"
+    )
+    
+    parser.add_argument(
+        "--chapter-groups",
+        type=str,
+        help="chapters 模式下的章节分组，如 \"1-2,3-4,5-6,7-8,9-10,11\""
+    )
+    
+    parser.add_argument(
+        "--prompt-format",
+        choices=list(PROMPT_FORMATS),
+        default="compact",
+        help="写作提示词中 FactPack 的编码：json（缩进 JSON）、compact（紧凑 JSON，默认）或 compact-tables（财务指标用表格）"
+    )
+    
+    parser.add_argument(
+        "--batch",
+        type=str,
+        metavar="FILE",
+        help="批量模式：从文件读取公司列表（每行一个，\"-\" 表示从标准输入读取）"
+    )
+    
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="批量模式下的最大并发数，默认 4"
+    )
+    
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="批量模式下使用两阶段流水线（Fact Pack 与文章分别限流，阶段之间用队列衔接）"
+    )
+    
+    parser.add_argument(
+        "--factpack-concurrency",
+        type=int,
+        help="流水线模式下 Fact Pack 阶段的最大并发数（默认同 --concurrency）"
+    )
+    
+    parser.add_argument(
+        "--article-concurrency",
+        type=int,
+        help="流水线模式下文章阶段的最大并发数（默认同 --concurrency）"
+    )
+    
+    parser.add_argument(
+        "--queue",
+        nargs="?",
+        const=DEFAULT_QUEUE_PATH,
+        metavar="DB",
+        help=f"批量模式下使用持久化任务队列（SQLite，默认 {DEFAULT_QUEUE_PATH}），"
+             "每个阶段完成后写入检查点，中断后重新运行从检查点继续；不带 --batch 时继续处理队列中未完成的公司"
+    )
+    
+    parser.add_argument(
+        "--lease-timeout",
+        type=float,
+        default=DEFAULT_LEASE_SECONDS,
+        help=f"任务队列的租约时长（秒），超时未完成的任务可被其他进程领取，默认 {DEFAULT_LEASE_SECONDS}"
+    )
+    
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="任务队列中每家公司最多尝试次数，默认 3"
+    )
+    
+    parser.add_argument(
+        "--prewarm",
+        type=str,
+        metavar="WATCHLIST",
+        help="预热模式：每天在预热窗口内为关注列表（格式同 --batch）生成次日的 Fact Pack 和文章缓存"
+    )
+    
+    parser.add_argument(
+        "--prewarm-window",
+        default=DEFAULT_PREWARM_WINDOW,
+        metavar="HH:MM-HH:MM",
+        help=f"预热窗口（本地时间，须在零点前结束），公司的启动时间在窗口内均匀分布，默认 {DEFAULT_PREWARM_WINDOW}"
+    )
+    
+    parser.add_argument(
+        "--prewarm-once",
+        action="store_true",
+        help="只运行下一个预热窗口，完成后退出（适合由 cron 启动）"
+    )
+    
     args = parser.parse_args()
+    timer.mark("解析参数")
+    
+    if args.cache_list or args.cache_import_json or args.cache_compact:
+        run_cache_command(args)
+        return
+    
+    if args.prewarm:
+        run_prewarm_mode(args)
+        return
+    
+    if args.batch or args.queue:
+        run_batch_mode(args)
+        return
     
     # 获取公司输入
     company_input = args.company
@@ -570,44 +2890,49 @@ def main():
     print(f"新闻时间窗口: {args.market_days} 天")
     print(f"最大输出 tokens: {args.max_output_tokens}")
     print(f"使用缓存: {not args.no_cache}")
+    print(f"流式输出: {args.stream}")
+    print(f"Fact Pack 模式: {args.factpack_mode}")
+    print(f"写作模式: {args.writer_mode}")
+    print(f"提示词格式: {args.prompt_format}")
     print(f"{'='*60}\n")
     
     try:
-        # 创建生成器
-        generator = CompanyStoryGenerator(
-            api_key=args.api_key,
-            model=args.model,
-            max_output_tokens=args.max_output_tokens,
-            enable_web_search=not args.no_web,
-            market_days=args.market_days,
-            use_cache=not args.no_cache
-        )
+        # 创建生成器（不会创建 API client，第一次调用模型时才创建）
+        generator = build_generator(args)
+        timer.mark("创建生成器")
         
-        # 生成文章
-        article, factpack = generator.generate(company_identifier)
+        # 当天的 Fact Pack 和文章都已缓存时直接输出，不导入 openai、pydantic
+        cached = generator.load_cached_output(company_identifier)
+        timer.mark("读取缓存")
         
-        # 保存输出文件
-        markdown_path, sources_path = get_output_paths(company_identifier)
+        if cached is not None:
+            article, factpack = cached
+            print("✓ Fact Pack 和文章均命中缓存，直接输出（未调用模型）")
+            if args.stream:
+                print(article)
+            save_outputs(company_identifier, article, factpack, metadata=generator.result_metadata())
+        elif args.stream:
+            generate_streaming(generator, company_identifier)
+        else:
+            # 生成文章
+            article, factpack = generator.generate(company_identifier)
+            
+            # 保存输出文件
+            save_outputs(company_identifier, article, factpack, metadata=generator.result_metadata())
         
-        # 保存 Markdown
-        with open(markdown_path, 'w', encoding='utf-8') as f:
-            f.write(article)
-        print(f"✓ 文章已保存: {markdown_path}")
+        timer.mark("生成与保存")
         
-        # 保存 Sources JSON
-        sources_data = {
-            "company": company_identifier,
-            "generated_at": datetime.now().isoformat(),
-            "sources": [s.model_dump() for s in factpack.sources]
-        }
-        with open(sources_path, 'w', encoding='utf-8') as f:
-            json.dump(sources_data, f, ensure_ascii=False, indent=2)
-        print(f"✓ 来源文件已保存: {sources_path}")
+        print_cache_stats(generator.cache_stats)
+        print_usage_summary(generator)
+        print_model_route(generator)
         
         print(f"\n{'='*60}")
         print("生成完成！")
         print(f"{'='*60}\n")
         
+        if args.startup_timing:
+            timer.report()
+        
     except KeyboardInterrupt:
         print("\n\n用户中断")
         sys.exit(1)
@@ -616,6 +2941,8 @@ def main():
         import traceback
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        export_metrics(args)
 
 
 if __name__ == "__main__":
@@ -3,7 +3,7 @@
 诊断 OpenAI API 账户状态
 """
 import sys
-from openai import OpenAI
+from http_client import get_openai_client, SDK_DEFAULT_MAX_RETRIES
 from datetime import datetime
 
 def diagnose_api(api_key: str):
@@ -13,7 +13,7 @@ def diagnose_api(api_key: str):
     print("=" * 60)
     print(f"时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
     
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key, max_retries=SDK_DEFAULT_MAX_RETRIES)
     
     # 1. 测试基本连接
     print("1. 测试 API 连接...")
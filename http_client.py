@@ -0,0 +1,148 @@
+"""
+进程内共享的 OpenAI client 与 HTTP 连接池
+
+所有生成器（批量任务、Web 服务中的并发请求）和诊断脚本复用同一个 client，
+TLS 连接通过 keep-alive 复用，不必每次请求都重新握手。
+
+openai 在第一次创建 client 时才导入（导入 openai SDK 需要数百毫秒），
+命中缓存、不调用模型的命令行调用不必承担这部分开销。
+
+连接池通过 SDK 自带的 DefaultHttpxClient 创建，使用 SDK 依赖的那个 HTTP 库
+（较早的版本是 httpx，较新的版本是 httpx2），不需要单独安装 httpx。
+"""
+import importlib
+import threading
+from typing import Optional, Dict, Any, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+    from openai import OpenAI
+
+
+# 默认连接池与超时设置
+DEFAULT_HTTP_SETTINGS = {
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 60.0,
+    "connect_timeout": 10.0,
+    # 长文章生成可能持续数分钟，读超时按单次响应的最长时间设置
+    "read_timeout": 600.0,
+    "write_timeout": 30.0,
+    "pool_timeout": 60.0,
+    "http2": False,
+}
+
+# openai SDK 的默认重试次数（与 openai.DEFAULT_MAX_RETRIES 相同，这里写死以免导入 SDK）
+SDK_DEFAULT_MAX_RETRIES = 2
+
+_settings: Dict[str, Any] = dict(DEFAULT_HTTP_SETTINGS)
+_clients: Dict[Tuple[str, Optional[str], int], "OpenAI"] = {}
+_lock = threading.Lock()
+
+
+def configure_http_client(**settings) -> None:
+    """
+    修改共享连接池的设置（在第一次创建 client 之前调用才生效）
+
+    Args:
+        **settings: DEFAULT_HTTP_SETTINGS 中的键，值为 None 的项忽略
+    """
+    unknown = set(settings) - set(DEFAULT_HTTP_SETTINGS)
+    if unknown:
+        raise ValueError(f"未知的 HTTP 设置: {', '.join(sorted(unknown))}")
+    with _lock:
+        if _clients:
+            print("警告：共享 HTTP client 已创建，新的连接池设置不会生效")
+        _settings.update({key: value for key, value in settings.items() if value is not None})
+
+
+def _sdk_http_module():
+    """openai SDK 所用的 HTTP 库模块（httpx 或 httpx2）"""
+    from openai import DefaultHttpxClient
+
+    base = next(cls for cls in DefaultHttpxClient.__mro__[1:] if cls.__name__ == "Client")
+    return importlib.import_module(base.__module__.split(".")[0])
+
+
+def build_http_client(settings: Optional[Dict[str, Any]] = None) -> "httpx.Client":
+    """
+    按设置创建 SDK 使用的 HTTP 连接池
+
+    Args:
+        settings: 连接池与超时设置（默认当前共享设置）
+
+    Returns:
+        openai.DefaultHttpxClient（httpx.Client 或 httpx2.Client 的子类）
+    """
+    from openai import DefaultHttpxClient
+
+    http = _sdk_http_module()
+    settings = dict(settings or _settings)
+    http2 = settings["http2"]
+    if http2:
+        try:
+            import h2  # noqa: F401  HTTP/2 支持依赖 h2
+        except ImportError:
+            print("警告：未安装 h2（pip install h2），改用 HTTP/1.1")
+            http2 = False
+
+    return DefaultHttpxClient(
+        http2=http2,
+        limits=http.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive_connections"],
+            keepalive_expiry=settings["keepalive_expiry"],
+        ),
+        timeout=http.Timeout(
+            settings["read_timeout"],
+            connect=settings["connect_timeout"],
+            write=settings["write_timeout"],
+            pool=settings["pool_timeout"],
+        ),
+    )
+
+
+def get_openai_client(api_key: str, base_url: Optional[str] = None, max_retries: int = 0) -> "OpenAI":
+    """
+    获取进程内共享的 OpenAI client（同一 API Key、base_url 和重试次数只创建一次）
+
+    默认关闭 SDK 自带的重试，生成器的重试统一由 retry.RetryPolicy 负责；没有外层重试的
+    独立脚本（如 test_api_key.py）传入 SDK_DEFAULT_MAX_RETRIES 保留 SDK 的重试。
+
+    Args:
+        api_key: OpenAI API Key
+        base_url: API 地址（默认读取 OPENAI_BASE_URL 环境变量，未设置时为官方地址）
+        max_retries: SDK 自带的重试次数
+
+    Returns:
+        OpenAI client
+    """
+    key = (api_key, base_url, max_retries)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI
+
+            try:
+                http_client = build_http_client(_settings)
+            except (ImportError, AttributeError, TypeError, StopIteration) as e:
+                # SDK 版本不提供 DefaultHttpxClient 或参数不兼容：使用 SDK 默认连接池，只设置超时
+                print(f"警告：无法应用自定义连接池设置，使用 SDK 默认连接池: {e}")
+                http_client = None
+            if http_client is not None:
+                client = OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries, http_client=http_client)
+            else:
+                client = OpenAI(
+                    api_key=api_key, base_url=base_url, max_retries=max_retries, timeout=_settings["read_timeout"]
+                )
+            _clients[key] = client
+        return client
+
+
+def close_openai_clients() -> None:
+    """关闭所有共享 client 的连接池（进程退出前或测试中调用）"""
+    with _lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
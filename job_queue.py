@@ -0,0 +1,314 @@
+"""
+持久化的本地任务队列（SQLite）：记录每家公司完成到哪个阶段
+
+阶段依次为 queued → factpack_done → article_done → written。每完成一个阶段，
+Fact Pack JSON、文章正文和输出路径都写进队列数据库，批量任务中断（崩溃、Ctrl+C、
+机器重启）后重新运行，会从上次完成的阶段继续，已经完成的模型调用不会再付费。
+
+工作线程以租约方式领取任务：租约到期前其他线程和进程不会领取同一家公司；
+持有者崩溃后租约到期（或同一台机器上的持有进程已退出），任务可以被重新领取。
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Optional, Dict, Any, List
+
+from utils import DEFAULT_QUEUE_PATH, DEFAULT_LEASE_SECONDS
+
+STAGES = ("queued", "factpack_done", "article_done", "written")
+
+
+def make_worker_id(name: Optional[str] = None) -> str:
+    """
+    生成工作线程标识：主机名:进程号:线程名
+
+    Args:
+        name: 线程名（默认当前线程名）
+
+    Returns:
+        工作线程标识
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{name or threading.current_thread().name}"
+
+
+def _owner_process_gone(owner: str) -> bool:
+    """租约持有者是否是本机上已经退出的进程"""
+    try:
+        host, pid, _ = owner.split(":", 2)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname() or pid == os.getpid():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+
+class JobQueue:
+    """
+    SQLite 任务队列
+
+    每个线程使用自己的连接，数据库使用 WAL 模式；领取任务在 BEGIN IMMEDIATE 事务中完成，
+    多个线程和进程可以同时从同一个队列领取任务。
+    """
+
+    def __init__(self, db_path: str = DEFAULT_QUEUE_PATH, lease_seconds: float = DEFAULT_LEASE_SECONDS):
+        """
+        打开（或创建）任务队列
+
+        Args:
+            db_path: 队列数据库文件路径
+            lease_seconds: 租约时长（秒），应长于单个阶段的最长耗时
+        """
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self._local = threading.local()
+        Path(os.path.dirname(db_path) or ".").mkdir(parents=True, exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                company TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                stage TEXT NOT NULL DEFAULT 'queued',
+                factpack TEXT,
+                article TEXT,
+                metadata TEXT,
+                outputs TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                lease_owner TEXT,
+                lease_expires REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (stage, failed, lease_expires);
+        """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 阶段检查点是恢复的依据，提交后必须落盘
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, companies: List[str], retry_failed: bool = True) -> int:
+        """
+        加入公司；已在队列中的公司保留原有进度
+
+        Args:
+            companies: 公司标识列表
+            retry_failed: 是否让之前失败的任务重新可领取（清零尝试次数）
+
+        Returns:
+            新加入的公司数
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            position = conn.execute("SELECT COALESCE(MAX(position), 0) FROM jobs").fetchone()[0]
+            added = 0
+            for company in companies:
+                position += 1
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO jobs (company, position, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (company, position, now, now)
+                )
+                added += cursor.rowcount
+            if retry_failed:
+                conn.execute(
+                    "UPDATE jobs SET failed = 0, attempts = 0, updated_at = ? WHERE failed = 1",
+                    (now,)
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def recover(self) -> int:
+        """
+        释放本机上已退出进程持有的租约（重新运行时不必等租约到期）
+
+        Returns:
+            释放的租约数
+        """
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT company, lease_owner FROM jobs WHERE lease_owner IS NOT NULL AND stage != 'written'"
+        ).fetchall()
+        released = 0
+        for row in rows:
+            if _owner_process_gone(row["lease_owner"]):
+                cursor = conn.execute(
+                    "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL WHERE company = ? AND lease_owner = ?",
+                    (row["company"], row["lease_owner"])
+                )
+                released += cursor.rowcount
+        return released
+
+    def lease(self, worker_id: str, max_attempts: int = 3) -> Optional[Dict[str, Any]]:
+        """
+        领取一个未完成、未被租用（或租约已过期）的任务
+
+        Args:
+            worker_id: 工作线程标识
+            max_attempts: 最多尝试次数，达到后标记为失败
+
+        Returns:
+            任务字典（company、stage、factpack、article、metadata、attempts）；没有可领取的任务时返回 None
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE stage != 'written' AND failed = 0 "
+                    "AND (lease_expires IS NULL OR lease_expires < ?) ORDER BY position LIMIT 1",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                if row["attempts"] < max_attempts:
+                    break
+                # 之前的持有者在租约过期前都没有报告结果（多半是进程崩溃），次数用完后标记为失败
+                conn.execute(
+                    "UPDATE jobs SET failed = 1, lease_owner = NULL, lease_expires = NULL, "
+                    "last_error = COALESCE(last_error, '租约过期'), updated_at = ? WHERE company = ?",
+                    (now, row["company"])
+                )
+            conn.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_expires = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE company = ?",
+                (worker_id, now + self.lease_seconds, now, row["company"])
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return self._row_to_job(row, attempts=row["attempts"] + 1)
+
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row, **overrides) -> Dict[str, Any]:
+        job = {
+            "company": row["company"],
+            "stage": row["stage"],
+            "factpack": row["factpack"],
+            "article": row["article"],
+            "metadata": json.loads(row["metadata"]) if row["metadata"] else None,
+            "outputs": json.loads(row["outputs"]) if row["outputs"] else None,
+            "attempts": row["attempts"],
+            "last_error": row["last_error"],
+        }
+        job.update(overrides)
+        return job
+
+    def checkpoint(self, company: str, worker_id: str, stage: str, **fields) -> bool:
+        """
+        记录阶段完成并续租
+
+        只有仍持有租约的工作线程能写入：租约过期后被别人领走的任务，旧持有者的结果会被丢弃。
+
+        Args:
+            company: 公司标识
+            worker_id: 工作线程标识
+            stage: 完成的阶段（factpack_done、article_done、written）
+            **fields: 该阶段的产物（factpack、article、metadata、outputs）
+
+        Returns:
+            是否写入成功
+        """
+        if stage not in STAGES:
+            raise ValueError(f"未知的阶段: {stage}")
+        columns = {"stage": stage, "updated_at": time.time()}
+        for key, value in fields.items():
+            if key not in ("factpack", "article", "metadata", "outputs"):
+                raise ValueError(f"未知的字段: {key}")
+            columns[key] = json.dumps(value, ensure_ascii=False) if key in ("metadata", "outputs") else value
+        if stage == "written":
+            columns.update(lease_owner=None, lease_expires=None, last_error=None)
+        else:
+            columns["lease_expires"] = time.time() + self.lease_seconds
+        assignments = ", ".join(f"{key} = ?" for key in columns)
+        cursor = self._conn().execute(
+            f"UPDATE jobs SET {assignments} WHERE company = ? AND lease_owner = ?",
+            (*columns.values(), company, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, company: str, worker_id: str, error: str, max_attempts: int = 3) -> bool:
+        """
+        报告失败并释放租约；尝试次数达到上限时标记为失败，不再领取
+
+        Args:
+            company: 公司标识
+            worker_id: 工作线程标识
+            error: 错误信息
+            max_attempts: 最多尝试次数
+
+        Returns:
+            是否已标记为失败（不再重试）
+        """
+        conn = self._conn()
+        conn.execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL, last_error = ?, "
+            "failed = CASE WHEN attempts >= ? THEN 1 ELSE 0 END, updated_at = ? "
+            "WHERE company = ? AND lease_owner = ?",
+            (error, max_attempts, time.time(), company, worker_id)
+        )
+        row = conn.execute("SELECT failed FROM jobs WHERE company = ?", (company,)).fetchone()
+        return bool(row and row["failed"])
+
+    def release(self, company: str, worker_id: str) -> None:
+        """放弃租约但不计失败（如用户中断），保留已完成的阶段"""
+        self._conn().execute(
+            "UPDATE jobs SET lease_owner = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0) "
+            "WHERE company = ? AND lease_owner = ?",
+            (company, worker_id)
+        )
+
+    def counts(self) -> Dict[str, int]:
+        """
+        各阶段的公司数
+
+        Returns:
+            {"queued": n, "factpack_done": n, "article_done": n, "written": n, "failed": n, "leased": n}
+        """
+        conn = self._conn()
+        counts = {stage: 0 for stage in STAGES}
+        for row in conn.execute("SELECT stage, COUNT(*) AS n FROM jobs WHERE failed = 0 GROUP BY stage"):
+            counts[row["stage"]] = row["n"]
+        counts["failed"] = conn.execute("SELECT COUNT(*) FROM jobs WHERE failed = 1").fetchone()[0]
+        counts["leased"] = conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE lease_expires >= ? AND stage != 'written'", (time.time(),)
+        ).fetchone()[0]
+        return counts
+
+    def failures(self) -> List[Dict[str, str]]:
+        """失败的公司及最后一次错误"""
+        return [
+            {"company": row["company"], "error": row["last_error"] or "", "stage": row["stage"]}
+            for row in self._conn().execute("SELECT * FROM jobs WHERE failed = 1 ORDER BY position")
+        ]
+
+    def close(self) -> None:
+        """关闭当前线程的连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
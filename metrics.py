@@ -0,0 +1,301 @@
+"""
+轻量级指标：各环节耗时（span）和计数器（token 用量、重试、备用模型、缓存命中），
+可导出为 JSON Lines 和 Prometheus 文本格式
+
+进程内共享一个 Metrics 实例（get_metrics()），生成器、重试策略和缓存后端都写入它。
+标签只放低基数的取值（阶段、模型、缓存类型），公司名等只出现在 JSONL 事件中。
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+
+# span 耗时直方图的桶上界（秒）
+SPAN_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _label_key(name: str, labels: Dict[str, Any]) -> _LabelKey:
+    return (name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None)))
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Dict[str, str]] = None) -> str:
+    items = list(labels) + sorted((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label_value(value)}"' for key, value in items) + "}"
+
+
+class Metrics:
+    """
+    指标注册表（线程安全）
+
+    - 计数器：inc("tokens_in", 1200, stage="factpack", model="gpt-4o")
+    - span：with metrics.span("api_call", stage="article"): ...，耗时计入直方图，
+      同时记录一条事件（开始时间、耗时、所在线程、外层 span、是否出错）
+    """
+
+    def __init__(self, prefix: str = "company_story", max_events: int = 10000):
+        """
+        初始化指标注册表
+
+        Args:
+            prefix: Prometheus 指标名前缀
+            max_events: 内存中保留的最近 span 事件数
+        """
+        self.prefix = prefix
+        self._counters: Dict[_LabelKey, float] = {}
+        self._histograms: Dict[_LabelKey, Dict[str, Any]] = {}
+        self._events: deque = deque(maxlen=max_events)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """
+        计数器加 value
+
+        Args:
+            name: 计数器名（导出时加前缀和 _total 后缀）
+            value: 增量
+            **labels: 标签
+        """
+        if not value:
+            return
+        key = _label_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """
+        记录一次耗时（计入 span 直方图）
+
+        Args:
+            name: span 名
+            seconds: 耗时（秒）
+            **labels: 标签
+        """
+        key = _label_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(SPAN_BUCKETS)}
+                self._histograms[key] = histogram
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["max"] = max(histogram["max"], seconds)
+            for i, bound in enumerate(SPAN_BUCKETS):
+                if seconds <= bound:
+                    histogram["buckets"][i] += 1
+
+    @contextmanager
+    def span(self, name: str, attrs: Optional[Dict[str, Any]] = None, **labels):
+        """
+        计时一个环节
+
+        Args:
+            name: span 名（cache_lookup、prompt_build、api_call、json_extract、validate、file_write 等）
+            attrs: 只写入 JSONL 事件、不作为标签的附加信息（如公司名）
+            **labels: 标签
+        """
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        parent = stack[-1] if stack else None
+        stack.append(name)
+        started_at = time.time()
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            stack.pop()
+            self.observe(name, duration, **labels)
+            event = {
+                "type": "span",
+                "name": name,
+                "labels": {key: value for key, value in labels.items() if value is not None},
+                "start": round(started_at, 6),
+                "duration_ms": round(duration * 1000, 3),
+                "thread": threading.current_thread().name,
+                "parent": parent,
+                "error": error,
+            }
+            if attrs:
+                event["attrs"] = attrs
+            with self._lock:
+                self._events.append(event)
+
+    def counter(self, name: str, **labels) -> float:
+        """
+        读取计数器；不带标签时返回该计数器所有标签组合之和
+
+        Args:
+            name: 计数器名
+            **labels: 标签（只匹配给出的标签）
+
+        Returns:
+            计数值
+        """
+        wanted = set(_label_key(name, labels)[1])
+        with self._lock:
+            return sum(
+                value for (counter_name, counter_labels), value in self._counters.items()
+                if counter_name == name and wanted <= set(counter_labels)
+            )
+
+    def cache_hit_ratios(self) -> Dict[str, float]:
+        """
+        各类缓存的命中率（由 cache_requests 计数器计算）
+
+        Returns:
+            {缓存类型: 命中率}
+        """
+        totals: Dict[str, List[float]] = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                if name != "cache_requests":
+                    continue
+                label_map = dict(labels)
+                entry = totals.setdefault(label_map.get("kind", ""), [0.0, 0.0])
+                entry[0 if label_map.get("outcome") == "hit" else 1] += value
+        return {kind: hits / (hits + misses) for kind, (hits, misses) in totals.items() if hits + misses}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        当前所有指标
+
+        Returns:
+            {"counters": [...], "spans": [...], "cache_hit_ratio": {...}}
+        """
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            spans = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum_ms": round(histogram["sum"] * 1000, 3),
+                    "mean_ms": round(histogram["sum"] / histogram["count"] * 1000, 3),
+                    "max_ms": round(histogram["max"] * 1000, 3),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+        return {"counters": counters, "spans": spans, "cache_hit_ratio": self.cache_hit_ratios()}
+
+    def events(self) -> List[Dict[str, Any]]:
+        """最近的 span 事件"""
+        with self._lock:
+            return list(self._events)
+
+    def to_prometheus(self) -> str:
+        """
+        导出为 Prometheus 文本格式
+
+        Returns:
+            文本（计数器为 <prefix>_<name>_total，span 为 <prefix>_span_seconds 直方图）
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value:g}")
+
+        if histograms:
+            metric = f"{self.prefix}_span_seconds"
+            lines.append(f"# HELP {metric} Time spent in each pipeline step")
+            lines.append(f"# TYPE {metric} histogram")
+            for (name, labels), histogram in histograms:
+                span_labels = (("span", name),) + labels
+                for bound, count in zip(SPAN_BUCKETS, histogram["buckets"]):
+                    lines.append(f"{metric}_bucket{_format_labels(span_labels, {'le': f'{bound:g}'})} {count}")
+                lines.append(f"{metric}_bucket{_format_labels(span_labels, {'le': '+Inf'})} {histogram['count']}")
+                lines.append(f"{metric}_sum{_format_labels(span_labels)} {histogram['sum']:.6f}")
+                lines.append(f"{metric}_count{_format_labels(span_labels)} {histogram['count']}")
+
+        ratios = self.cache_hit_ratios()
+        if ratios:
+            metric = f"{self.prefix}_cache_hit_ratio"
+            lines.append(f"# TYPE {metric} gauge")
+            for kind, ratio in sorted(ratios.items()):
+                lines.append(f"{metric}{_format_labels((('kind', kind),))} {ratio:.4f}")
+        return "\n".join(lines) + "\n"
+
+    def write_jsonl(self, path: str) -> None:
+        """
+        把 span 事件、计数器和 span 汇总追加到 JSON Lines 文件
+
+        Args:
+            path: 文件路径
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        snapshot = self.snapshot()
+        now = round(time.time(), 6)
+        with open(path, "a", encoding="utf-8") as f:
+            for event in self.events():
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            for counter in snapshot["counters"]:
+                f.write(json.dumps(dict(counter, type="counter", time=now), ensure_ascii=False) + "\n")
+            for span in snapshot["spans"]:
+                f.write(json.dumps(dict(span, type="span_summary", time=now), ensure_ascii=False) + "\n")
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        写入 Prometheus 文本文件（先写临时文件再替换，可供 node_exporter textfile collector 读取）
+
+        Args:
+            path: 文件路径
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def reset(self) -> None:
+        """清空所有指标"""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._events.clear()
+
+
+_default_metrics: Optional[Metrics] = None
+_default_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """
+    获取进程内共享的指标注册表
+
+    Returns:
+        Metrics 实例
+    """
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = Metrics()
+        return _default_metrics
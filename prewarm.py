@@ -0,0 +1,186 @@
+"""
+缓存预热：每天在日期切换前的时间窗口内，为关注列表中的公司提前生成次日的 Fact Pack 和文章
+
+Fact Pack 缓存键带日期，零点之后当天的缓存是空的，早上第一批读者要等几分钟。
+预热直接写入次日的缓存键（文章缓存按 Fact Pack 内容寻址，会随之命中），零点之后的读者
+拿到的都是热缓存。窗口内的任务按公司数均匀错开启动，再加上生成器自身的限流器和
+并发上限，不会在窗口开始时集中打满 API 配额。
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Any, List, Tuple
+
+from batch import read_company_list, print_batch_summary, _BatchProgress
+from utils import DEFAULT_PREWARM_WINDOW
+
+
+def parse_prewarm_window(spec: str) -> Tuple[int, int]:
+    """
+    解析预热窗口
+
+    Args:
+        spec: "HH:MM-HH:MM"（本地时间），结束时间必须晚于开始时间且不跨零点
+
+    Returns:
+        (开始, 结束)，单位为当天零点起的分钟数
+
+    Raises:
+        ValueError: 格式错误
+    """
+    try:
+        start_text, end_text = spec.split("-", 1)
+        bounds = []
+        for text in (start_text, end_text):
+            hour, minute = text.strip().split(":")
+            hour, minute = int(hour), int(minute)
+            if not (0 <= hour < 24 and 0 <= minute < 60):
+                raise ValueError
+            bounds.append(hour * 60 + minute)
+    except ValueError:
+        raise ValueError(f"无效的预热窗口: {spec}（格式如 22:00-23:45）")
+    start, end = bounds
+    if end <= start:
+        raise ValueError(f"无效的预热窗口: {spec}（结束时间必须晚于开始时间，且不能跨零点）")
+    return start, end
+
+
+def next_window(window: Tuple[int, int], now: Optional[datetime] = None) -> Tuple[datetime, datetime]:
+    """
+    下一个（或正在进行的）预热窗口
+
+    Args:
+        window: parse_prewarm_window 的结果
+        now: 当前时间（默认本地当前时间）
+
+    Returns:
+        (开始时间, 结束时间)；当前处于窗口内时开始时间为窗口开始时刻
+    """
+    now = now or datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    start = midnight + timedelta(minutes=window[0])
+    end = midnight + timedelta(minutes=window[1])
+    if now >= end:
+        start += timedelta(days=1)
+        end += timedelta(days=1)
+    return start, end
+
+
+def spread_schedule(companies: List[str], start: datetime, end: datetime) -> List[Tuple[datetime, str]]:
+    """
+    把公司的启动时间均匀分布在窗口内
+
+    最后一家公司在窗口结束前一个间隔启动，给它留出生成时间。
+
+    Args:
+        companies: 公司列表
+        start: 最早启动时间
+        end: 窗口结束时间
+
+    Returns:
+        [(启动时间, 公司)]
+    """
+    if not companies:
+        return []
+    interval = max((end - start).total_seconds(), 0) / len(companies)
+    return [(start + timedelta(seconds=interval * i), company) for i, company in enumerate(companies)]
+
+
+def run_prewarm_window(
+    generator,
+    companies: List[str],
+    start: datetime,
+    end: datetime,
+    concurrency: int = 2
+) -> Dict[str, Any]:
+    """
+    在一个窗口内为次日预热缓存
+
+    Args:
+        generator: CompanyStoryGenerator 实例（需启用缓存）
+        companies: 公司列表
+        start: 窗口开始时间（已经开始时从当前时间起分布）
+        end: 窗口结束时间
+        concurrency: 最大并发数
+
+    Returns:
+        汇总结果字典（同 run_batch，另含 cache_date）
+    """
+    cache_date = (end.date() + timedelta(days=1)).strftime("%Y-%m-%d")
+    start = max(start, datetime.now())
+    schedule = spread_schedule(companies, start, end)
+    progress = _BatchProgress(len(companies))
+    interval = (end - start).total_seconds() / max(len(companies), 1)
+    print(
+        f"预热 {cache_date} 的缓存：{len(companies)} 家公司，"
+        f"{start:%H:%M:%S}-{end:%H:%M:%S}，约每 {interval:.0f} 秒启动一家，并发数 {concurrency}"
+    )
+
+    def _warm_one(company: str) -> None:
+        started = time.monotonic()
+        try:
+            generator.generate(company, use_cache=True, cache_date=cache_date)
+        except Exception as e:
+            progress.failure(company, e)
+            return
+        progress.success(company, time.monotonic() - started)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="prewarm") as executor:
+        for launch_at, company in schedule:
+            delay = (launch_at - datetime.now()).total_seconds()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_warm_one, company)
+
+    summary = progress.summary(concurrency=concurrency, cache_date=cache_date)
+    if datetime.now() > end:
+        print(f"警告：预热在窗口结束后才完成（{datetime.now():%H:%M:%S}），可以加大并发数或提前窗口")
+    print_batch_summary(summary)
+    return summary
+
+
+def run_prewarm(
+    generator,
+    watchlist: str,
+    window: str = DEFAULT_PREWARM_WINDOW,
+    concurrency: int = 2,
+    once: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    预热调度：等待下一个窗口，在窗口内预热次日缓存，然后等待第二天的窗口
+
+    每个窗口开始时重新读取关注列表，修改列表不需要重启。
+
+    Args:
+        generator: CompanyStoryGenerator 实例
+        watchlist: 关注列表文件（格式同 --batch）
+        window: 预热窗口 "HH:MM-HH:MM"（本地时间）
+        concurrency: 最大并发数
+        once: 只运行一个窗口
+
+    Returns:
+        各窗口的汇总结果
+    """
+    bounds = parse_prewarm_window(window)
+    summaries = []
+    while True:
+        start, end = next_window(bounds)
+        wait = (start - datetime.now()).total_seconds()
+        if wait > 0:
+            print(f"等待预热窗口：{start:%Y-%m-%d %H:%M}（{wait / 3600:.1f} 小时后）")
+            time.sleep(wait)
+
+        try:
+            companies = read_company_list(watchlist)
+        except OSError as e:
+            print(f"警告：无法读取关注列表，跳过本次预热: {e}")
+            companies = []
+        if companies:
+            summaries.append(run_prewarm_window(generator, companies, start, end, concurrency=concurrency))
+        else:
+            print("警告：关注列表为空，跳过本次预热")
+
+        if once:
+            return summaries
+        # 确保进入下一天的窗口
+        time.sleep(max(0.0, (end - datetime.now()).total_seconds()) + 1)
@@ -0,0 +1,195 @@
+"""
+客户端限流：按模型的请求数/分钟（RPM）和 token 数/分钟（TPM）令牌桶，请求发出前排队
+
+令牌桶状态保存在 cache/ratelimit/<model>.json 中，更新时加文件锁，
+因此同一台机器上的多个线程、多个进程共享同一份额度。
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Tuple
+
+from utils import sanitize_filename
+
+try:
+    import fcntl
+except ImportError:  # Windows：只在进程内共享
+    fcntl = None
+
+
+def parse_rate_limits(items: Optional[List[str]]) -> Dict[str, Tuple[Optional[float], Optional[float]]]:
+    """
+    解析限流参数
+
+    Args:
+        items: 形如 "gpt-4o=500:30000"（RPM:TPM）的列表；只限 RPM 写 "gpt-4o=500"，
+            只限 TPM 写 "gpt-4o=:30000"；模型名写 "*" 表示对所有未单独配置的模型生效
+
+    Returns:
+        {模型名: (rpm, tpm)}，未配置的一项为 None
+    """
+    limits = {}
+    for item in items or []:
+        if "=" not in item:
+            raise ValueError(f"限流参数格式错误（应为 模型=RPM:TPM）: {item}")
+        model, spec = item.split("=", 1)
+        rpm_text, _, tpm_text = spec.partition(":")
+        try:
+            rpm = float(rpm_text) if rpm_text.strip() else None
+            tpm = float(tpm_text) if tpm_text.strip() else None
+        except ValueError:
+            raise ValueError(f"限流参数格式错误（应为 模型=RPM:TPM）: {item}")
+        if rpm is None and tpm is None:
+            raise ValueError(f"限流参数至少需要 RPM 或 TPM: {item}")
+        limits[model.strip()] = (rpm, tpm)
+    return limits
+
+
+def _refill(bucket: List[float], capacity: float, now: float) -> None:
+    """按经过的时间补充令牌（bucket 为 [余量, 上次更新时间]，原地修改）"""
+    elapsed = max(0.0, now - bucket[1])
+    bucket[0] = min(capacity, bucket[0] + elapsed * capacity / 60.0)
+    bucket[1] = now
+
+
+class RateLimiter:
+    """
+    按模型的 RPM/TPM 令牌桶限流器（线程安全，可跨进程共享）
+
+    每次请求前调用 acquire 预扣 1 个请求和预估的 token 数（提示词估算 + max_tokens），
+    额度不足时等待；请求完成后调用 reconcile 按实际用量多退少补。
+    """
+
+    def __init__(
+        self,
+        limits: Dict[str, Tuple[Optional[float], Optional[float]]],
+        state_dir: Optional[str] = os.path.join("cache", "ratelimit"),
+        sleep=time.sleep,
+        max_wait_step: float = 5.0
+    ):
+        """
+        初始化限流器
+
+        Args:
+            limits: {模型名: (rpm, tpm)}，"*" 为默认配置
+            state_dir: 状态文件目录；为 None 时只在进程内共享
+            sleep: 等待函数（测试时可替换）
+            max_wait_step: 每次等待的最长时间（秒），醒来后重新检查额度
+        """
+        self.limits = dict(limits)
+        self.state_dir = state_dir
+        self.sleep = sleep
+        self.max_wait_step = max_wait_step
+        self.waited = 0.0
+        self._states: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+
+    def limits_for(self, model: str) -> Tuple[Optional[float], Optional[float]]:
+        """
+        某个模型的限额
+
+        Args:
+            model: 模型名
+
+        Returns:
+            (rpm, tpm)；未配置时为 (None, None)
+        """
+        return self.limits.get(model) or self.limits.get("*") or (None, None)
+
+    @contextmanager
+    def _state(self, model: str):
+        """加锁读取并在退出时写回某个模型的令牌桶状态"""
+        with self._lock:
+            if not self.state_dir or fcntl is None:
+                yield self._states.setdefault(model, {})
+                return
+            path = os.path.join(self.state_dir, f"{sanitize_filename(model)}.json")
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                raw = b""
+                while True:
+                    block = os.read(fd, 65536)
+                    if not block:
+                        break
+                    raw += block
+                try:
+                    state = json.loads(raw.decode("utf-8")) if raw else {}
+                except ValueError:
+                    state = {}
+                yield state
+                payload = json.dumps(state).encode("utf-8")
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, payload)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def acquire(self, model: str, tokens: float) -> float:
+        """
+        预扣一次请求的额度，额度不足时等待
+
+        Args:
+            model: 模型名
+            tokens: 预估 token 数（提示词 + max_tokens）
+
+        Returns:
+            实际预扣的 token 数（超过 TPM 上限的请求按上限预扣），用于之后 reconcile
+        """
+        rpm, tpm = self.limits_for(model)
+        if rpm is None and tpm is None:
+            return 0.0
+        tokens = min(float(tokens), tpm) if tpm else 0.0
+        announced = False
+
+        while True:
+            with self._state(model) as state:
+                now = time.time()
+                wait = 0.0
+                buckets = []
+                if rpm:
+                    bucket = state.setdefault("requests", [rpm, now])
+                    _refill(bucket, rpm, now)
+                    buckets.append((bucket, 1.0, rpm))
+                if tpm:
+                    bucket = state.setdefault("tokens", [tpm, now])
+                    _refill(bucket, tpm, now)
+                    buckets.append((bucket, tokens, tpm))
+                for bucket, need, capacity in buckets:
+                    if bucket[0] < need:
+                        wait = max(wait, (need - bucket[0]) * 60.0 / capacity)
+                if wait <= 0:
+                    for bucket, need, _ in buckets:
+                        bucket[0] -= need
+                    return tokens
+
+            if not announced and wait >= 1:
+                print(f"限流：{model} 额度已用满，等待约 {wait:.1f} 秒...")
+                announced = True
+            step = min(wait, self.max_wait_step)
+            self.waited += step
+            self.sleep(step)
+
+    def reconcile(self, model: str, reserved: float, actual: float) -> None:
+        """
+        按实际用量修正预扣的 token 数（预扣多了退回，少了补扣）
+
+        Args:
+            model: 模型名
+            reserved: acquire 返回的预扣数
+            actual: 实际 token 数（prompt_tokens + completion_tokens）
+        """
+        _, tpm = self.limits_for(model)
+        if not tpm or reserved <= 0:
+            return
+        with self._state(model) as state:
+            now = time.time()
+            bucket = state.setdefault("tokens", [tpm, now])
+            _refill(bucket, tpm, now)
+            # 允许短暂为负：实际用量超出预估时，后续请求会多等一会儿
+            bucket[0] = min(tpm, bucket[0] + reserved - actual)
@@ -0,0 +1,376 @@
+"""
+API 调用的重试策略：错误分类、带完全抖动的指数退避、Retry-After、全局重试预算和熔断器
+"""
+import time
+import random
+import threading
+from datetime import datetime, timezone
+from typing import Optional, Callable, Any
+
+from metrics import get_metrics
+
+
+# 错误类型
+RATE_LIMIT = "rate_limit"
+QUOTA = "quota"
+MODEL_NOT_FOUND = "model_not_found"
+TIMEOUT = "timeout"
+CONNECTION = "connection"
+SERVER = "server"
+CLIENT = "client"
+UNKNOWN = "unknown"
+
+# 可以重试的错误类型
+RETRYABLE_ERRORS = (RATE_LIMIT, TIMEOUT, CONNECTION, SERVER)
+
+# 说明后端不健康、计入熔断的错误类型（限流说明后端正常，只是请求太多）
+BREAKER_ERRORS = (TIMEOUT, CONNECTION, SERVER)
+
+ERROR_LABELS = {
+    RATE_LIMIT: "限流",
+    TIMEOUT: "超时",
+    CONNECTION: "连接错误",
+    SERVER: "服务端错误",
+}
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，请求被直接拒绝"""
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    把 API 调用异常归类
+
+    优先使用 openai SDK 异常的类名和 status_code，其次按错误信息匹配。
+
+    Args:
+        error: 异常
+
+    Returns:
+        错误类型（RATE_LIMIT、QUOTA、MODEL_NOT_FOUND、TIMEOUT、CONNECTION、SERVER、CLIENT、UNKNOWN）
+    """
+    status = getattr(error, "status_code", None)
+    name = type(error).__name__
+    message = str(error).lower()
+
+    if "insufficient_quota" in message or "quota" in message:
+        return QUOTA
+    if status == 429 or name == "RateLimitError" or "rate limit" in message:
+        return RATE_LIMIT
+    if "model" in message and ("not found" in message or "does not exist" in message or "404" in message):
+        return MODEL_NOT_FOUND
+    if name == "APITimeoutError" or isinstance(error, TimeoutError) or status == 408 or "timed out" in message:
+        return TIMEOUT
+    if name == "APIConnectionError" or isinstance(error, ConnectionError):
+        return CONNECTION
+    if status is not None and (status >= 500 or status == 409):
+        return SERVER
+    if status is not None:
+        return CLIENT
+    if "model" in message and "invalid" in message:
+        return MODEL_NOT_FOUND
+    return UNKNOWN
+
+
+def get_retry_after(error: BaseException) -> Optional[float]:
+    """
+    读取服务端建议的重试等待时间（retry-after-ms 或 Retry-After 响应头）
+
+    Args:
+        error: 异常
+
+    Returns:
+        等待秒数；没有提示时返回 None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    # HTTP 日期格式很少见，用到时才导入 email.utils
+    from email.utils import parsedate_to_datetime
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryBudget:
+    """
+    全局重试预算（线程安全）
+
+    每个首次请求存入 ratio 个令牌，每次重试消耗 1 个；余额从 reserve 开始，
+    最多累积到 max_balance。后端大面积失败时重试次数被限制在请求数的一定比例内，
+    避免重试把负载放大数倍。
+    """
+
+    def __init__(self, ratio: float = 0.2, reserve: float = 10, max_balance: float = 100):
+        """
+        初始化重试预算
+
+        Args:
+            ratio: 每个请求存入的令牌数（即长期允许的重试/请求比例）
+            reserve: 初始余额
+            max_balance: 余额上限
+        """
+        self.ratio = ratio
+        self.max_balance = max_balance
+        self._balance = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        with self._lock:
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        为一次重试扣减预算
+
+        Returns:
+            是否允许重试
+        """
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+    @property
+    def balance(self) -> float:
+        with self._lock:
+            return self._balance
+
+
+class CircuitBreaker:
+    """
+    熔断器（线程安全）
+
+    连续 failure_threshold 次后端错误（超时、连接错误、5xx）后打开，打开期间所有请求
+    直接失败；reset_timeout 秒后进入半开状态，只放行一个试探请求，成功则关闭，失败则
+    重新打开。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        初始化熔断器
+
+        Args:
+            failure_threshold: 触发熔断的连续失败次数
+            reset_timeout: 打开后多久进入半开状态（秒）
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """
+        请求前检查
+
+        Raises:
+            CircuitOpenError: 熔断中
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self._opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(f"熔断中：后端连续失败，{remaining:.0f} 秒内直接失败")
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    raise CircuitOpenError("熔断中：正在等待试探请求的结果")
+                self._probing = True
+
+    def release_probe(self) -> None:
+        """放弃试探请求但不记录结果（如调用被 KeyboardInterrupt 中断），下一个请求可以重新试探"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self, kind: str) -> None:
+        """
+        记录一次失败
+
+        Args:
+            kind: 错误类型，只有后端错误计入熔断
+        """
+        with self._lock:
+            if kind not in BREAKER_ERRORS:
+                # 非后端错误说明后端有响应，半开状态下也视为恢复
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                    self._failures = 0
+                self._probing = False
+                return
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"警告：连续 {self._failures} 次后端错误，熔断 {self.reset_timeout:.0f} 秒")
+                    get_metrics().inc("circuit_opened")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class RetryPolicy:
+    """
+    重试策略
+
+    只重试限流、超时、连接错误和 5xx；等待时间为完全抖动的指数退避
+    （0 到 min(max_delay, base_delay * 2^n) 之间均匀随机），服务端给出 Retry-After 时
+    以其为准。所有请求共享同一个重试预算和熔断器。
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        max_retry_after: float = 120.0,
+        budget: Optional[RetryBudget] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        """
+        初始化重试策略
+
+        Args:
+            max_attempts: 单个请求最多尝试次数（含首次）
+            base_delay: 退避基数（秒）
+            max_delay: 退避上限（秒）
+            max_retry_after: Retry-After 的上限（秒），防止被异常大的提示卡住
+            budget: 重试预算（默认新建）
+            breaker: 熔断器（默认新建）
+            sleep: 等待函数（测试时可替换）
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = sleep
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """
+        计算第 attempt 次重试前的等待时间
+
+        Args:
+            attempt: 重试序号（从 1 开始）
+            error: 触发重试的异常（用于读取 Retry-After）
+
+        Returns:
+            等待秒数
+        """
+        retry_after = get_retry_after(error) if error is not None else None
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def call(
+        self,
+        fn: Callable[[], Any],
+        max_attempts: Optional[int] = None,
+        label: str = "API"
+    ) -> Any:
+        """
+        按策略调用 fn
+
+        Args:
+            fn: 无参调用
+            max_attempts: 覆盖最多尝试次数
+            label: 日志中的调用名称
+
+        Returns:
+            fn 的返回值
+
+        Raises:
+            CircuitOpenError: 熔断中
+            最后一次调用的异常：不可重试、次数用完或预算用完
+        """
+        attempts = max(1, max_attempts or self.max_attempts)
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+            try:
+                result = fn()
+            except BaseException as e:
+                if not isinstance(e, Exception):
+                    # KeyboardInterrupt、GeneratorExit 等：不计入熔断，但不能让半开状态一直占着试探名额
+                    self.breaker.release_probe()
+                    raise
+                kind = classify_error(e)
+                self.breaker.record_failure(kind)
+                if kind not in RETRYABLE_ERRORS or attempt >= attempts:
+                    raise
+                if self.breaker.state == CircuitBreaker.OPEN:
+                    # 刚刚触发熔断，等待也无济于事
+                    raise
+                if not self.budget.withdraw():
+                    print(f"警告：重试预算已用完，不再重试 {label}")
+                    raise
+                delay = self.backoff(attempt, e)
+                with self._lock:
+                    self.retries += 1
+                get_metrics().inc("retries", kind=kind)
+                print(
+                    f"{label} 遇到{ERROR_LABELS.get(kind, kind)}，等待 {delay:.1f} 秒后重试... "
+                    f"(尝试 {attempt}/{attempts})"
+                )
+                self.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return result
+
+
+_default_policy: Optional[RetryPolicy] = None
+_default_policy_lock = threading.Lock()
+
+
+def get_retry_policy() -> RetryPolicy:
+    """
+    获取进程内共享的默认重试策略（共享重试预算和熔断器）
+
+    Returns:
+        RetryPolicy 实例
+    """
+    global _default_policy
+    with _default_policy_lock:
+        if _default_policy is None:
+            _default_policy = RetryPolicy()
+        return _default_policy
@@ -1,9 +1,14 @@
 """
 数据模型定义：FactPack 结构
 """
+import copy
+import typing
 from datetime import date, datetime
+from functools import lru_cache
 from typing import List, Optional, Dict, Any
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, TypeAdapter, field_validator
+
+from utils import FACTPACK_SCHEMA_VERSION  # noqa: F401  结构版本（修改字段或校验规则时在 utils 中递增）
 
 
 class Source(BaseModel):
@@ -159,3 +164,237 @@ class FactPack(BaseModel):
             }
         }
 
+
+# ---------------------------------------------------------------------------
+# 结构化输出（response_format 的 json_schema strict 模式）
+# ---------------------------------------------------------------------------
+
+# 由程序填写、不需要模型输出的字段
+FACTPACK_SERVER_FIELDS = ("generated_at", "web_search_enabled")
+
+# 顶层列表的长度约束（与 FactPack 的字段校验器保持一致）
+FACTPACK_ARRAY_LIMITS = {
+    "timeline": (5, 7),
+    "news_30_90d": (3, None),
+    "risks": (3, None),
+}
+
+# strict 模式不支持自由键名的对象，Dict[str, Any] 字段改为键值对数组
+_FREE_FORM_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "key": {"type": "string"},
+        "value": {"type": ["string", "number", "null"]}
+    },
+    "required": ["key", "value"],
+    "additionalProperties": False
+}
+
+# strict 模式只接受 JSON Schema 的一个子集，这些注解关键字不发送
+_STRICT_DROPPED_KEYWORDS = ("default", "title", "example", "examples")
+
+
+def _to_strict_schema(node):
+    """
+    把 pydantic 生成的 JSON Schema 节点转换为 strict 模式可接受的形式
+    
+    所有字段都列为必填（可选字段本身已允许 null），对象禁止额外字段，
+    去掉 default/title/example 等注解，自由键名的对象改为键值对数组。
+    """
+    if isinstance(node, list):
+        return [_to_strict_schema(item) for item in node]
+    if not isinstance(node, dict):
+        return node
+    if "$ref" in node:
+        return {"$ref": node["$ref"]}
+    if node.get("type") == "object" and "properties" not in node:
+        strict = {"type": "array", "items": dict(_FREE_FORM_ITEM_SCHEMA)}
+        if "description" in node:
+            strict["description"] = node["description"]
+        return strict
+    
+    strict = {}
+    for key, value in node.items():
+        if key in _STRICT_DROPPED_KEYWORDS:
+            continue
+        if key == "properties":
+            strict[key] = {name: _to_strict_schema(prop) for name, prop in value.items()}
+        elif key in ("items", "anyOf", "$defs"):
+            strict[key] = (
+                {name: _to_strict_schema(item) for name, item in value.items()}
+                if key == "$defs" else _to_strict_schema(value)
+            )
+        else:
+            strict[key] = value
+    if "properties" in strict:
+        strict["required"] = list(strict["properties"])
+        strict["additionalProperties"] = False
+    return strict
+
+
+def _build_factpack_strict_schema() -> dict:
+    schema = FactPack.model_json_schema()
+    for field in FACTPACK_SERVER_FIELDS:
+        schema["properties"].pop(field, None)
+    schema = _to_strict_schema(schema)
+    for field, (min_items, max_items) in FACTPACK_ARRAY_LIMITS.items():
+        prop = schema["properties"][field]
+        prop["minItems"] = min_items
+        if max_items is not None:
+            prop["maxItems"] = max_items
+    return schema
+
+
+# 导入时生成一次，之后每次请求直接复用
+FACTPACK_STRICT_SCHEMA = _build_factpack_strict_schema()
+
+FACTPACK_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "FactPack", "strict": True, "schema": FACTPACK_STRICT_SCHEMA}
+}
+
+
+@lru_cache(maxsize=None)
+def factpack_section_response_format(sections: tuple) -> dict:
+    """
+    分段生成时某一组字段的 response_format（只含这些字段和 sources）
+    
+    Args:
+        sections: 顶层字段元组（不含 sources）
+        
+    Returns:
+        response_format 参数
+    """
+    names = [name for name in sections if name in FACTPACK_STRICT_SCHEMA["properties"]] + ["sources"]
+    schema = {
+        "type": "object",
+        "properties": {name: copy.deepcopy(FACTPACK_STRICT_SCHEMA["properties"][name]) for name in names},
+        "required": names,
+        "additionalProperties": False,
+        "$defs": FACTPACK_STRICT_SCHEMA["$defs"]
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "FactPackSection", "strict": True, "schema": schema}
+    }
+
+
+@lru_cache(maxsize=None)
+def factpack_gap_fill_response_format(section: str) -> dict:
+    """
+    补充某个列表字段时的 response_format（该字段和 sources，不限条数）
+    
+    Args:
+        section: 列表字段名
+        
+    Returns:
+        response_format 参数
+    """
+    response_format = copy.deepcopy(factpack_section_response_format((section,)))
+    prop = response_format["json_schema"]["schema"]["properties"][section]
+    prop.pop("minItems", None)
+    prop.pop("maxItems", None)
+    response_format["json_schema"]["name"] = "FactPackGapFill"
+    return response_format
+
+
+def factpack_count_deficits(factpack_data: dict) -> Dict[str, int]:
+    """
+    检查列表字段的条数是否达到 FactPack 校验器的下限
+    
+    Args:
+        factpack_data: FactPack 字典
+        
+    Returns:
+        {字段名: 还缺少的条数}，条数足够时为空字典
+    """
+    deficits = {}
+    for field, (min_items, _) in FACTPACK_ARRAY_LIMITS.items():
+        items = factpack_data.get(field)
+        count = len(items) if isinstance(items, list) else 0
+        if count < min_items:
+            deficits[field] = min_items - count
+    return deficits
+
+
+def _model_of(annotation):
+    """返回注解对应的 BaseModel 子类（含 Optional/List 包装）及是否为列表"""
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin in (list, List) and args:
+        model, _ = _model_of(args[0])
+        return (model, True)
+    if origin is typing.Union:
+        for arg in args:
+            model, is_list = _model_of(arg)
+            if model is not None:
+                return (model, is_list)
+        return (None, False)
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return (annotation, False)
+    return (None, False)
+
+
+def _is_free_form(annotation) -> bool:
+    origin = typing.get_origin(annotation)
+    return annotation is dict or origin in (dict, Dict)
+
+
+def restore_free_form_fields(data: dict, model=None) -> dict:
+    """
+    把结构化输出中键值对数组形式的 Dict[str, Any] 字段还原为字典（原地修改）
+    
+    Args:
+        data: 模型输出解析后的字典（可以只包含部分顶层字段）
+        model: 对应的模型类，默认 FactPack
+        
+    Returns:
+        data 本身
+    """
+    model = model or FactPack
+    if not isinstance(data, dict):
+        return data
+    for name, field in model.model_fields.items():
+        if name not in data:
+            continue
+        value = data[name]
+        if _is_free_form(field.annotation):
+            if isinstance(value, list):
+                data[name] = {
+                    item["key"]: item.get("value")
+                    for item in value
+                    if isinstance(item, dict) and "key" in item
+                }
+            continue
+        sub_model, is_list = _model_of(field.annotation)
+        if sub_model is None:
+            continue
+        if is_list and isinstance(value, list):
+            for item in value:
+                restore_free_form_fields(item, sub_model)
+        elif isinstance(value, dict):
+            restore_free_form_fields(value, sub_model)
+    return data
+
+
+@lru_cache(maxsize=None)
+def _section_adapter(name: str) -> TypeAdapter:
+    return TypeAdapter(FactPack.model_fields[name].annotation)
+
+
+def validate_factpack_section(name: str, value) -> None:
+    """
+    按 FactPack 中对应字段的类型校验单个顶层字段（不含条数等整体校验）
+    
+    用于流式生成时在字段结束后立即发现格式错误。未知字段不校验。
+    
+    Args:
+        name: 顶层字段名
+        value: 字段值
+        
+    Raises:
+        ValidationError: 字段不符合模型定义
+    """
+    if name not in FactPack.model_fields:
+        return
+    _section_adapter(name).validate_python(value)
@@ -3,12 +3,12 @@
 测试 OpenAI API Key
 """
 import sys
-from openai import OpenAI
+from http_client import get_openai_client, SDK_DEFAULT_MAX_RETRIES
 
 def test_api_key(api_key: str):
     """测试 API Key 是否可用"""
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key, max_retries=SDK_DEFAULT_MAX_RETRIES)
         response = client.chat.completions.create(
             model='gpt-4o',
             messages=[{'role': 'user', 'content': 'Hello, just say "OK"'}],
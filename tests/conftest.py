@@ -0,0 +1,43 @@
+"""
+测试公共夹具：模拟服务和使用临时缓存目录的生成器
+"""
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bench"))
+
+from mock_server import MockCompletionServer  # noqa: E402
+
+
+@pytest.fixture
+def mock_server():
+    """本地模拟的 OpenAI 兼容服务（无延迟）"""
+    with MockCompletionServer(latency=0) as server:
+        yield server
+
+
+@pytest.fixture
+def make_generator(tmp_path, monkeypatch, mock_server):
+    """在临时目录中创建连接模拟服务的生成器（缓存、锁、输出都写在临时目录）"""
+    from company_story import CompanyStoryGenerator
+    from retry import RetryPolicy
+    from utils import SQLiteCacheBackend
+
+    monkeypatch.chdir(tmp_path)
+    backend = SQLiteCacheBackend(str(tmp_path / "cache" / "cache.db"))
+
+    def _make(**kwargs):
+        kwargs.setdefault("enable_web_search", False)
+        kwargs.setdefault("retry_policy", RetryPolicy(base_delay=0.01, max_delay=0.1, max_retry_after=0.1))
+        return CompanyStoryGenerator(
+            api_key="mock",
+            base_url=mock_server.base_url,
+            cache_backend=backend,
+            **kwargs
+        )
+
+    return _make
@@ -0,0 +1,50 @@
+import os
+import importlib.util
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from conftest import REPO_DIR  # noqa: E402
+
+
+def _load_api_module():
+    spec = importlib.util.spec_from_file_location("api_main", os.path.join(REPO_DIR, "api", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_generate_job_streams_progress_then_hits_cache(make_generator, mock_server):
+    api = _load_api_module()
+    manager = api.JobManager(make_generator, max_workers=2)
+
+    with TestClient(api.create_app(manager)) as client:
+        response = client.post("/api/generate", json={"company": "AAPL"})
+        assert response.status_code == 202
+        job_id = response.json()["job_id"]
+
+        events = []
+        with client.stream("GET", f"/api/jobs/{job_id}/events") as stream:
+            for line in stream.iter_lines():
+                if line.startswith("event: "):
+                    events.append(line[len("event: "):])
+                    if events[-1] in ("done", "error"):
+                        break
+        assert events[-1] == "done"
+        assert "stage" in events
+        assert client.get(f"/api/jobs/{job_id}").json()["status"] == "done"
+
+        # 在结束事件之后重连：没有事件可回放，连接立即结束
+        with client.stream("GET", f"/api/jobs/{job_id}/events", headers={"Last-Event-ID": "9999"}) as stream:
+            assert [line for line in stream.iter_lines() if line] == []
+
+        requests_before = dict(mock_server.stats()["requests"])
+        cached = client.post("/api/generate", json={"company": "AAPL"})
+        assert cached.status_code == 200
+        assert cached.json()["cached"] is True
+        assert cached.json()["article"]
+        assert mock_server.stats()["requests"] == requests_before
@@ -0,0 +1,19 @@
+from datetime import datetime, timedelta
+
+from utils import get_today_date_str
+
+
+def _tomorrow() -> str:
+    return (datetime.strptime(get_today_date_str(), "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def test_prewarm_after_same_day_run_requests_fresh_factpack(make_generator, mock_server):
+    generator = make_generator(incremental_refresh=False)
+    generator.generate("AAPL")
+    assert mock_server.stats()["requests"].get("factpack") == 1
+
+    mock_server.reset_stats()
+    generator.generate("AAPL", use_cache=True, cache_date=_tomorrow())
+
+    # 不能复用白天缓存的响应，否则次日的 Fact Pack 实际上是今天的数据
+    assert mock_server.stats()["requests"].get("factpack") == 1
@@ -0,0 +1,25 @@
+import time
+
+import schemas
+from mock_server import canned_factpack
+
+
+def test_refresh_keeps_sections_the_model_left_out_expired(make_generator, monkeypatch):
+    generator = make_generator()
+    previous = schemas.FactPack(**canned_factpack("AAPL")).model_dump()
+    now = time.time()
+    stale = now - 48 * 3600
+    fetched_at = {section: now for section in generator.section_ttls}
+    fetched_at.update(valuation=stale, news_30_90d=stale)
+
+    # 重新请求 news_30_90d、valuation 时模型只返回了 news_30_90d
+    part = {"news_30_90d": previous["news_30_90d"], "sources": previous["sources"]}
+    monkeypatch.setattr(generator, "_fetch_fact_pack_section_parts", lambda *args, **kwargs: [part])
+
+    factpack, section_fetched_at = generator._refresh_fact_pack(
+        "AAPL", {"factpack": previous, "section_fetched_at": fetched_at}, now
+    )
+
+    assert factpack is not None
+    assert section_fetched_at["news_30_90d"] == now
+    assert section_fetched_at["valuation"] == stale
@@ -0,0 +1,17 @@
+from utils import SQLiteCacheBackend, UsageTracker
+
+
+def test_usage_records_from_separate_processes_are_merged(tmp_path):
+    backend = SQLiteCacheBackend(str(tmp_path / "cache.db"))
+    lock_dir = str(tmp_path / "locks")
+    # 两个实例模拟两个进程：各自先读取（为空）的历史，再分别写入
+    first = UsageTracker(backend=backend, lock_dir=lock_dir)
+    second = UsageTracker(backend=backend, lock_dir=lock_dir)
+    first.suggest_max_tokens("article", 16000)
+    second.suggest_max_tokens("article", 16000)
+
+    first.record("article", "AAPL", 1000, 3000)
+    second.record("article", "MSFT", 1000, 4000)
+
+    records = backend.get(UsageTracker.NAMESPACE, "article")["records"]
+    assert [record["company"] for record in records] == ["AAPL", "MSFT"]
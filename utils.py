@@ -4,9 +4,81 @@
 import re
 import os
 import json
+import time
+import hashlib
+import sqlite3
+import importlib
+import tempfile
+import functools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, date
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Optional, Tuple, List, Dict, Any, Callable
+
+from metrics import get_metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# FactPack 结构版本：修改字段或校验规则时递增，旧版本的缓存会被视为未命中
+# （定义在这里而不是 schemas.py，读缓存时不必导入 pydantic）
+FACTPACK_SCHEMA_VERSION = 1
+
+# 任务队列和预热的默认值（命令行参数默认值要用，放在这里避免启动时导入 job_queue、prewarm）
+DEFAULT_QUEUE_PATH = os.path.join("cache", "queue.db")
+DEFAULT_LEASE_SECONDS = 1800
+DEFAULT_PREWARM_WINDOW = "22:00-23:45"
+
+
+class LazyModule:
+    """
+    延迟导入的模块代理：第一次访问属性时才导入模块
+    
+    用于 pydantic 这类导入耗时上百毫秒、但命中缓存时用不到的依赖。多个线程同时第一次
+    访问时由 importlib 的导入锁保证只导入一次（Python 3.11 的 importlib.util.LazyLoader
+    在这种情况下会暴露尚未初始化完的模块）。
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr: str):
+        module = self._module
+        if module is None:
+            module = self._module = importlib.import_module(self._name)
+        return getattr(module, attr)
+    
+    def __repr__(self) -> str:
+        return f"<lazy module {self._name!r}{'' if self._module is None else ' (loaded)'}>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    延迟导入模块
+    
+    Args:
+        name: 模块名
+        
+    Returns:
+        模块代理，第一次访问属性时导入
+    """
+    return LazyModule(name)
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_encoding():
+    """o200k_base 编码；未安装 tiktoken（可选依赖）时返回 None"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        return None
 
 
 def sanitize_filename(name: str) -> str:
@@ -126,14 +198,148 @@ def save_cache(cache_path: str, data: dict) -> bool:
         是否保存成功
     """
     try:
-        with open(cache_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        atomic_write_json(cache_path, data)
         return True
     except Exception as e:
         print(f"警告：保存缓存失败：{e}")
         return False
 
 
+def atomic_write_json(path: str, data, indent: Optional[int] = 2) -> None:
+    """
+    原子地写入 JSON 文件：先写同目录下的临时文件，再重命名覆盖
+    
+    并发写入时读者只会看到旧文件或完整的新文件，不会读到写了一半的内容。
+    
+    Args:
+        path: 目标文件路径
+        data: 要写入的数据
+        indent: JSON 缩进
+    """
+    directory = os.path.dirname(path) or "."
+    with get_metrics().span("file_write", kind="json"):
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=indent)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+@contextmanager
+def file_lock(lock_path: str, timeout: float = 600, poll_interval: float = 0.2):
+    """
+    跨进程文件锁
+    
+    POSIX 系统上使用 fcntl.flock（进程退出时自动释放）；其他系统退回到
+    O_CREAT | O_EXCL 创建锁文件的方式，超过 timeout 的锁文件视为残留并清除。
+    
+    Args:
+        lock_path: 锁文件路径
+        timeout: 最长等待时间（秒），超时抛出 TimeoutError
+        poll_interval: 轮询间隔（秒）
+    """
+    Path(os.path.dirname(lock_path) or ".").mkdir(parents=True, exist_ok=True)
+    deadline = time.monotonic() + timeout
+    
+    if fcntl is not None:
+        with open(lock_path, 'a') as f:
+            while True:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"等待锁超时: {lock_path}")
+                    time.sleep(poll_interval)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        return
+    
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > timeout:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"等待锁超时: {lock_path}")
+            time.sleep(poll_interval)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
+class SingleFlight:
+    """
+    进程内的同键请求合并
+    
+    同一个键同时只执行一次；执行期间到达的调用会等待并拿到同一个结果
+    （或同一个异常）。
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key: str, fn):
+        """
+        执行 fn，或等待正在执行的同键调用
+        
+        Args:
+            key: 合并键
+            fn: 无参数的可调用对象
+            
+        Returns:
+            fn 的返回值
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = {"event": threading.Event(), "result": None, "error": None}
+                self._calls[key] = call
+                leader = True
+            else:
+                leader = False
+        
+        if not leader:
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+
 def get_today_date_str() -> str:
     """
     获取今天的日期字符串（YYYY-MM-DD）
@@ -179,6 +385,486 @@ def format_sources_section(sources: list) -> str:
     return "\n".join(lines)
 
 
+def dedupe_sources(sources: list) -> list:
+    """
+    按来源编号去重（保留第一次出现的条目）
+    
+    Args:
+        sources: Source 对象列表或字典列表
+        
+    Returns:
+        去重后的列表
+    """
+    seen_ids = set()
+    result = []
+    for source in sources:
+        source_id = source.get('id') if isinstance(source, dict) else getattr(source, 'id', None)
+        if source_id in seen_ids:
+            continue
+        seen_ids.add(source_id)
+        result.append(source)
+    return result
+
+
+def strip_sources_section(markdown: str) -> str:
+    """
+    移除 Markdown 文本中的 Sources / 来源 章节（从该标题到文末）
+    
+    Args:
+        markdown: Markdown 文本
+        
+    Returns:
+        移除后的文本
+    """
+    match = re.search(r'^##\s*(?:Sources|来源)\s*$', markdown, re.MULTILINE)
+    if match:
+        markdown = markdown[:match.start()]
+    return markdown.rstrip()
+
+
+def split_markdown_sections(markdown: str) -> List[Tuple[str, str]]:
+    """
+    按二级标题（##）切分 Markdown 文本
+    
+    Args:
+        markdown: Markdown 文本
+        
+    Returns:
+        [(heading_line, section_text), ...] 列表，section_text 包含标题行本身；
+        第一个标题之前的内容会被丢弃
+    """
+    sections = []
+    matches = list(re.finditer(r'^##(?!#).*$', markdown, re.MULTILINE))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(markdown)
+        sections.append((match.group(0), markdown[match.start():end].rstrip()))
+    return sections
+
+
+def parse_chapter_groups(spec: str, chapter_count: int = 11) -> List[List[int]]:
+    """
+    解析章节分组参数
+    
+    Args:
+        spec: 分组字符串，如 "1-2,3-4,5-6,7-8,9-10,11"（逗号分隔组，短横线表示区间，
+              组内多个不连续章节用 + 连接，如 "1+3"）
+        chapter_count: 章节总数
+        
+    Returns:
+        章节编号分组列表
+    """
+    groups = []
+    covered = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        group = []
+        for item in part.split("+"):
+            if "-" in item:
+                start, end = item.split("-", 1)
+                group.extend(range(int(start), int(end) + 1))
+            else:
+                group.append(int(item))
+        for n in group:
+            if n < 1 or n > chapter_count:
+                raise ValueError(f"章节编号超出范围: {n}")
+            if n in covered:
+                raise ValueError(f"章节 {n} 出现在多个分组中")
+            covered.add(n)
+        groups.append(group)
+    
+    missing = set(range(1, chapter_count + 1)) - covered
+    if missing:
+        raise ValueError(f"以下章节未分配到任何分组: {sorted(missing)}")
+    return groups
+
+
+def _normalize_source_id(source_id):
+    """把来源编号统一成 int（无法转换时原样返回）"""
+    try:
+        return int(source_id)
+    except (TypeError, ValueError):
+        return source_id
+
+
+def remap_source_ids(value, id_map: dict):
+    """
+    递归替换数据中所有 source_id 字段的编号
+    
+    Args:
+        value: 任意 JSON 数据（dict/list/标量）
+        id_map: 旧编号 -> 新编号映射；找不到映射的编号会被置为 None
+        
+    Returns:
+        替换后的新数据
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if key == "source_id" and item is not None:
+                result[key] = id_map.get(_normalize_source_id(item))
+            else:
+                result[key] = remap_source_ids(item, id_map)
+        return result
+    if isinstance(value, list):
+        return [remap_source_ids(item, id_map) for item in value]
+    return value
+
+
+def merge_factpack_sections(parts: List[dict]) -> dict:
+    """
+    合并多个部分 FactPack（每部分带有自己的 sources 列表）
+    
+    所有来源统一重新编号（从 1 开始），URL 相同的来源合并为一条，
+    各部分中的 source_id 随之替换为新编号。
+    
+    Args:
+        parts: 部分 FactPack 字典列表
+        
+    Returns:
+        合并后的 FactPack 字典
+    """
+    merged = {}
+    sources = []
+    url_to_id = {}
+    
+    for part in parts:
+        id_map = {}
+        for source in part.get("sources") or []:
+            if not isinstance(source, dict):
+                continue
+            url = (source.get("url") or "").strip()
+            if url and url in url_to_id:
+                new_id = url_to_id[url]
+                existing = sources[new_id - 1]
+                for used_for in source.get("used_for") or []:
+                    if used_for not in existing.setdefault("used_for", []):
+                        existing["used_for"].append(used_for)
+            else:
+                new_id = len(sources) + 1
+                new_source = dict(source)
+                new_source["id"] = new_id
+                new_source["used_for"] = list(source.get("used_for") or [])
+                sources.append(new_source)
+                if url:
+                    url_to_id[url] = new_id
+            if source.get("id") is not None:
+                id_map[_normalize_source_id(source["id"])] = new_id
+        
+        for key, value in part.items():
+            if key == "sources":
+                continue
+            merged[key] = remap_source_ids(value, id_map)
+    
+    merged["sources"] = sources
+    return merged
+
+
+# 补充条目时用来判断是否与已有条目重复的字段
+_GAP_FILL_IDENTITY_FIELDS = {
+    "timeline": ("date", "event"),
+    "news_30_90d": ("title",),
+    "risks": ("risk_name",),
+}
+
+
+def merge_gap_fill(
+    factpack_data: dict,
+    section: str,
+    new_items: list,
+    new_sources: list,
+    max_items: Optional[int] = None
+) -> dict:
+    """
+    把补充请求返回的条目合并到 FactPack 的某个列表字段
+    
+    补充条目可以直接引用已有来源的编号，也可以附带新来源：新来源中 URL 与已有来源
+    相同的合并为一条，其余接在已有来源之后编号，补充条目中的 source_id 随之替换。
+    与已有条目重复的补充条目会被丢弃；模型多给的条目超出 max_items 时，保留已有条目
+    和排在前面的补充条目。
+    
+    Args:
+        factpack_data: FactPack 字典
+        section: 列表字段名（如 timeline、news_30_90d、risks）
+        new_items: 补充的条目
+        new_sources: 补充条目使用的新来源
+        max_items: 合并后的条数上限（None 表示不限）
+        
+    Returns:
+        合并后的新 FactPack 字典
+    """
+    merged = dict(factpack_data)
+    sources = [dict(source) for source in merged.get("sources") or [] if isinstance(source, dict)]
+    id_map = {}
+    url_to_source = {}
+    for source in sources:
+        source_id = _normalize_source_id(source.get("id"))
+        id_map[source_id] = source_id
+        url = (source.get("url") or "").strip()
+        if url:
+            url_to_source[url] = source
+    next_id = max([sid for sid in id_map if isinstance(sid, int)] + [0]) + 1
+    
+    for source in new_sources or []:
+        if not isinstance(source, dict):
+            continue
+        url = (source.get("url") or "").strip()
+        existing = url_to_source.get(url) if url else None
+        if existing is not None:
+            existing["used_for"] = list(existing.get("used_for") or [])
+            for used_for in source.get("used_for") or []:
+                if used_for not in existing["used_for"]:
+                    existing["used_for"].append(used_for)
+            new_id = existing["id"]
+        else:
+            new_id = next_id
+            next_id += 1
+            new_source = dict(source)
+            new_source["id"] = new_id
+            new_source["used_for"] = list(source.get("used_for") or [])
+            sources.append(new_source)
+            if url:
+                url_to_source[url] = new_source
+        if source.get("id") is not None:
+            id_map[_normalize_source_id(source["id"])] = new_id
+    
+    identity_fields = _GAP_FILL_IDENTITY_FIELDS.get(section, ())
+    items = list(merged.get(section) or [])
+    seen = {
+        tuple(str(item.get(field) or "").strip().lower() for field in identity_fields)
+        for item in items if isinstance(item, dict)
+    }
+    for item in remap_source_ids([item for item in new_items or [] if isinstance(item, dict)], id_map):
+        if max_items is not None and len(items) >= max_items:
+            break
+        identity = tuple(str(item.get(field) or "").strip().lower() for field in identity_fields)
+        if identity_fields and identity in seen:
+            continue
+        seen.add(identity)
+        items.append(item)
+    
+    merged[section] = items
+    merged["sources"] = sources
+    return merged
+
+
+# FactPack 各字段的默认有效期（小时）：新闻和估值每天变化，其余字段变化缓慢
+DEFAULT_SECTION_TTLS = {
+    "company": 30 * 24,
+    "business": 7 * 24,
+    "timeline": 30 * 24,
+    "financials": 30 * 24,
+    "valuation": 24,
+    "news_30_90d": 24,
+    "risks": 7 * 24,
+    "competitors": 30 * 24,
+    "search_keywords": 7 * 24,
+}
+
+
+def parse_section_ttls(items: Optional[List[str]]) -> dict:
+    """
+    解析字段有效期参数
+    
+    Args:
+        items: ["news_30_90d=12", "financials=1440", ...]，单位为小时
+        
+    Returns:
+        在 DEFAULT_SECTION_TTLS 基础上覆盖后的字典
+    """
+    ttls = dict(DEFAULT_SECTION_TTLS)
+    for item in items or []:
+        if "=" not in item:
+            raise ValueError(f"字段有效期格式应为 SECTION=HOURS: {item}")
+        section, hours = item.split("=", 1)
+        section = section.strip()
+        if section not in DEFAULT_SECTION_TTLS:
+            raise ValueError(f"未知的 FactPack 字段: {section}")
+        ttls[section] = float(hours)
+    return ttls
+
+
+def expired_sections(section_fetched_at: dict, ttls: dict, now: Optional[float] = None) -> List[str]:
+    """
+    找出已过期的 FactPack 字段
+    
+    Args:
+        section_fetched_at: 字段 -> 上次获取时间（Unix 时间戳）
+        ttls: 字段 -> 有效期（小时）
+        now: 当前时间戳（默认 time.time()）
+        
+    Returns:
+        过期（或从未获取）的字段列表，按 ttls 中的顺序
+    """
+    now = now if now is not None else time.time()
+    expired = []
+    for section, ttl_hours in ttls.items():
+        fetched_at = section_fetched_at.get(section)
+        if fetched_at is None or now - fetched_at >= ttl_hours * 3600:
+            expired.append(section)
+    return expired
+
+
+def collect_source_ids(value) -> set:
+    """
+    收集数据中所有 source_id 字段引用的编号
+    
+    Args:
+        value: 任意 JSON 数据
+        
+    Returns:
+        编号集合
+    """
+    ids = set()
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == "source_id" and item is not None:
+                ids.add(_normalize_source_id(item))
+            else:
+                ids |= collect_source_ids(item)
+    elif isinstance(value, list):
+        for item in value:
+            ids |= collect_source_ids(item)
+    return ids
+
+
+def refresh_factpack_sections(previous: dict, new_parts: List[dict]) -> dict:
+    """
+    把重新获取的字段合并进上一版 FactPack
+    
+    未刷新的字段原样保留；上一版中只被已刷新字段使用的来源会被移除，
+    其余来源与新来源一起统一重新编号。
+    
+    Args:
+        previous: 上一版 FactPack 字典
+        new_parts: 新获取的部分 FactPack 列表（每部分带自己的 sources）
+        
+    Returns:
+        合并后的 FactPack 字典
+    """
+    refreshed = {key for part in new_parts for key in part if key != "sources"}
+    kept = {
+        key: value for key, value in previous.items()
+        if key not in refreshed and key not in ("sources", "generated_at")
+    }
+    
+    referenced = collect_source_ids(kept)
+    kept_sources = []
+    for source in previous.get("sources") or []:
+        if _normalize_source_id(source.get("id")) in referenced:
+            kept_sources.append(source)
+            continue
+        used_sections = {
+            match.group(0)
+            for used_for in source.get("used_for") or []
+            for match in [re.match(r'[A-Za-z0-9_]+', str(used_for))] if match
+        }
+        if used_sections & set(kept):
+            kept_sources.append(source)
+    
+    base_part = dict(kept)
+    base_part["sources"] = kept_sources
+    return merge_factpack_sections([base_part] + list(new_parts))
+
+
+# 仅用于记录的内部字段，不需要发给写作模型
+FACTPACK_INTERNAL_FIELDS = ("generated_at", "web_search_enabled")
+
+FINANCIAL_TABLE_COLUMNS = ("fiscal_year", "period_end", "value", "unit", "basis", "source_id")
+
+
+def _prune_empty(value):
+    """递归移除 None、空字符串、空列表和空字典"""
+    if isinstance(value, dict):
+        pruned = {key: _prune_empty(item) for key, item in value.items()}
+        return {key: item for key, item in pruned.items() if item not in (None, "", [], {})}
+    if isinstance(value, list):
+        pruned = [_prune_empty(item) for item in value]
+        return [item for item in pruned if item not in (None, "", [], {})]
+    return value
+
+
+def _format_table_value(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).replace("|", "/")
+
+
+def serialize_factpack_for_prompt(factpack_data: dict, compact_tables: bool = False) -> str:
+    """
+    把 FactPack 序列化为节省 token 的提示词文本
+    
+    去掉内部字段和空值（None、空字符串、空列表、空字典），使用紧凑分隔符；
+    compact_tables 为 True 时，financials 中的指标列表改为竖线分隔的表格。
+    
+    Args:
+        factpack_data: FactPack 字典（如 factpack.model_dump()）
+        compact_tables: 是否把财务指标渲染为表格
+        
+    Returns:
+        提示词文本
+    """
+    data = {key: value for key, value in factpack_data.items() if key not in FACTPACK_INTERNAL_FIELDS}
+    data = _prune_empty(data)
+    
+    financials = data.pop("financials", None) if compact_tables else None
+    text = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    if not financials:
+        return text
+    
+    lines = [f"financials（每行一个数据点，列：指标|{'|'.join(FINANCIAL_TABLE_COLUMNS)}）:"]
+    for metric_name, metrics in financials.items():
+        if not isinstance(metrics, list):
+            lines.append(f"{metric_name}:{json.dumps(metrics, ensure_ascii=False, separators=(',', ':'))}")
+            continue
+        for metric in metrics:
+            row = [metric.get("metric_name") or metric_name]
+            row.extend(_format_table_value(metric.get(column)) for column in FINANCIAL_TABLE_COLUMNS)
+            lines.append("|".join(row))
+    return text + "\n" + "\n".join(lines)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数
+    
+    安装了 tiktoken 时使用 o200k_base 编码精确计算；否则按经验规则估算
+    （中日韩字符约 1 token/字，其他字符约 4 字符/token）。
+    
+    Args:
+        text: 文本
+        
+    Returns:
+        token 数
+    """
+    encoding = _tiktoken_encoding()
+    if encoding is not None:
+        try:
+            return len(encoding.encode(text))
+        except Exception:
+            pass
+    cjk = len(re.findall(r'[\u3000-\u9fff\uac00-\ud7af\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def factpack_content_hash(factpack_data: dict) -> str:
+    """
+    计算 FactPack 内容的稳定哈希（忽略 generated_at 等与内容无关的字段）
+    
+    Args:
+        factpack_data: FactPack 字典（如 factpack.model_dump()）
+        
+    Returns:
+        SHA-256 十六进制字符串
+    """
+    content = {key: value for key, value in factpack_data.items() if key != "generated_at"}
+    payload = json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
 def validate_factpack_json(json_str: str) -> Tuple[bool, Optional[str]]:
     """
     验证 FactPack JSON 字符串的基本结构
@@ -204,3 +890,884 @@ def validate_factpack_json(json_str: str) -> Tuple[bool, Optional[str]]:
     except Exception as e:
         return (False, f"验证失败: {e}")
 
+
+class StreamingJSONObjectParser:
+    """
+    增量解析流式输出的 JSON 对象：每个顶层字段的值一结束就回调
+    
+    对象开始前的内容（如说明文字、```json 代码块标记）会被跳过。回调抛出的异常会
+    原样传给 feed 的调用方，调用方可以据此提前中止流式请求。
+    """
+    
+    def __init__(self, on_member: Optional[Callable[[str, Any], None]] = None):
+        """
+        初始化解析器
+        
+        Args:
+            on_member: 顶层字段回调 on_member(key, value)，value 为解析后的 Python 对象
+        """
+        self.on_member = on_member
+        self.members: Dict[str, Any] = {}
+        self.done = False
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expect = "key"
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+    
+    def feed(self, chunk: str) -> None:
+        """
+        追加一段输出并解析
+        
+        Args:
+            chunk: 新收到的内容片段
+        """
+        if self.done:
+            return
+        self._text += chunk
+        text = self._text
+        i = self._pos
+        while i < len(text) and not self.done:
+            ch = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expect == "key":
+                        self._key = json.loads(text[self._key_start:i + 1])
+                        self._expect = "colon"
+            elif self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._expect == "key":
+                        self._key_start = i
+                    elif self._expect == "value" and self._value_start is None:
+                        self._value_start = i
+            elif ch in "{[":
+                if self._depth == 1 and self._expect == "value" and self._value_start is None:
+                    self._value_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 1 and self._expect == "value":
+                    self._emit(text[self._value_start:i + 1])
+                elif self._depth == 0:
+                    if self._expect == "value" and self._value_start is not None:
+                        self._emit(text[self._value_start:i])
+                    self.done = True
+            elif self._depth == 1:
+                if ch == ":" and self._expect == "colon":
+                    self._expect = "value"
+                    self._value_start = None
+                elif ch == ",":
+                    if self._expect == "value" and self._value_start is not None:
+                        self._emit(text[self._value_start:i])
+                    self._expect = "key"
+                elif not ch.isspace() and self._expect == "value" and self._value_start is None:
+                    self._value_start = i
+            i += 1
+        self._pos = i
+    
+    def _emit(self, value_text: str) -> None:
+        key = self._key
+        self._expect = "after_value"
+        self._value_start = None
+        try:
+            value = json.loads(value_text)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"字段 {key} 不是合法 JSON: {e}")
+        self.members[key] = value
+        if self.on_member:
+            self.on_member(key, value)
+
+
+def _timed_cache_io(op: str):
+    """缓存后端读写计时（span cache_io，标签为后端、操作和命名空间）"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, namespace, *args, **kwargs):
+            with get_metrics().span("cache_io", backend=self.backend_name, op=op, namespace=namespace):
+                return method(self, namespace, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class CacheBackend:
+    """
+    缓存存储后端接口
+    
+    条目按 (namespace, key) 寻址，值为可 JSON 序列化的数据；可附带公司、日期、
+    schema 版本等元数据，用于查询和淘汰。
+    """
+    
+    def get(self, namespace: str, key: str, schema_version: Optional[int] = None):
+        """
+        读取条目
+        
+        Args:
+            namespace: 命名空间（如 factpack、factpack_state、response）
+            key: 键
+            schema_version: 如果提供，版本不一致的条目视为不存在
+            
+        Returns:
+            缓存的值；不存在、已过期或版本不一致时返回 None
+        """
+        raise NotImplementedError
+    
+    def put(
+        self,
+        namespace: str,
+        key: str,
+        value,
+        company: Optional[str] = None,
+        cache_date: Optional[str] = None,
+        schema_version: Optional[int] = None,
+        ttl: Optional[float] = None
+    ) -> bool:
+        """
+        写入条目
+        
+        Args:
+            namespace: 命名空间
+            key: 键
+            value: 可 JSON 序列化的值
+            company: 公司标识（用于查询）
+            cache_date: 数据日期 YYYY-MM-DD（用于查询）
+            schema_version: 数据的 schema 版本
+            ttl: 有效期（秒），None 表示不过期
+            
+        Returns:
+            是否写入成功
+        """
+        raise NotImplementedError
+    
+    def delete(self, namespace: str, key: str) -> None:
+        """删除条目"""
+        raise NotImplementedError
+    
+    def find(
+        self,
+        namespace: Optional[str] = None,
+        company: Optional[str] = None,
+        cache_date: Optional[str] = None,
+        schema_version: Optional[int] = None
+    ) -> List[dict]:
+        """
+        按元数据查询条目（不含值）
+        
+        Returns:
+            元数据字典列表（namespace、key、company、cache_date、schema_version、
+            created_at、accessed_at、expires_at、size）
+        """
+        raise NotImplementedError
+    
+    def evict(
+        self,
+        namespace: Optional[str] = None,
+        max_entries: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None
+    ) -> int:
+        """
+        删除过期条目，并按最久未使用的顺序淘汰超出上限的条目
+        
+        Args:
+            namespace: 只处理该命名空间（None 表示全部）
+            max_entries: 最多保留的条目数
+            max_bytes: 最多占用的字节数
+            max_age: 创建时间超过该秒数的条目会被删除
+            
+        Returns:
+            删除的条目数
+        """
+        raise NotImplementedError
+    
+    def compact(self) -> None:
+        """整理存储空间"""
+        raise NotImplementedError
+
+
+class JsonFileCacheBackend(CacheBackend):
+    """
+    每个条目一个 JSON 文件的缓存后端
+    
+    factpack 命名空间沿用 cache/<company>_<date>.json 的布局，其余命名空间放在
+    cache/<namespace>/ 子目录中。文件内容为 {"meta": {...}, "value": ...}；
+    旧版直接存放 FactPack 的文件也可以读取。
+    """
+    
+    backend_name = "json"
+    
+    def __init__(self, base_dir: str = "cache"):
+        self.base_dir = base_dir
+    
+    def _path(self, namespace: str, key: str) -> str:
+        safe_key = sanitize_filename(key)
+        if namespace == "factpack":
+            return os.path.join(self.base_dir, f"{safe_key}.json")
+        return os.path.join(self.base_dir, namespace, f"{safe_key}.json")
+    
+    def _read(self, path: str) -> Optional[Tuple[dict, object]]:
+        data = load_cache(path)
+        if data is None:
+            return None
+        if isinstance(data, dict) and set(data.keys()) == {"meta", "value"}:
+            return (data["meta"], data["value"])
+        # 旧版文件：没有元数据，直接是值
+        return ({}, data)
+    
+    @_timed_cache_io("get")
+    def get(self, namespace: str, key: str, schema_version: Optional[int] = None):
+        path = self._path(namespace, key)
+        entry = self._read(path)
+        if entry is None:
+            return None
+        meta, value = entry
+        expires_at = meta.get("expires_at")
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(namespace, key)
+            return None
+        if schema_version is not None and meta.get("schema_version", schema_version) != schema_version:
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+    
+    @_timed_cache_io("put")
+    def put(self, namespace, key, value, company=None, cache_date=None, schema_version=None, ttl=None) -> bool:
+        path = self._path(namespace, key)
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        meta = {
+            "namespace": namespace,
+            "key": key,
+            "company": company,
+            "cache_date": cache_date,
+            "schema_version": schema_version,
+            "created_at": now,
+            "expires_at": now + ttl if ttl is not None else None
+        }
+        return save_cache(path, {"meta": meta, "value": value})
+    
+    def delete(self, namespace: str, key: str) -> None:
+        try:
+            os.remove(self._path(namespace, key))
+        except OSError:
+            pass
+    
+    def _iter_files(self, namespace: Optional[str] = None):
+        if namespace == "factpack":
+            roots = [(self.base_dir, False)]
+        elif namespace:
+            roots = [(os.path.join(self.base_dir, namespace), True)]
+        else:
+            roots = [(self.base_dir, True)]
+        for root_dir, recursive in roots:
+            if not os.path.isdir(root_dir):
+                continue
+            for root, dirs, files in os.walk(root_dir):
+                for name in files:
+                    if name.endswith(".json"):
+                        yield os.path.join(root, name)
+                if not recursive:
+                    break
+    
+    def find(self, namespace=None, company=None, cache_date=None, schema_version=None) -> List[dict]:
+        results = []
+        for path in self._iter_files(namespace):
+            entry = self._read(path)
+            if entry is None:
+                continue
+            meta = dict(entry[0])
+            meta.setdefault("namespace", "factpack")
+            meta.setdefault("key", os.path.splitext(os.path.basename(path))[0])
+            if namespace and meta.get("namespace") != namespace:
+                continue
+            if company and meta.get("company") != company:
+                continue
+            if cache_date and meta.get("cache_date") != cache_date:
+                continue
+            if schema_version is not None and meta.get("schema_version") != schema_version:
+                continue
+            stat = os.stat(path)
+            meta["accessed_at"] = stat.st_mtime
+            meta["size"] = stat.st_size
+            results.append(meta)
+        return results
+    
+    def evict(self, namespace=None, max_entries=None, max_bytes=None, max_age=None) -> int:
+        now = time.time()
+        entries = []
+        for path in self._iter_files(namespace):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        
+        entries.sort()
+        removed = 0
+        remaining = []
+        for mtime, size, path in entries:
+            if max_age is not None and now - mtime > max_age:
+                try:
+                    os.remove(path)
+                    removed += 1
+                    continue
+                except OSError:
+                    pass
+            remaining.append((mtime, size, path))
+        
+        total_bytes = sum(size for _, size, _ in remaining)
+        while remaining and (
+            (max_entries is not None and len(remaining) > max_entries)
+            or (max_bytes is not None and total_bytes > max_bytes)
+        ):
+            _, size, path = remaining.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            removed += 1
+        return removed
+    
+    def compact(self) -> None:
+        # 删除空的子目录
+        for root, dirs, files in os.walk(self.base_dir, topdown=False):
+            if root != self.base_dir and not os.listdir(root):
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    单文件 SQLite 缓存后端（默认）
+    
+    所有条目存放在一张带索引的表里，支持按公司、日期、schema 版本查询，
+    以及按容量和存活时间淘汰。每个线程使用自己的连接，数据库使用 WAL 模式，
+    多个进程可以同时读写同一个文件。
+    """
+    
+    backend_name = "sqlite"
+    
+    def __init__(self, db_path: str = os.path.join("cache", "cache.db")):
+        self.db_path = db_path
+        self._local = threading.local()
+        Path(os.path.dirname(db_path) or ".").mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache_entries (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                company TEXT,
+                cache_date TEXT,
+                schema_version INTEGER,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                expires_at REAL,
+                size INTEGER NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key)
+            );
+            CREATE INDEX IF NOT EXISTS idx_cache_company_date ON cache_entries (company, cache_date);
+            CREATE INDEX IF NOT EXISTS idx_cache_schema ON cache_entries (schema_version);
+            CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache_entries (namespace, accessed_at);
+            CREATE INDEX IF NOT EXISTS idx_cache_expires ON cache_entries (expires_at);
+        """)
+    
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    @_timed_cache_io("get")
+    def get(self, namespace: str, key: str, schema_version: Optional[int] = None):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT value, expires_at, schema_version FROM cache_entries WHERE namespace = ? AND key = ?",
+            (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires_at, entry_version = row
+        now = time.time()
+        if expires_at is not None and expires_at <= now:
+            self.delete(namespace, key)
+            return None
+        if schema_version is not None and entry_version is not None and entry_version != schema_version:
+            return None
+        conn.execute(
+            "UPDATE cache_entries SET accessed_at = ? WHERE namespace = ? AND key = ?",
+            (now, namespace, key)
+        )
+        try:
+            return json.loads(value)
+        except ValueError as e:
+            print(f"警告：加载缓存失败：{e}")
+            return None
+    
+    @_timed_cache_io("put")
+    def put(self, namespace, key, value, company=None, cache_date=None, schema_version=None, ttl=None) -> bool:
+        try:
+            payload = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+            now = time.time()
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache_entries "
+                "(namespace, key, company, cache_date, schema_version, created_at, accessed_at, expires_at, size, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    namespace, key, company, cache_date, schema_version, now, now,
+                    now + ttl if ttl is not None else None,
+                    len(payload.encode("utf-8")), payload
+                )
+            )
+            return True
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"警告：保存缓存失败：{e}")
+            return False
+    
+    def delete(self, namespace: str, key: str) -> None:
+        self._conn().execute("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", (namespace, key))
+    
+    def find(self, namespace=None, company=None, cache_date=None, schema_version=None) -> List[dict]:
+        conditions = []
+        params = []
+        for column, value in (
+            ("namespace", namespace),
+            ("company", company),
+            ("cache_date", cache_date),
+            ("schema_version", schema_version)
+        ):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        columns = ["namespace", "key", "company", "cache_date", "schema_version",
+                   "created_at", "accessed_at", "expires_at", "size"]
+        rows = self._conn().execute(
+            f"SELECT {', '.join(columns)} FROM cache_entries {where} ORDER BY company, cache_date, namespace",
+            params
+        ).fetchall()
+        return [dict(zip(columns, row)) for row in rows]
+    
+    def evict(self, namespace=None, max_entries=None, max_bytes=None, max_age=None) -> int:
+        conn = self._conn()
+        now = time.time()
+        scope = "namespace = ?" if namespace else "1 = 1"
+        scope_params = [namespace] if namespace else []
+        removed = 0
+        
+        removed += conn.execute(
+            f"DELETE FROM cache_entries WHERE {scope} AND expires_at IS NOT NULL AND expires_at <= ?",
+            scope_params + [now]
+        ).rowcount
+        if max_age is not None:
+            removed += conn.execute(
+                f"DELETE FROM cache_entries WHERE {scope} AND created_at < ?",
+                scope_params + [now - max_age]
+            ).rowcount
+        
+        count, total_bytes = conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries WHERE {scope}",
+            scope_params
+        ).fetchone()
+        if (max_entries is None or count <= max_entries) and (max_bytes is None or total_bytes <= max_bytes):
+            return removed
+        
+        # 按最久未使用的顺序找出需要淘汰的条目
+        victims = []
+        rows = conn.execute(
+            f"SELECT namespace, key, size FROM cache_entries WHERE {scope} ORDER BY accessed_at",
+            scope_params
+        )
+        for entry_namespace, key, size in rows:
+            if (max_entries is None or count <= max_entries) and (max_bytes is None or total_bytes <= max_bytes):
+                break
+            victims.append((entry_namespace, key))
+            count -= 1
+            total_bytes -= size
+        conn.executemany("DELETE FROM cache_entries WHERE namespace = ? AND key = ?", victims)
+        return removed + len(victims)
+    
+    def compact(self) -> None:
+        conn = self._conn()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+
+
+_cache_backends = {}
+_cache_backends_lock = threading.Lock()
+
+
+def get_cache_backend(kind: str = "sqlite", base_dir: str = "cache") -> CacheBackend:
+    """
+    获取进程内共享的缓存后端实例
+    
+    Args:
+        kind: "sqlite"（默认，cache/cache.db）或 "json"（每个条目一个文件）
+        base_dir: 缓存目录
+        
+    Returns:
+        CacheBackend 实例
+    """
+    with _cache_backends_lock:
+        backend = _cache_backends.get((kind, base_dir))
+        if backend is None:
+            if kind == "sqlite":
+                backend = SQLiteCacheBackend(os.path.join(base_dir, "cache.db"))
+            elif kind == "json":
+                backend = JsonFileCacheBackend(base_dir)
+            else:
+                raise ValueError(f"未知的缓存后端: {kind}")
+            _cache_backends[(kind, base_dir)] = backend
+        return backend
+
+
+def make_factpack_cache_key(ticker_or_name: str, cache_date: Optional[str] = None) -> str:
+    """
+    生成 Fact Pack 缓存键（与旧版缓存文件名一致：<company>_<date>）
+    
+    Args:
+        ticker_or_name: 股票代码或公司名
+        cache_date: 日期（默认今天）
+        
+    Returns:
+        缓存键
+    """
+    return f"{sanitize_filename(ticker_or_name)}_{cache_date or get_today_date_str()}"
+
+
+def import_json_cache(backend: CacheBackend, base_dir: str = "cache") -> int:
+    """
+    把旧版 cache/ 目录中的 JSON 文件导入到缓存后端
+    
+    识别 <company>_<YYYY-MM-DD>.json（Fact Pack）和 <company>_state.json（增量刷新状态）。
+    
+    Args:
+        backend: 目标缓存后端
+        base_dir: 旧版缓存目录
+        
+    Returns:
+        导入的条目数
+    """
+    if not os.path.isdir(base_dir):
+        return 0
+    
+    imported = 0
+    for name in sorted(os.listdir(base_dir)):
+        path = os.path.join(base_dir, name)
+        if not name.endswith(".json") or not os.path.isfile(path):
+            continue
+        stem = name[:-len(".json")]
+        
+        factpack_match = re.match(r'^(.+)_(\d{4}-\d{2}-\d{2})$', stem)
+        state_match = re.match(r'^(.+)_state$', stem)
+        data = load_cache(path)
+        if data is None:
+            continue
+        schema_version = None
+        if isinstance(data, dict) and set(data.keys()) == {"meta", "value"}:
+            schema_version = data["meta"].get("schema_version")
+            data = data["value"]
+        
+        if factpack_match:
+            company, cache_date = factpack_match.groups()
+            ok = backend.put("factpack", stem, data, company=company, cache_date=cache_date,
+                             schema_version=schema_version)
+        elif state_match:
+            company = state_match.group(1)
+            ok = backend.put("factpack_state", company, data, company=company, schema_version=schema_version)
+        else:
+            continue
+        if ok:
+            imported += 1
+    return imported
+
+
+class ResponseCache:
+    """
+    按请求内容寻址的 LLM 响应缓存
+    
+    缓存键是模型、消息、工具和采样参数的哈希，任何一项变化都会落到新的键上。
+    每条记录有自己的过期时间；内存中保留一层 LRU，持久层（缓存后端的
+    response 命名空间）按条目数和总字节数淘汰最久未使用的记录。
+    """
+    
+    NAMESPACE = "response"
+    
+    # 参与缓存键计算的请求参数。max_tokens 不参与：输出被截断时会自动续写，
+    # 最终内容与输出上限无关，自适应调整上限也不应让缓存失效
+    KEY_FIELDS = (
+        "model", "messages", "tools", "temperature", "top_p",
+        "response_format", "seed", "presence_penalty", "frequency_penalty"
+    )
+    
+    def __init__(
+        self,
+        backend: Optional[CacheBackend] = None,
+        max_entries: int = 2000,
+        max_bytes: int = 200 * 1024 * 1024,
+        memory_entries: int = 128,
+        evict_every: int = 20
+    ):
+        """
+        初始化响应缓存
+        
+        Args:
+            backend: 持久层缓存后端（默认 get_cache_backend()）
+            max_entries: 持久层最多保留的条目数
+            max_bytes: 持久层最多占用的字节数
+            memory_entries: 内存 LRU 层的条目数
+            evict_every: 每写入多少条执行一次淘汰
+        """
+        self.backend = backend or get_cache_backend()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.evict_every = max(1, evict_every)
+        self._memory: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._writes = 0
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def make_key(cls, request_params: dict) -> str:
+        """
+        根据请求参数计算缓存键
+        
+        Args:
+            request_params: Chat Completions 请求参数
+            
+        Returns:
+            SHA-256 十六进制字符串
+        """
+        material = {field: request_params.get(field) for field in cls.KEY_FIELDS if field in request_params}
+        payload = json.dumps(material, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存
+        
+        Args:
+            key: 缓存键
+            
+        Returns:
+            缓存的响应内容；不存在或已过期时返回 None
+        """
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                expires_at, content = self._memory[key]
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return content
+                del self._memory[key]
+        
+        entry = self.backend.get(self.NAMESPACE, key)
+        if not entry:
+            return None
+        self._remember(key, entry["expires_at"], entry["content"])
+        return entry["content"]
+    
+    def put(self, key: str, content: str, ttl: float) -> None:
+        """
+        写入缓存
+        
+        Args:
+            key: 缓存键
+            content: 响应内容
+            ttl: 有效期（秒）
+        """
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, content)
+        if not self.backend.put(self.NAMESPACE, key, {"expires_at": expires_at, "content": content}, ttl=ttl):
+            return
+        
+        with self._lock:
+            self._writes += 1
+            should_evict = self._writes % self.evict_every == 0
+        if should_evict:
+            self.evict()
+    
+    def delete(self, key: str) -> None:
+        """
+        删除缓存记录（内容解析或校验失败时调用，避免在有效期内反复返回坏结果）
+        
+        Args:
+            key: 缓存键
+        """
+        with self._lock:
+            self._memory.pop(key, None)
+        self.backend.delete(self.NAMESPACE, key)
+    
+    def _remember(self, key: str, expires_at: float, content: str) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, content)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+    
+    def evict(self) -> int:
+        """
+        删除过期记录，并按最久未使用的顺序淘汰超出条目数/字节数上限的记录
+        
+        Returns:
+            删除的条目数
+        """
+        return self.backend.evict(
+            namespace=self.NAMESPACE,
+            max_entries=self.max_entries,
+            max_bytes=self.max_bytes
+        )
+
+
+class UsageTracker:
+    """
+    按阶段记录每次调用的 token 用量，并据此推算各阶段的输出上限（max_tokens）
+    
+    用量记录保存在缓存后端的 usage 命名空间（键为阶段名），每个阶段只保留最近
+    max_history 条；写入时在跨进程文件锁内重新读取再追加，多个进程同时运行不会互相覆盖。输出上限取历史 completion_tokens 的 p95 再乘以余量系数，
+    并向上取整到 256 的倍数；样本不足时使用调用方给出的默认上限。
+    """
+    
+    NAMESPACE = "usage"
+    
+    def __init__(
+        self,
+        backend: Optional[CacheBackend] = None,
+        max_history: int = 200,
+        min_samples: int = 5,
+        percentile: float = 0.95,
+        headroom: float = 1.25,
+        floor: int = 1024,
+        lock_dir: str = os.path.join("cache", "locks")
+    ):
+        """
+        初始化用量记录
+        
+        Args:
+            backend: 缓存后端（默认 get_cache_backend()）
+            max_history: 每个阶段保留的记录条数
+            min_samples: 开始自适应所需的最少样本数
+            percentile: 使用的分位数
+            headroom: 余量系数
+            floor: 自适应上限的下限
+            lock_dir: 跨进程文件锁目录
+        """
+        self.backend = backend or get_cache_backend()
+        self.max_history = max_history
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.headroom = headroom
+        self.floor = floor
+        self.lock_dir = lock_dir
+        self._history: Dict[str, List[dict]] = {}
+        self._lock = threading.Lock()
+    
+    def _load(self, stage: str) -> List[dict]:
+        if stage not in self._history:
+            entry = self.backend.get(self.NAMESPACE, stage)
+            self._history[stage] = list(entry.get("records", [])) if entry else []
+        return self._history[stage]
+    
+    def record(
+        self,
+        stage: str,
+        company: Optional[str],
+        prompt_tokens: int,
+        completion_tokens: int,
+        finish_reason: Optional[str] = None,
+        continuations: int = 0
+    ) -> None:
+        """
+        记录一次调用的用量（含续写请求在内的合计）
+        
+        Args:
+            stage: 阶段名（如 factpack、factpack_section、article、chapter）
+            company: 公司标识
+            prompt_tokens: 输入 token 数
+            completion_tokens: 输出 token 数
+            finish_reason: 最后一次请求的结束原因
+            continuations: 续写次数
+        """
+        record = {
+            "company": company,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "finish_reason": finish_reason,
+            "continuations": continuations,
+            "at": time.time()
+        }
+        # 其他进程可能在本进程读取之后写入过，在锁内重新读取共享记录再追加
+        with file_lock(os.path.join(self.lock_dir, f"usage_{sanitize_filename(stage)}.lock")):
+            entry = self.backend.get(self.NAMESPACE, stage)
+            records = list(entry.get("records", [])) if entry else []
+            records.append(record)
+            del records[:-self.max_history]
+            self.backend.put(self.NAMESPACE, stage, {"records": records})
+        with self._lock:
+            self._history[stage] = records
+    
+    def suggest_max_tokens(self, stage: str, default: int) -> int:
+        """
+        推算某阶段的输出上限
+        
+        Args:
+            stage: 阶段名
+            default: 样本不足时使用的上限，同时也是自适应结果的上限（优先于 floor）
+            
+        Returns:
+            max_tokens
+        """
+        with self._lock:
+            samples = sorted(r["completion_tokens"] for r in self._load(stage) if r.get("completion_tokens"))
+        if len(samples) < self.min_samples:
+            return default
+        index = min(len(samples) - 1, int(round(self.percentile * (len(samples) - 1))))
+        budget = int(samples[index] * self.headroom)
+        budget = -(-budget // 256) * 256
+        # default 可能来自 --max-output-tokens，下限不能把它撑破
+        return min(default, max(self.floor, budget))
+    
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """
+        各阶段用量汇总（样本数、平均/p95 输出 token、截断续写次数）
+        
+        Returns:
+            {阶段名: 汇总字典}
+        """
+        result = {}
+        with self._lock:
+            stages = set(self._history)
+        for stage in sorted(stages):
+            with self._lock:
+                records = list(self._load(stage))
+            completions = sorted(r["completion_tokens"] for r in records if r.get("completion_tokens"))
+            if not completions:
+                continue
+            result[stage] = {
+                "samples": len(completions),
+                "avg_completion_tokens": sum(completions) / len(completions),
+                "p95_completion_tokens": completions[min(len(completions) - 1, int(round(0.95 * (len(completions) - 1))))],
+                "continuations": sum(r.get("continuations", 0) for r in records)
+            }
+        return result